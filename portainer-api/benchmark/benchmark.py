@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" portainer-api deploy benchmarks against the local fake portainer """
+
+import contextlib
+import getopt
+import importlib
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from fake_portainer import Config, FakePortainer
+
+COMPOSE_FILE = '''version: "3.7"
+services:
+  web:
+    image: nginx:1
+    deploy:
+      placement:
+        constraints: [node.role == worker]
+  worker:
+    image: redis:5
+'''
+
+# name: (fake portainer config, deploy kind, deploy arguments)
+SCENARIOS = {
+    'container': ({}, 'container', {}),
+    'container-networks': ({'networks': 200}, 'container', {'networks': ['app', 'backend']}),
+    'container-networks-legacy': ({'networks': 200, 'single_network': True}, 'container', {'networks': ['app', 'backend']}),
+    'container-skip-unchanged': ({}, 'container', {'skip_unchanged': True}),
+    'container-blue-green': ({}, 'container', {'blue_green': True}),
+    'service-update': ({'services': 500}, 'service', {}),
+    'service-create': ({'services': 500, 'networks': 200}, 'service', {'name': 'api', 'networks': ['app', 'backend']}),
+    'service-wait': ({}, 'service', {'wait': True}),
+    'stack-update': ({'stacks': 300, 'services': 500}, 'stack', {}),
+    'stack-wait': ({'stacks': 300}, 'stack', {'wait': True}),
+    # only the worker image differs from the live services
+    'stack-diff': ({'stacks': 300, 'services': 500, 'stack_file': COMPOSE_FILE}, 'stack', {'wait': True}),
+    'stack-full-update': ({'stacks': 300, 'services': 500, 'stack_file': COMPOSE_FILE}, 'stack', {'wait': True, 'diff': False}),
+    'latency-50ms': ({'latency': 0.05}, 'service', {}),
+    'slow-pull': ({'layers': 10, 'pull_delay': 0.005}, 'service', {}),
+    'flaky-get': ({'failure_rate': 0.5}, 'service', {}),
+}
+
+def deploy_args(kind, options, compose_file):
+    name = options.get('name', 'bench' if kind == 'stack' else 'hello')
+    return (
+        'local',
+        'web' if kind == 'stack' else name,
+        None if kind == 'stack' else 'nginx:1',
+        list(options.get('networks', [])),
+        [],
+        [],
+        [],
+        'bench' if kind == 'stack' else None,
+        compose_file if kind == 'stack' else None,
+        0
+    )
+
+def operation(kind, options):
+    if kind == 'stack':
+        return 'deploy_stack', (None, True, options.get('wait', False), None, options.get('diff', True))
+    if kind == 'service':
+        return 'deploy_service', ('Replicated', 2, True, options.get('skip_unchanged', False), options.get('wait', False), None)
+    return 'deploy_container', (options.get('skip_unchanged', False), options.get('blue_green', False), None)
+
+def run_sync(kind, options, compose_file):
+    import deploy
+    instance = deploy.Deploy(*deploy_args(kind, options, compose_file))
+    try:
+        name, args = operation(kind, options)
+        getattr(instance, name)(*args)
+        return instance.connection_stats()
+    finally:
+        instance.close()
+
+def run_async(kind, options, compose_file):
+    import asyncio
+    import async_deploy
+
+    async def run():
+        async with async_deploy.AsyncDeploy(*deploy_args(kind, options, compose_file)) as instance:
+            name, args = operation(kind, options)
+            await getattr(instance, name)(*args)
+            return instance.connection_stats()
+
+    return asyncio.run(run())
+
+def run_scenario(server, name, engine, repeat, compose_file, verbose):
+    config, kind, options = SCENARIOS[name]
+    samples = []
+    for _ in range(repeat):
+        server.reset(Config(**config))
+        output = io.StringIO()
+        start = time.time()
+        error = None
+        with contextlib.redirect_stdout(sys.stdout if verbose else output):
+            try:
+                connections = (run_async if engine == 'async' else run_sync)(kind, options, compose_file)
+            except Exception as ex:
+                connections = {}
+                error = str(ex)
+        samples.append(dict(server.state.stats(), wall = time.time() - start, opened = connections.get('opened'), error = error))
+
+    walls = [sample['wall'] for sample in samples]
+    last = samples[-1]
+    return {
+        'scenario': name,
+        'engine': engine,
+        'wall': statistics.median(walls),
+        'wall_min': min(walls),
+        'wall_max': max(walls),
+        'requests': last['requests'],
+        'failures': last['failures'],
+        'bytes_in': last['bytes_in'],
+        'bytes_out': last['bytes_out'],
+        'connections': last['opened'],
+        'error': next((sample['error'] for sample in samples if sample['error']), None)
+    }
+
+def format_results(results, baseline = None):
+    baseline = dict(((item['scenario'], item['engine']), item) for item in baseline or [])
+    lines = ['{:<26} {:<6} {:>9} {:>9} {:>6} {:>6} {:>10} {:>11} {:>6}  {}'.format(
+        'SCENARIO', 'ENGINE', 'WALL', 'CHANGE', 'REQS', 'FAILED', 'BYTES IN', 'BYTES OUT', 'CONNS', 'ERROR')]
+    for result in results:
+        previous = baseline.get((result['scenario'], result['engine']))
+        change = '{:+.0%}'.format(result['wall'] / previous['wall'] - 1) if previous and previous['wall'] else ''
+        lines.append('{:<26} {:<6} {:>8.3f}s {:>9} {:>6} {:>6} {:>10} {:>11} {:>6}  {}'.format(
+            result['scenario'], result['engine'], result['wall'], change, result['requests'], result['failures'], result['bytes_in'],
+            result['bytes_out'], result['connections'] if result['connections'] is not None else '-', result['error'] or ''))
+    return '\n'.join(lines)
+
+def regressions(results, baseline, threshold):
+    '''
+    scenarios whose median wall time grew by more than threshold, or that now need more requests
+    '''
+    baseline = dict(((item['scenario'], item['engine']), item) for item in baseline)
+    found = []
+    for result in results:
+        previous = baseline.get((result['scenario'], result['engine']))
+        if not previous:
+            continue
+        if result['error'] and not previous['error']:
+            found.append('{} ({}): now fails: {}'.format(result['scenario'], result['engine'], result['error']))
+        if previous['wall'] and result['wall'] > previous['wall'] * (1 + threshold):
+            found.append('{} ({}): wall {:.3f}s -> {:.3f}s'.format(result['scenario'], result['engine'], previous['wall'], result['wall']))
+        if result['requests'] > previous['requests']:
+            found.append('{} ({}): requests {} -> {}'.format(result['scenario'], result['engine'], previous['requests'], result['requests']))
+    return found
+
+def main(argv):
+    usage = 'Usage: benchmark.py \
+            --scenario=service-update \
+            --engine=sync|async|all \
+            --repeat=5 \
+            --output=results.json \
+            --baseline=results.json \
+            --threshold=0.2 \
+            --verbose \
+            --list'
+    try:
+        opts, _ = getopt.getopt(argv, '', ['scenario=', 'engine=', 'repeat=', 'output=', 'baseline=', 'threshold=', 'verbose', 'list'])
+    except getopt.GetoptError as er:
+        print(er)
+        print(usage)
+        return 2
+
+    scenarios = []
+    engines = ['sync']
+    repeat = 3
+    output = None
+    baseline = None
+    threshold = 0.2
+    verbose = False
+    for opt, arg in opts:
+        if opt == '--scenario':
+            scenarios.append(arg.strip())
+        elif opt == '--engine':
+            engines = ['sync', 'async'] if arg.strip() == 'all' else [arg.strip()]
+        elif opt == '--repeat':
+            repeat = int(arg)
+        elif opt == '--output':
+            output = arg.strip()
+        elif opt == '--baseline':
+            baseline = json.load(open(arg.strip(), 'r'))
+        elif opt == '--threshold':
+            threshold = float(arg)
+        elif opt == '--verbose':
+            verbose = True
+        elif opt == '--list':
+            for name, (config, kind, options) in SCENARIOS.items():
+                print('{:<26} {:<10} {} {}'.format(name, kind, config, options))
+            return 0
+
+    for name in scenarios:
+        if name not in SCENARIOS:
+            print('Unknown scenario {}, see --list'.format(name))
+            return 2
+
+    with tempfile.TemporaryDirectory() as workdir, FakePortainer() as server:
+        compose_file = os.path.join(workdir, 'docker-compose.yml')
+        with open(compose_file, 'w') as compose:
+            compose.write(COMPOSE_FILE)
+        os.environ.update({
+            'PORTAINER_URL': server.url,
+            'PORTAINER_USERNAME': 'bench',
+            'PORTAINER_PASSWORD': 'bench',
+            'REGISTRY_HOST': 'registry.bench',
+            'PORTAINER_BACKOFF': '0',
+            # every run starts cold: login and endpoint lookup included
+            'PORTAINER_CACHE': 'off',
+            # deploy history is written as usual, into the scratch directory
+            'PORTAINER_HISTORY': os.path.join(workdir, 'history.db'),
+        })
+        os.environ.pop('PORTAINER_METRICS_FILE', None)
+        # keep module import time out of the first scenario
+        for module in ('deploy', 'async_deploy'):
+            importlib.import_module(module)
+
+        results = []
+        for name in scenarios or list(SCENARIOS):
+            for engine in engines:
+                results.append(run_scenario(server, name, engine, repeat, compose_file, verbose))
+                print(format_results(results[-1:], baseline).splitlines()[-1], flush = True)
+
+    print()
+    print(format_results(results, baseline))
+    if output:
+        with open(output, 'w') as output_file:
+            json.dump(results, output_file, indent = 2)
+
+    if baseline:
+        found = regressions(results, baseline, threshold)
+        for line in found:
+            print('REGRESSION ' + line)
+        if found:
+            return 1
+    return 1 if any(result['error'] for result in results) else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" local stand-in for the Portainer and Docker (through Portainer) apis used by deploy.py """
+
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# a jwt whose exp claim lies far in the future
+TOKEN = 'e30.eyJleHAiOjk5OTk5OTk5OTl9.x'
+DIGEST = 'sha256:' + 'b' * 64
+
+class Config:
+    '''
+    latency: seconds added to every response
+    services, networks, stacks, containers: size of the lists the server returns
+    layers, layer_size, pull_delay: image pulls stream layers progress lines, pull_delay seconds apart
+    failure_rate: share of GET requests answered with 503, the client is expected to retry them
+    converge_delay: seconds after an update until the tasks of a service run
+    stack_file: compose file the bench stack was deployed with
+    single_network: behave like engines before docker 25, which connect a new container to one network only
+    '''
+    def __init__(self, latency = 0, services = 10, networks = 10, stacks = 10, containers = 10,
+                 layers = 5, layer_size = 20 * 1024 * 1024, pull_delay = 0, failure_rate = 0, converge_delay = 0.5,
+                 stack_file = '', single_network = False):
+        self.latency = latency
+        self.services = services
+        self.networks = networks
+        self.stacks = stacks
+        self.containers = containers
+        self.layers = layers
+        self.layer_size = layer_size
+        self.pull_delay = pull_delay
+        self.failure_rate = failure_rate
+        self.converge_delay = converge_delay
+        self.stack_file = stack_file
+        self.single_network = single_network
+
+def service(service_id, name, labels = None):
+    return {
+        'ID': service_id,
+        'Version': {'Index': 1},
+        'Spec': {
+            'Name': name,
+            'Labels': labels or {},
+            'TaskTemplate': {
+                'ContainerSpec': {'Image': 'nginx:1@' + DIGEST},
+                'Resources': {'Limits': {}},
+                'ForceUpdate': 0,
+                'Placement': {'Constraints': ['node.role == worker']}
+            },
+            'Mode': {'Replicated': {'Replicas': 2}}
+        },
+        'UpdatedAt': 0
+    }
+
+class State:
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.random = random.Random(0)
+        self.services = [service('svc{}'.format(i), 'filler_{}'.format(i), {'com.docker.stack.namespace': 'filler'})
+                         for i in range(config.services)]
+        self.services.append(service('svc-hello', 'hello'))
+        self.services.append(service('svc-web', 'bench_web', {'com.docker.stack.namespace': 'bench'}))
+        self.services.append(service('svc-worker', 'bench_worker', {'com.docker.stack.namespace': 'bench'}))
+        self.networks = [{'Name': 'net{}'.format(i), 'Id': 'n{}'.format(i), 'Driver': 'overlay'} for i in range(config.networks)]
+        self.networks += [{'Name': 'app', 'Id': 'napp', 'Driver': 'overlay'}, {'Name': 'backend', 'Id': 'nbackend', 'Driver': 'overlay'}]
+        self.stacks = [{'Id': i + 1, 'Name': 'stack{}'.format(i), 'EndpointId': 1, 'SwarmId': 'swarm1'} for i in range(config.stacks)]
+        self.stacks.append({'Id': len(self.stacks) + 1, 'Name': 'bench', 'EndpointId': 1, 'SwarmId': 'swarm1'})
+        self.stack_files = {len(self.stacks): config.stack_file}
+        self.containers = {'filler{}'.format(i): {'Image': 'nginx:1'} for i in range(config.containers)}
+        self.containers['hello'] = {'Image': 'nginx:1'}
+
+    def count(self, bytes_in, bytes_out):
+        with self.lock:
+            self.requests += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def stats(self):
+        return {'requests': self.requests, 'failures': self.failures, 'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out}
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # like portainer (go), otherwise headers and body wait on delayed acks
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def send(self, code, body = b''):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        return len(data)
+
+    def stream(self, lines):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        size = 0
+        for line in lines:
+            data = json.dumps(line).encode() + b'\r\n'
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            self.wfile.flush()
+            size += len(data)
+            if self.state.config.pull_delay:
+                time.sleep(self.state.config.pull_delay)
+        self.wfile.write(b'0\r\n\r\n')
+        return size
+
+    def handle_any(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if self.state.config.latency:
+            time.sleep(self.state.config.latency)
+        if method == 'GET' and self.state.config.failure_rate and self.state.random.random() < self.state.config.failure_rate:
+            with self.state.lock:
+                self.state.failures += 1
+            size = self.send(503, {'message': 'injected failure'})
+        else:
+            url = urlparse(self.path)
+            size = self.route(method, re.sub(r'^/api/endpoints/\d+/docker', '/docker', url.path), parse_qs(url.query), body)
+        self.state.count(length + len(self.path), size)
+
+    def route(self, method, path, query, body):
+        state = self.state
+        filters = json.loads(query['filters'][0]) if 'filters' in query else {}
+        if path == '/api/auth':
+            return self.send(200, {'jwt': TOKEN})
+        if path == '/api/endpoints':
+            return self.send(200, [{'Name': 'local', 'Id': 1}])
+        if path == '/docker/containers/json':
+            return self.send(200, [{'Id': name, 'Names': ['/' + name]} for name in state.containers])
+        if path == '/docker/v2/agents':
+            return self.send(200, [{'NodeName': 'manager1', 'NodeRole': 1}, {'NodeName': 'worker1', 'NodeRole': 2},
+                                   {'NodeName': 'worker2', 'NodeRole': 2}])
+        if path == '/docker/images/create':
+            return self.stream(self.pull_lines(query.get('tag', ['latest'])[0]))
+        if path.startswith('/docker/images/') and path.endswith('/json'):
+            return self.send(200, {'Id': 'sha256:image', 'RepoDigests': ['nginx@' + DIGEST], 'RepoTags': ['nginx:1']})
+        if path.startswith('/docker/distribution/'):
+            return self.send(200, {'Descriptor': {'digest': DIGEST}})
+        if path == '/docker/containers/create':
+            endpoints = list((json.loads(body).get('NetworkingConfig') or {}).get('EndpointsConfig') or {})
+            if state.config.single_network and len(endpoints) > 1:
+                return self.send(400, {'message': 'Container cannot be connected to network endpoints: ' + ', '.join(endpoints)})
+            state.containers[query['name'][0]] = json.loads(body)
+            return self.send(201, {'Id': query['name'][0]})
+        match = re.match(r'^/docker/containers/([^/]+)(/\w+)?$', path)
+        if match:
+            return self.container(method, match.group(1), match.group(2), query)
+        if path == '/docker/networks':
+            names = filters.get('name')
+            return self.send(200, [network for network in state.networks
+                                   if not names or any(name in network['Name'] for name in names)])
+        if re.match(r'^/docker/networks/[^/]+/connect$', path):
+            return self.send(200)
+        if path == '/docker/swarm':
+            return self.send(200, {'ID': 'swarm1'})
+        if path == '/docker/services':
+            return self.send(200, [item for item in state.services if self.service_matches(item, filters)])
+        if path == '/docker/services/create':
+            spec = json.loads(body)
+            state.services.append(dict(service('svc-' + spec['Name'], spec['Name']), Spec = spec, UpdatedAt = time.time()))
+            return self.send(201, {'ID': 'svc-' + spec['Name']})
+        match = re.match(r'^/docker/services/([^/]+)(/update)?$', path)
+        if match:
+            return self.service(method, match.group(1), match.group(2), query, body)
+        if path == '/docker/tasks':
+            return self.send(200, self.tasks(filters))
+        if path == '/api/stacks' and method == 'POST':
+            spec = json.loads(body)
+            state.stacks.append({'Id': len(state.stacks) + 1, 'Name': spec['Name'], 'EndpointId': 1, 'SwarmId': spec['SwarmID']})
+            state.stack_files[len(state.stacks)] = spec['StackFileContent']
+            return self.send(200, state.stacks[-1])
+        if path == '/api/stacks':
+            return self.send(200, state.stacks)
+        match = re.match(r'^/api/stacks/(\d+)(/file)?$', path)
+        if match:
+            stack_id = int(match.group(1))
+            if match.group(2):
+                return self.send(200, {'StackFileContent': state.stack_files.get(stack_id, '')})
+            state.stack_files[stack_id] = json.loads(body)['StackFileContent']
+            self.touch_stack([stack for stack in state.stacks if stack['Id'] == stack_id][0]['Name'])
+            return self.send(200, {'Id': stack_id})
+        return self.send(404, {'message': 'unhandled {} {}'.format(method, path)})
+
+    def pull_lines(self, tag):
+        config = self.state.config
+        lines = [{'status': 'Pulling from library/nginx', 'id': tag}]
+        lines += [{'status': 'Pulling fs layer', 'id': 'layer{}'.format(layer)} for layer in range(config.layers)]
+        for step in range(1, 5):
+            for layer in range(config.layers):
+                lines.append({'status': 'Downloading', 'id': 'layer{}'.format(layer),
+                              'progressDetail': {'current': config.layer_size * step // 4, 'total': config.layer_size}})
+        lines += [{'status': 'Pull complete', 'id': 'layer{}'.format(layer)} for layer in range(config.layers)]
+        lines.append({'status': 'Digest: ' + DIGEST})
+        lines.append({'status': 'Status: Downloaded newer image for nginx:' + tag})
+        return lines
+
+    def container(self, method, name, action, query):
+        state = self.state
+        if method == 'DELETE':
+            return self.send(204 if state.containers.pop(name, None) is not None else 404)
+        if action == '/json':
+            if name not in state.containers:
+                return self.send(404, {'message': 'No such container: ' + name})
+            # inspect splits the create body like docker does
+            config = dict(state.containers[name])
+            host_config = config.pop('HostConfig', {})
+            networks = (config.pop('NetworkingConfig', None) or {}).get('EndpointsConfig') or {}
+            return self.send(200, {
+                'Id': name,
+                'Image': 'sha256:image',
+                'Config': config,
+                'HostConfig': host_config,
+                'State': {'Running': True, 'Health': {'Status': 'healthy'}},
+                'NetworkSettings': {'Networks': dict((network, {}) for network in networks)}
+            })
+        if action == '/rename':
+            state.containers[query['name'][0]] = state.containers.pop(name)
+        return self.send(204)
+
+    def service_matches(self, item, filters):
+        spec = item['Spec']
+        if 'id' in filters and item['ID'] not in filters['id']:
+            return False
+        if 'name' in filters and not any(name in spec['Name'] for name in filters['name']):
+            return False
+        for label in filters.get('label', []):
+            key, _, value = label.partition('=')
+            if spec.get('Labels', {}).get(key) != value:
+                return False
+        return True
+
+    def service(self, method, service_id, action, query, body):
+        for item in self.state.services:
+            if service_id in (item['ID'], item['Spec']['Name']):
+                if action:
+                    if int(query['version'][0]) != item['Version']['Index']:
+                        return self.send(500, {'message': 'update out of sequence'})
+                    item['Spec'] = json.loads(body)
+                    item['Version']['Index'] += 1
+                    item['UpdatedAt'] = time.time()
+                    return self.send(200, {'Warnings': None})
+                return self.send(200, item)
+        return self.send(404, {'message': 'service {} not found'.format(service_id)})
+
+    def touch_stack(self, name):
+        for item in self.state.services:
+            if item['Spec'].get('Labels', {}).get('com.docker.stack.namespace') == name:
+                item['Version']['Index'] += 1
+                item['UpdatedAt'] = time.time()
+
+    def tasks(self, filters):
+        tasks = []
+        for item in self.state.services:
+            if 'service' in filters and item['ID'] not in filters['service']:
+                continue
+            running = time.time() - item['UpdatedAt'] >= self.state.config.converge_delay
+            replicas = item['Spec'].get('Mode', {}).get('Replicated', {}).get('Replicas', 1)
+            for slot in range(replicas):
+                tasks.append({
+                    'ServiceID': item['ID'],
+                    'NodeID': 'node{}'.format(slot),
+                    'Spec': item['Spec']['TaskTemplate'],
+                    'Status': {'State': 'running' if running else 'starting'},
+                    'DesiredState': 'running'
+                })
+        return tasks
+
+    def do_GET(self):
+        self.handle_any('GET')
+
+    def do_POST(self):
+        self.handle_any('POST')
+
+    def do_PUT(self):
+        self.handle_any('PUT')
+
+    def do_DELETE(self):
+        self.handle_any('DELETE')
+
+class FakePortainer:
+    '''
+        with FakePortainer(Config(latency = 0.02)) as server:
+            os.environ['PORTAINER_URL'] = server.url
+    '''
+    def __init__(self, config = None, port = 0):
+        self.config = config or Config()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.server.state = State(self.config)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def reset(self, config = None):
+        self.config = config or self.config
+        self.server.state = State(self.config)
+
+    def start(self):
+        threading.Thread(target = self.server.serve_forever, daemon = True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+if __name__ == '__main__':
+    import sys
+    server = FakePortainer(port = int(sys.argv[1]) if len(sys.argv) > 1 else 9000).start()
+    print('Fake portainer listening on {}'.format(server.url))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,741 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" portainer-api asyncio engine """
+
+import aiohttp
+import asyncio
+import copy
+import deploy
+import json
+import time
+from metrics import timed
+from pull_progress import PullProgress
+from retry import CircuitOpenError, StatusError, RETRY_STATUS, BREAKER_STATUS
+
+class AsyncResponse:
+    '''
+    the parts of requests.Response the deploy workflow relies on
+    '''
+    def __init__(self, method, url, status_code, content, headers = None):
+        self.method = method
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+        self.retried = False
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', 'replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise StatusError('{} {} failed with {}: {}'.format(self.method, self.url, self.status_code, self.text), self.status_code)
+
+class AsyncDeploy(deploy.Deploy):
+    '''
+    asyncio variant of Deploy, independent steps (image pulls, network connects,
+    service and stack lookups) run concurrently on one aiohttp session.
+
+        async with AsyncDeploy('local', 'hello', image, ...) as instance:
+            await instance.deploy_container()
+    '''
+    def __init__(self, endpoint_name, container_name, image, networks, ports, volumes, envs, stack_name, compose_file, memory_limit,
+                 pool_size = None, timeout = None, session = None, portainer_token = None, endpoint_id = None, cache = None,
+                 metrics = None, update_config = None, cpu_limit = None, memory_reservation = None, cpu_reservation = None,
+                 constraints = None, spread = None, history = None, retries = None, backoff = None):
+        self.configure(endpoint_name, container_name, image, networks, ports, volumes, envs, stack_name, compose_file, memory_limit,
+                       pool_size, timeout, retries, backoff, cache, metrics, update_config, cpu_limit, memory_reservation,
+                       cpu_reservation, constraints, spread, history)
+        # session, token and endpoint id are set up in setup()
+        self.session = session
+        self.own_session = session is None
+        self.portainer_token = portainer_token
+        self.endpoint_id = endpoint_id
+        self.stats = {'requests': 0, 'opened': 0, 'reused': 0}
+
+    async def setup(self):
+        if not self.session:
+            connect_timeout, read_timeout = self.timeout
+            trace = aiohttp.TraceConfig()
+            trace.on_request_start.append(self.on_trace('requests'))
+            trace.on_connection_create_end.append(self.on_trace('opened'))
+            trace.on_connection_reuseconn.append(self.on_trace('reused'))
+            self.session = aiohttp.ClientSession(
+                connector = aiohttp.TCPConnector(limit = self.pool_size),
+                timeout = aiohttp.ClientTimeout(sock_connect = connect_timeout, sock_read = read_timeout),
+                trace_configs = [trace])
+        if not self.portainer_token:
+            self.portainer_token = await self.auth_portainer()
+        self.use_endpoint(self.endpoint_id or await self.parse_endpoint_id(self.endpoint_name))
+        return self
+
+    def on_trace(self, name):
+        async def count(session, context, params):
+            self.stats[name] += 1
+        return count
+
+    def connection_stats(self):
+        return dict(self.stats)
+
+    async def close(self):
+        if self.session and self.own_session:
+            await self.session.close()
+
+    async def __aenter__(self):
+        return await self.setup()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def request(self, method, url, headers = None, params = None, data = None, timeout = None, idempotent = None):
+        '''
+        portainer call retried along self.retry like Deploy.request
+        '''
+        # aiohttp rejects None header values and non-string query values
+        headers = { key: value for key, value in (headers or {}).items() if value is not None }
+        if params:
+            params = { key: str(value).lower() if isinstance(value, bool) else str(value) for key, value in params.items() }
+        result = await self.retried_request(method, url, headers, params, data, timeout, idempotent)
+
+        # a cached token may have been revoked, login again once
+        if result.status_code == 401 and self.portainer_token and headers.get('authorization') == self.portainer_token:
+            self.portainer_token = await self.auth_portainer(refresh = True)
+            headers['authorization'] = self.portainer_token
+            return await self.retried_request(method, url, headers, params, data, timeout, idempotent)
+        return result
+
+    async def retried_request(self, method, url, headers, params, data, timeout, idempotent):
+        breaker = self.retry.breaker(url)
+        breaker.check()
+        attempt = 0
+        while True:
+            failure = None
+            try:
+                result = await self.timed_request(method, url, headers, params, data, timeout, attempt)
+                status = result.status_code
+            except Exception as ex:
+                result, status, failure = None, None, ex
+            if failure is None and status not in RETRY_STATUS:
+                breaker.record(False)
+                result.retried = attempt > 0
+                return result
+            delay = None
+            sent = failure is None or not isinstance(failure, aiohttp.ClientConnectorError)
+            if self.retry.retryable(method, status, sent, idempotent):
+                delay = self.retry.delay(attempt, result.headers.get('Retry-After') if result is not None else None)
+            if delay is None:
+                breaker.record(failure is not None or status in BREAKER_STATUS)
+                if failure is not None:
+                    raise failure
+                result.retried = attempt > 0
+                return result
+            print('Retry {} {} in {:.2f}s after {}'.format(method, self.metric_path(url), delay, status or failure))
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def timed_request(self, method, url, headers, params, data, timeout, attempt):
+        kwargs = {}
+        if timeout:
+            kwargs['timeout'] = aiohttp.ClientTimeout(total = timeout)
+        retries = 1 if attempt else 0
+        start = time.time()
+        try:
+            async with self.session.request(method, url, headers = headers, params = params, data = data, **kwargs) as response:
+                content = await response.read()
+                result = AsyncResponse(method, url, response.status, content, response.headers)
+        except Exception:
+            self.metrics.record_http(method, self.metric_path(url), 'error', None, time.time() - start, retries, self.metric_labels)
+            raise
+        self.metrics.record_http(method, self.metric_path(url), result.status_code, len(content), time.time() - start, retries, self.metric_labels)
+        return result
+
+    @timed('auth')
+    async def auth_portainer(self, refresh = False):
+        cache_key = 'token|{}|{}'.format(self.portainer_url, self.portainer_username)
+        if not refresh:
+            token = self.cache.get(cache_key)
+            if token:
+                return token
+
+        url = self.portainer_url + '/api/auth'
+        payload = json.dumps({'Username': self.portainer_username, 'Password': self.portainer_password})
+        # a login has no side effect, retried like a GET
+        response = await self.request('POST', url, data = payload, headers = {'cache-control': 'no-cache'}, idempotent = True)
+        response.raise_for_status()
+        token = response.json()['jwt']
+        self.cache.set_token(cache_key, token)
+        return token
+
+    @timed('endpoint')
+    async def parse_endpoint_id(self, endpoint_name, refresh = False):
+        cache_key = 'endpoint|{}|{}'.format(self.portainer_url, endpoint_name.lower())
+        endpoint_id = self.cache.get(cache_key) if not refresh else None
+        if endpoint_id:
+            return endpoint_id
+
+        url = self.portainer_url + '/api/endpoints'
+        headers = {
+            'authorization': self.portainer_token,
+            'cache-control': 'no-cache',
+        }
+        response = await self.request('GET', url, headers = headers)
+        response.raise_for_status()
+        return self.select_endpoint(response.json(), endpoint_name)
+
+    @timed('warmup')
+    async def warmup(self):
+        try:
+            await self.check_endpoint()
+        except Exception as ex:
+            self.forget_endpoint()
+            try:
+                endpoint_id = await self.parse_endpoint_id(self.endpoint_name, refresh = True)
+            except Exception:
+                raise ex
+            if not self.endpoint_moved(endpoint_id):
+                raise ex
+            await self.check_endpoint()
+
+    async def check_endpoint(self):
+        url = '{0}/containers/json'.format(self.docker_api_prefix)
+        headers = {
+            'authorization': self.portainer_token,
+            'cache-control': 'no-cache',
+        }
+        response = await self.request('GET', url, headers = headers, timeout = 5)
+        response.raise_for_status()
+
+    async def agents(self):
+        url = '{}/v2/agents'.format(self.docker_api_prefix)
+        response = await self.request('GET', url, headers = {'authorization': self.portainer_token})
+        response.raise_for_status()
+        return response.json()
+
+    async def agent_nodes(self):
+        try:
+            return await self.agents()
+        except Exception as ex:
+            print('Can not list agents ({}), pull on the endpoint only.'.format(ex))
+            return None
+
+    @timed('pull')
+    async def pull_images(self, plan, concurrency = None):
+        semaphore = asyncio.Semaphore(concurrency or deploy.DEFAULT_PULL_CONCURRENCY)
+        timings = {}
+
+        async def pull(image, node):
+            async with semaphore:
+                start = time.time()
+                await self.pull_image(image, node)
+                timings['{} ({})'.format(image, node) if node else image] = time.time() - start
+
+        await asyncio.gather(*[pull(image, node) for image, node in plan])
+        self.print_pull_timings(timings)
+
+    async def pull_image_on_nodes(self, image_name = None, constraints = None, concurrency = None):
+        image_name, _ = self.image_query(image_name)
+        plan = self.pull_plan({image_name: [constraints]}, await self.agent_nodes())
+        await self.pull_images(plan, concurrency or min(len(plan), self.pool_size))
+
+    @timed('pull_image')
+    async def pull_image(self, image_name = None, agent_node = None):
+        url = '{}/images/create'.format(self.docker_api_prefix)
+        image_name, queryString = self.image_query(image_name)
+        headers = {
+            'authorization': self.portainer_token,
+            'X-Registry-Auth': self.registry_auth(image_name),
+            'cache-control': 'no-cache',
+        }
+        if agent_node:
+            headers["x-portaineragent-target"] = agent_node
+
+        label = '{} ({})'.format(image_name, agent_node) if agent_node else image_name
+        attempt = 0
+        while True:
+            try:
+                await self.stream_pull(url, headers, queryString, label, attempt)
+                break
+            except CircuitOpenError:
+                raise
+            except Exception as ex:
+                delay = self.pull_retry_delay(ex, attempt)
+                if delay is None:
+                    raise Exception('Pull image {} failed: {}'.format(label, ex))
+                print('Pull {} attempt {} failed: {}, retry in {:.2f}s'.format(label, attempt + 1, ex, delay))
+                await asyncio.sleep(delay)
+                attempt += 1
+
+        url = '{}/images/{}/json'.format(self.docker_api_prefix, image_name)
+        response = await self.request('GET', url, headers = headers)
+        response.raise_for_status()
+        print("Pull image {} Id: {} successfully.".format(image_name, response.json()["Id"]))
+
+    async def stream_pull(self, url, headers, queryString, label, attempt = 0):
+        progress = PullProgress(label)
+        headers = { key: value for key, value in headers.items() if value is not None }
+        timeout = aiohttp.ClientTimeout(sock_connect = self.timeout[0], sock_read = self.pull_idle_timeout)
+        breaker = self.retry.breaker(url)
+        breaker.check()
+        start = time.time()
+        try:
+            response = await self.session.request('POST', url, headers = headers, params = queryString, timeout = timeout)
+        except Exception:
+            self.metrics.record_http('POST', self.metric_path(url), 'error', None, time.time() - start, 1 if attempt else 0, self.metric_labels)
+            breaker.record(True)
+            raise
+        async with response:
+            self.metrics.record_http('POST', self.metric_path(url), response.status, response.content_length,
+                                     time.time() - start, 1 if attempt else 0, self.metric_labels)
+            breaker.record(response.status in BREAKER_STATUS)
+            if response.status >= 400:
+                raise StatusError('{} {}'.format(response.status, await response.text()), response.status)
+            async for line in response.content:
+                line = line.strip()
+                if line:
+                    progress.feed(json.loads(line))
+                if progress.stalled(self.pull_idle_timeout):
+                    raise Exception('no progress for {}s'.format(self.pull_idle_timeout))
+                progress.report()
+        progress.report(force = True)
+        return progress
+
+    async def pull_stack_images(self, concurrency = None, prepull = True):
+        agents = await self.agent_nodes() if prepull else None
+        await self.pull_images(self.pull_plan(self.stack_images(), agents), concurrency)
+
+    @timed('digest')
+    async def registry_digest(self, image_name = None):
+        image_name, _ = self.image_query(image_name)
+        url = '{}/distribution/{}/json'.format(self.docker_api_prefix, image_name)
+        headers = {
+            'authorization': self.portainer_token,
+            'X-Registry-Auth': self.registry_auth(image_name),
+        }
+        try:
+            response = await self.request('GET', url, headers = headers)
+            response.raise_for_status()
+            return response.json()['Descriptor']['digest']
+        except Exception as ex:
+            print('Can not resolve registry digest of {}: {}'.format(image_name, ex))
+            return None
+
+    async def container_unchanged(self, digest):
+        headers = { 'authorization': self.portainer_token }
+        url = '{}/containers/{}/json'.format(self.docker_api_prefix, self.container_name)
+        response = await self.request('GET', url, headers = headers)
+        if response.status_code == 404:
+            return False
+        response.raise_for_status()
+        container = response.json()
+        if not self.container_current(container) or not self.container_config_current(container):
+            return False
+
+        url = '{}/images/{}/json'.format(self.docker_api_prefix, container['Image'])
+        response = await self.request('GET', url, headers = headers)
+        response.raise_for_status()
+        return self.image_has_digest(response.json(), digest)
+
+    @timed('delete_container')
+    async def delete_container(self, force = True, name = None):
+        url = '{}/containers/{}'.format(self.docker_api_prefix, name or self.container_name)
+        response = await self.request('DELETE', url, headers = {'authorization': self.portainer_token}, params = {'force': force})
+        if response.status_code == 404:
+            print('Container not exists')
+        else:
+            response.raise_for_status()
+
+    @timed('create_container')
+    async def create_container(self, name = None, aliases = None):
+        url = '{0}/containers/create'.format(self.docker_api_prefix)
+        headers = {
+            'authorization': self.portainer_token,
+            'content-type': 'application/json',
+        }
+        params = {'name': name or self.container_name}
+        single = len(self.networks) > 1 and self.cache.get(self.single_network_key())
+        payload = self.container_payload(self.networks[:1] if single else self.networks, aliases)
+        response = await self.request('POST', url, data = json.dumps(payload), headers = headers, params = params, idempotent = True)
+        if not single and len(self.networks) > 1 and self.networks_rejected(response):
+            print('Docker engine takes one network at create, join the others afterwards')
+            self.cache.set(self.single_network_key(), True)
+            single = True
+            payload = self.container_payload(self.networks[:1], aliases)
+            response = await self.request('POST', url, data = json.dumps(payload), headers = headers, params = params, idempotent = True)
+        if response.status_code == 409 and response.retried:
+            # the container is deleted before, an attempt that failed on the way back did create it
+            container_id = (await self.inspect_container(params['name']))['Id']
+        else:
+            response.raise_for_status()
+            container_id = response.json()['Id']
+
+        if single:
+            # connect to the other networks concurrently
+            await asyncio.gather(*[self.join_network(network, container_id, aliases) for network in self.networks[1:]])
+
+    async def join_network(self, network, container_id, aliases = None):
+        url = '{}/networks/{}/connect'.format(self.docker_api_prefix, network['name'])
+        headers = {
+            'authorization': self.portainer_token,
+            'content-type': 'application/json',
+        }
+        payload = {'Container': container_id, 'EndpointConfig': self.endpoint_config(network, aliases)}
+        response = await self.request('POST', url, headers = headers, data = json.dumps(payload), idempotent = True)
+        # joined by an attempt that failed on the way back
+        if not (response.status_code == 403 and response.retried):
+            response.raise_for_status()
+        print('join network ' + network['name'] + ' success.')
+
+    @timed('start_container')
+    async def start_container(self, name = None):
+        url = '{}/containers/{}/start'.format(self.docker_api_prefix, name or self.container_name)
+        # starting a started container answers 304
+        response = await self.request('POST', url, headers = {'authorization': self.portainer_token}, idempotent = True)
+        response.raise_for_status()
+
+    async def inspect_container(self, name = None):
+        url = '{}/containers/{}/json'.format(self.docker_api_prefix, name or self.container_name)
+        response = await self.request('GET', url, headers = {'authorization': self.portainer_token})
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json()
+
+    async def inspect_image(self, image_id):
+        url = '{}/images/{}/json'.format(self.docker_api_prefix, image_id)
+        response = await self.request('GET', url, headers = {'authorization': self.portainer_token})
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json()
+
+    async def container_snapshot(self, name = None):
+        if not self.history.enabled:
+            return None
+        container = await self.inspect_container(name)
+        if not container:
+            return None
+        return self.snapshot_payload(container, await self.inspect_image(container['Image']))
+
+    async def rename_container(self, name, new_name):
+        url = '{}/containers/{}/rename'.format(self.docker_api_prefix, name)
+        response = await self.request('POST', url, headers = {'authorization': self.portainer_token}, params = {'name': new_name})
+        response.raise_for_status()
+
+    @timed('wait_healthy')
+    async def wait_healthy(self, name, timeout = None):
+        timeout = timeout or deploy.DEFAULT_HEALTH_TIMEOUT
+        start = time.time()
+        running_since = None
+        while time.time() - start < timeout:
+            health = self.container_health(await self.inspect_container(name))
+            if health == 'healthy':
+                print('Container {} healthy after {:.1f}s'.format(name, time.time() - start))
+                return
+            if health in ('unhealthy', 'stopped'):
+                raise Exception('Container {} is {}'.format(name, health))
+            if health == 'running':
+                running_since = running_since or time.time()
+                if time.time() - running_since >= deploy.NO_HEALTHCHECK_GRACE:
+                    print('Container {} has no healthcheck, running for {:.1f}s'.format(name, time.time() - running_since))
+                    return
+            else:
+                running_since = None
+            await asyncio.sleep(deploy.CONVERGE_POLL_MIN)
+        raise Exception('Container {} not healthy in {}s'.format(name, timeout))
+
+    async def deploy_container_blue_green(self, health_timeout = None):
+        next_name = self.container_name + '-next'
+        old_name = self.container_name + '-old'
+
+        await self.delete_container(name = next_name)
+        await self.create_container(next_name, [self.container_name])
+        await self.start_container(next_name)
+        try:
+            await self.wait_healthy(next_name, health_timeout)
+        except Exception:
+            print('New container is not healthy, keep the old one')
+            await self.delete_container(name = next_name)
+            raise
+        print('new container healthy')
+
+        has_old = await self.inspect_container() is not None
+        if has_old:
+            await self.delete_container(name = old_name)
+            await self.rename_container(self.container_name, old_name)
+        await self.rename_container(next_name, self.container_name)
+        if has_old:
+            await self.delete_container(name = old_name)
+        print('swap container successfully')
+
+    async def swarm_id(self):
+        cache_key = 'swarm|{}|{}'.format(self.portainer_url, self.endpoint_id)
+        swarm_id = self.cache.get(cache_key)
+        if swarm_id:
+            return swarm_id
+
+        url = '{}/swarm'.format(self.docker_api_prefix)
+        response = await self.request('GET', url, headers = {'authorization': self.portainer_token})
+        response.raise_for_status()
+        swarm_id = response.json()["ID"]
+        if swarm_id:
+            self.cache.set(cache_key, swarm_id)
+        return swarm_id
+
+    async def stacks(self):
+        if self.stack_index is None:
+            response = await self.request('GET', self.stack_api_prefix, headers = {'authorization': self.portainer_token})
+            response.raise_for_status()
+            self.stack_index = self.index_stacks(response.json())
+        return self.stack_index
+
+    async def stack_id(self):
+        stack = (await self.stacks()).get(self.stack_name)
+        if stack:
+            return stack["Id"]
+
+    @timed('create_stack')
+    async def create_stack(self):
+        payload, queryString = self.stack_payload(await self.swarm_id())
+        response = await self.request('POST', self.stack_api_prefix, data = payload,
+                                      headers = {'authorization': self.portainer_token}, params = queryString)
+        response.raise_for_status()
+        print(response.text)
+        self.stack_index = None
+
+    @timed('update_stack')
+    async def update_stack(self, stack_id):
+        url = '{}/{}'.format(self.stack_api_prefix, stack_id)
+        payload = json.dumps({'StackFileContent': self.compose_file})
+        response = await self.request('PUT', url, data = payload,
+                                      headers = {'authorization': self.portainer_token}, params = {'endpointId': self.endpoint_id})
+        response.raise_for_status()
+        print(response.text)
+
+    async def stack_file(self, stack_id):
+        url = '{}/{}/file'.format(self.stack_api_prefix, stack_id)
+        response = await self.request('GET', url, headers = {'authorization': self.portainer_token})
+        response.raise_for_status()
+        return response.json()['StackFileContent']
+
+    @timed('stack_diff')
+    async def stack_changes(self, stack_id):
+        plan = self.stack_plan(*(await asyncio.gather(self.stack_file(stack_id), self.stack_services())))
+        if not plan:
+            return None
+
+        images, live = plan
+        unique_images = sorted(set(images.values()))
+        digests = dict(zip(unique_images, await asyncio.gather(*[self.registry_digest(image) for image in unique_images])))
+        return self.stack_image_changes(images, live, digests)
+
+    @timed('update_service')
+    async def update_stack_service(self, service, image, digest):
+        headers = {
+            'authorization': self.portainer_token,
+            'X-Registry-Auth': self.registry_auth(image)
+        }
+        response = await self.post_service_update(service, lambda current: self.stack_service_payload(current, image, digest), headers)
+        response.raise_for_status()
+        print('Update service {} to {} successfully'.format(service['Spec']['Name'], service['Spec']['TaskTemplate']['ContainerSpec']['Image']))
+
+    async def inspect_service(self, service_id):
+        url = '{}/services/{}'.format(self.docker_api_prefix, service_id)
+        response = await self.request('GET', url, headers = {'authorization': self.portainer_token})
+        response.raise_for_status()
+        return response.json()
+
+    async def post_service_update(self, service, build_payload, headers):
+        url = '{}/services/{}/update'.format(self.docker_api_prefix, service['ID'])
+        for attempt in range(deploy.VERSION_CONFLICT_RETRIES + 1):
+            replaced = copy.deepcopy(service['Spec'])
+            payload = json.dumps(build_payload(service))
+            response = await self.request('POST', url, data = payload, headers = headers,
+                                          params = {'version': service['Version']['Index']})
+            response.replaced = replaced
+            if not self.version_conflict(response) or attempt == deploy.VERSION_CONFLICT_RETRIES:
+                return response
+            print('Service {} was updated meanwhile, retry with a fresh spec'.format(service['Spec']['Name']))
+            fresh = await self.inspect_service(service['ID'])
+            service.clear()
+            service.update(fresh)
+
+    async def get_networks(self, names):
+        missing = [name for name in names if name not in self.network_index]
+        if missing:
+            response = await self.request('GET', self.docker_api_prefix + '/networks', headers = {'authorization': self.portainer_token},
+                                          params = self.name_filter(*missing))
+            response.raise_for_status()
+            self.index_networks(missing, response.json())
+        return [self.network_index[name] for name in names]
+
+    async def get_network(self, name):
+        return (await self.get_networks([name]))[0]
+
+    async def get_service(self):
+        response = await self.request('GET', self.docker_api_prefix + '/services', headers = {'authorization': self.portainer_token},
+                                      params = self.name_filter(self.service_name()))
+        response.raise_for_status()
+        return self.select_service(response.json())
+
+    async def stack_services(self):
+        queryString = {'filters': json.dumps({'label': ['com.docker.stack.namespace={}'.format(self.stack_name)]})}
+        response = await self.request('GET', self.docker_api_prefix + '/services', headers = {'authorization': self.portainer_token},
+                                      params = queryString)
+        response.raise_for_status()
+        return response.json()
+
+    async def stack_service_ids(self):
+        return [service['ID'] for service in await self.stack_services()]
+
+    @timed('wait_converged')
+    async def wait_converged(self, service_ids, timeout = None):
+        timeout = timeout or deploy.DEFAULT_CONVERGE_TIMEOUT
+        headers = {'authorization': self.portainer_token}
+        start = time.time()
+        delay = deploy.CONVERGE_POLL_MIN
+        pending = list(service_ids)
+        durations = {}
+        last = None
+        while pending:
+            services, tasks = await asyncio.gather(
+                self.request('GET', self.docker_api_prefix + '/services', headers = headers,
+                             params = {'filters': json.dumps({'id': pending})}),
+                self.request('GET', self.docker_api_prefix + '/tasks', headers = headers,
+                             params = {'filters': json.dumps({'service': pending, 'desired-state': ['running']})}))
+            services.raise_for_status()
+            tasks.raise_for_status()
+            state = self.converge_round(services.json(), tasks.json(), pending, start, durations)
+            if not pending:
+                break
+            delay = self.converge_delay(delay, state, last, start, timeout)
+            last = state
+            await asyncio.sleep(delay)
+        return durations
+
+    @timed('create_service')
+    async def create_service(self, mode = "Replicated", replicas = 1, digest = None):
+        headers = {
+            'authorization': self.portainer_token,
+            'X-Registry-Auth': self.registry_auth()
+        }
+        networks = await self.get_networks([network['name'] for network in self.networks])
+        payload = json.dumps(self.service_payload(mode, replicas, networks, digest))
+        response = await self.request('POST', self.docker_api_prefix + '/services/create', data = payload, headers = headers)
+        response.raise_for_status()
+        print(response.text)
+        print('Create service successfully')
+        return response.json()['ID']
+
+    @timed('deploy')
+    async def deploy_service(self, mode = "Replicated", replicas = 1, prepull = True, skip_unchanged = False,
+                             wait = False, wait_timeout = None):
+        await self.warmup()
+        agents, current_service, digest = await asyncio.gather(
+            self.agent_nodes() if prepull else asyncio.sleep(0),
+            self.get_service(),
+            self.registry_digest())
+        if current_service and skip_unchanged and digest and self.service_unchanged(current_service, digest):
+            print('Service {} already runs {}@{}, no-op'.format(self.service_name(), self.image, digest))
+            return deploy.NO_OP
+
+        placement = current_service["Spec"]["TaskTemplate"].get("Placement", {}) if current_service else {}
+        image_name, _ = self.image_query()
+        plan = self.pull_plan({image_name: [self.constraints or placement.get("Constraints")]}, agents)
+        await self.pull_images(plan, min(len(plan), self.pool_size))
+        if not current_service:
+            print("Service not exists!")
+            print("Trying to create service: {}".format(self.service_name()))
+            service_id = await self.create_service(mode, replicas, digest)
+            self.record_deploy('service', self.service_name(), None, None)
+            if wait:
+                await self.wait_converged([service_id], wait_timeout)
+            return
+
+        previous = await self.update_service(current_service, digest)
+        self.record_deploy('service', self.service_name(), previous, previous["TaskTemplate"]["ContainerSpec"]["Image"])
+        if wait:
+            await self.wait_converged([current_service["ID"]], wait_timeout)
+
+    @timed('update_service')
+    async def update_service(self, current_service, digest = None):
+        headers = {
+            'authorization': self.portainer_token,
+            'X-Registry-Auth': self.registry_auth()
+        }
+        response = await self.post_service_update(current_service, lambda service: self.service_update_payload(service, digest), headers)
+        response.raise_for_status()
+        print(response.text)
+        print('Update service {} successfully'.format(self.service_name()))
+        return response.replaced
+
+    @timed('deploy')
+    async def deploy_container(self, skip_unchanged = False, blue_green = False, health_timeout = None):
+        if self.constraints or self.spread or self.cpu_reservation:
+            print('Placement and cpu reservations only apply to swarm services, ignored for containers')
+        await self.warmup()
+        print('warmup successfully')
+
+        if skip_unchanged:
+            digest = await self.registry_digest()
+            if digest and await self.container_unchanged(digest):
+                print('Container {} already runs {}@{}, no-op'.format(self.container_name, self.image, digest))
+                return deploy.NO_OP
+
+        _, previous = await asyncio.gather(self.pull_image(), self.container_snapshot())
+        print('pull image successfully')
+
+        if blue_green and self.ports:
+            print('Published ports can not be bound by two containers, blue/green deploy disabled')
+        elif blue_green:
+            await self.deploy_container_blue_green(health_timeout)
+            self.record_deploy('container', self.container_name, previous, previous['Image'] if previous else None)
+            print('deploy finished')
+            return
+
+        await self.delete_container()
+        print('delete container successfully')
+
+        await self.create_container()
+        print('create container successfully')
+
+        await self.start_container()
+        print('start container successfully')
+        self.record_deploy('container', self.container_name, previous, previous['Image'] if previous else None)
+        print('deploy finished')
+
+    @timed('deploy')
+    async def deploy_stack(self, pull_concurrency = None, prepull = True, wait = False, wait_timeout = None, diff = True):
+        await self.warmup()
+        print('warmup successfully')
+
+        stack_id = await self.stack_id()
+        changes = await self.stack_changes(stack_id) if stack_id and diff else None
+        if changes is not None:
+            if not changes:
+                print('Stack {} unchanged, no-op'.format(self.stack_name))
+                return deploy.NO_OP
+            agents = await self.agent_nodes() if prepull else None
+            await self.pull_images(self.pull_plan(self.changed_images(changes), agents), pull_concurrency)
+            print('pull changed images successfully')
+            await asyncio.gather(*[self.update_stack_service(service, image, digest) for service, image, digest in changes])
+            if wait:
+                await self.wait_converged([service['ID'] for service, _, _ in changes], wait_timeout)
+            return
+
+        await self.pull_stack_images(pull_concurrency, prepull)
+        print('pull stack images successfully')
+
+        if not stack_id:
+            await self.create_stack()
+            print('create stack successfully')
+        else:
+            await self.update_stack(stack_id)
+            print('update stack successfully')
+
+        if wait:
+            await self.wait_converged(await self.stack_service_ids(), wait_timeout)
@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" portainer-api replica autoscaler """
+
+import batch
+import collections
+import deploy
+import json
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_INTERVAL = 15
+DEFAULT_POLICY = {
+    'min': 1,
+    'max': 10,
+    # average usage per task: cpu in percent of one core like docker stats, memory in percent of the limit
+    'cpu': 70,
+    'memory': None,
+    'window': 120,
+    'min_samples': 3,
+    'tolerance': 0.1,
+    'scale_up_cooldown': 60,
+    'scale_down_cooldown': 300
+}
+
+def load_policies(policy_file):
+    '''
+    policy file is a yaml (or json) file, defaults apply to every service:
+
+    defaults:
+      endpoint: prod
+      min: 2
+      max: 8
+      cpu: 70
+      memory: 80
+      window: 120
+      scale_up_cooldown: 60
+      scale_down_cooldown: 300
+    services:
+      - name: peck
+        stack_name: pipeline
+      - name: api
+        max: 20
+    '''
+    config = deploy.load_yaml(open(policy_file, 'r').read())
+    if isinstance(config, list):
+        config = {'services': config}
+
+    defaults = dict(DEFAULT_POLICY, **(config.get('defaults') or {}))
+    policies = []
+    keys = set()
+    for item in config.get('services') or []:
+        policy = dict(defaults, **item)
+        if not policy.get('endpoint'):
+            raise Exception('endpoint of service {} can\'t be null'.format(policy.get('name')))
+        if not policy.get('name'):
+            raise Exception('name of service can\'t be null')
+        if not policy.get('cpu') and not policy.get('memory'):
+            raise Exception('service {} needs a cpu or memory target'.format(policy['name']))
+        if not 1 <= int(policy['min']) <= int(policy['max']):
+            raise Exception('service {} needs 1 <= min <= max'.format(policy['name']))
+        policy['service'] = '{}_{}'.format(policy['stack_name'], policy['name']) if policy.get('stack_name') else policy['name']
+        policy['key'] = policy_key(policy['endpoint'], policy['service'])
+        if policy['key'] in keys:
+            raise Exception('service {} on {} has more than one policy'.format(policy['service'], policy['endpoint']))
+        keys.add(policy['key'])
+        policies.append(policy)
+    return policies
+
+def policy_key(endpoint, service):
+    '''
+    services of the same name on different endpoints are scaled apart
+    '''
+    return (endpoint.lower(), service)
+
+def cpu_percent(stats):
+    '''
+    cpu usage of a container stats sample in percent of one core, computed like docker stats
+    '''
+    cpu = stats.get('cpu_stats') or {}
+    precpu = stats.get('precpu_stats') or {}
+    cpu_delta = cpu.get('cpu_usage', {}).get('total_usage', 0) - precpu.get('cpu_usage', {}).get('total_usage', 0)
+    system_delta = cpu.get('system_cpu_usage', 0) - precpu.get('system_cpu_usage', 0)
+    cpus = cpu.get('online_cpus') or len(cpu.get('cpu_usage', {}).get('percpu_usage') or []) or 1
+    if cpu_delta <= 0 or system_delta <= 0:
+        return 0.0
+    return cpu_delta / system_delta * cpus * 100
+
+def memory_percent(stats):
+    '''
+    memory usage without page cache in percent of the limit, None without a limit
+    '''
+    memory = stats.get('memory_stats') or {}
+    limit = memory.get('limit')
+    if not limit or 'usage' not in memory:
+        return None
+    details = memory.get('stats') or {}
+    # inactive_file on cgroup v2, cache on cgroup v1
+    cache = details.get('inactive_file', details.get('total_inactive_file', details.get('cache', 0)))
+    return max(memory['usage'] - cache, 0) / limit * 100
+
+class StatsSampler:
+    '''
+    cpu and memory usage of the running tasks of services, read through the portainer docker proxy.
+    on agent endpoints every container is read on its own node through the agent target header,
+    otherwise only the containers of the endpoint's node can be read
+    '''
+    def __init__(self, instance):
+        self.instance = instance
+        self.agent = instance.agent_nodes() is not None
+        self.hostnames = {}
+
+    def get(self, path, params = None, headers = None):
+        headers = dict(headers or {}, authorization = self.instance.portainer_token)
+        response = self.instance.request('GET', self.instance.docker_api_prefix + path, headers = headers, params = params)
+        response.raise_for_status()
+        return response.json()
+
+    def node_hostname(self, node_id):
+        if node_id not in self.hostnames:
+            self.hostnames = dict((node['ID'], node['Description']['Hostname']) for node in self.get('/nodes'))
+        return self.hostnames.get(node_id)
+
+    def container_stats(self, container_id, node_id):
+        headers = {}
+        if self.agent:
+            headers['x-portaineragent-target'] = self.node_hostname(node_id)
+        try:
+            return self.get('/containers/{}/stats'.format(container_id), {'stream': 'false'}, headers)
+        except Exception as ex:
+            print('Can not read stats of container {}: {}'.format(container_id[:12], ex))
+            return None
+
+    def sample(self, names):
+        '''
+        {service name: sample} of the replicated services among names, a sample holds the service id,
+        replicas and the average cpu and memory usage of its running tasks
+        '''
+        services = [service for service in self.get('/services', self.instance.name_filter(*names))
+                    if service['Spec']['Name'] in names and 'Replicated' in service['Spec']['Mode']]
+        if not services:
+            return {}
+        tasks = self.get('/tasks', {'filters': json.dumps({'service': [service['ID'] for service in services],
+                                                            'desired-state': ['running']})})
+        tasks = [task for task in tasks
+                 if task['Status']['State'] == 'running' and task['Status'].get('ContainerStatus', {}).get('ContainerID')]
+
+        with ThreadPoolExecutor(max_workers = max(min(len(tasks), self.instance.pool_size), 1)) as executor:
+            stats = list(executor.map(lambda task: self.container_stats(task['Status']['ContainerStatus']['ContainerID'], task['NodeID']), tasks))
+
+        samples = {}
+        for service in services:
+            usage = [item for task, item in zip(tasks, stats) if item and task['ServiceID'] == service['ID']]
+            cpu = [cpu_percent(item) for item in usage]
+            memory = [value for value in (memory_percent(item) for item in usage) if value is not None]
+            samples[service['Spec']['Name']] = {
+                'id': service['ID'],
+                'replicas': service['Spec']['Mode']['Replicated']['Replicas'],
+                'tasks': len(usage),
+                'cpu': sum(cpu) / len(cpu) if cpu else None,
+                'memory': sum(memory) / len(memory) if memory else None
+            }
+        return samples
+
+class Autoscaler:
+    '''
+    scaling decisions from a sliding window of samples per service, kept apart from portainer so
+    recorded samples can be replayed. services are keyed by policy_key:
+
+        scaler = Autoscaler(policies)
+        scaler.observe(('prod', 'api'), now, 2, cpu = 150, memory = 40)
+        decision = scaler.decide(('prod', 'api'), now, 2)
+
+    the desired replicas are replicas * usage / target of the metric furthest above its target,
+    changes within the tolerance are ignored and a service is not scaled again within its cooldowns
+    '''
+    def __init__(self, policies):
+        self.policies = dict((policy['key'], policy) for policy in policies)
+        self.windows = dict((key, collections.deque()) for key in self.policies)
+        self.last_scale = {}
+
+    def observe(self, key, timestamp, replicas, cpu = None, memory = None):
+        window = self.windows[key]
+        window.append((timestamp, replicas, cpu, memory))
+        while window and window[0][0] < timestamp - self.policies[key]['window']:
+            window.popleft()
+
+    def average(self, key, index):
+        values = [sample[index] for sample in self.windows[key] if sample[index] is not None]
+        return sum(values) / len(values) if values else None
+
+    def desired(self, key, replicas):
+        '''
+        desired replicas and the reason for them
+        '''
+        policy = self.policies[key]
+        ratios = []
+        for metric, index in (('cpu', 2), ('memory', 3)):
+            average = self.average(key, index)
+            if policy.get(metric) and average is not None:
+                ratios.append((average / float(policy[metric]), '{} {:.0f}% (target {}%)'.format(metric, average, policy[metric])))
+        if not ratios:
+            return replicas, 'no usage reported'
+        ratio, reason = max(ratios)
+        if abs(ratio - 1) <= policy['tolerance']:
+            return replicas, reason + ' within tolerance'
+        return int(math.ceil(replicas * ratio - 1e-9)), reason
+
+    def decide(self, key, timestamp, replicas):
+        '''
+        a decision is a dict of endpoint, service, time, replicas, desired, action (up, down or hold) and reason
+        '''
+        policy = self.policies[key]
+        low, high = int(policy['min']), int(policy['max'])
+        decision = {'endpoint': policy['endpoint'], 'service': policy['service'], 'time': timestamp, 'replicas': replicas}
+        window = self.windows[key]
+
+        if not low <= replicas <= high:
+            desired, reason = min(max(replicas, low), high), 'replicas outside {}..{}'.format(low, high)
+        elif len(window) < int(policy['min_samples']):
+            desired, reason = replicas, 'warming up, {} of {} samples'.format(len(window), policy['min_samples'])
+        else:
+            wanted, reason = self.desired(key, replicas)
+            desired = min(max(wanted, low), high)
+            if desired != wanted:
+                reason = '{}, limited to {}'.format(reason, 'max {}'.format(high) if wanted > high else 'min {}'.format(low))
+            if desired != replicas and key in self.last_scale:
+                cooldown = policy['scale_up_cooldown'] if desired > replicas else policy['scale_down_cooldown']
+                remaining = self.last_scale[key] + cooldown - timestamp
+                if remaining > 0:
+                    desired, reason = replicas, '{}, cooldown {:.0f}s left'.format(reason, remaining)
+
+        decision['desired'] = desired
+        decision['action'] = 'up' if desired > replicas else 'down' if desired < replicas else 'hold'
+        decision['reason'] = reason
+        return decision
+
+    def scaled(self, key, timestamp):
+        '''
+        samples before a scale describe the old replica count
+        '''
+        self.last_scale[key] = timestamp
+        self.windows[key].clear()
+
+def log_decision(decision, record = None):
+    if decision['action'] == 'hold':
+        print('Service {} on {}: {} replicas, {}'.format(decision['service'], decision['endpoint'], decision['replicas'], decision['reason']))
+    else:
+        print('Scale service {} on {} {} -> {}: {}'.format(decision['service'], decision['endpoint'], decision['replicas'],
+                                                         decision['desired'], decision['reason']))
+    if record:
+        record.write(json.dumps(dict(decision, type = 'decision')) + '\n')
+        record.flush()
+
+def run(policies, interval = None, record_file = None, dry_run = False):
+    '''
+    sample every interval seconds and scale the services, samples and decisions are appended to record_file
+    '''
+    interval = interval or DEFAULT_INTERVAL
+    scaler = Autoscaler(policies)
+    runner = batch.BatchDeploy([])
+    instances = dict((policy['key'], runner.create_deploy({
+        'endpoint': policy['endpoint'],
+        'name': policy['name'],
+        'stack_name': policy.get('stack_name'),
+        'swarm_mode': True
+    })) for policy in policies)
+    endpoints = collections.OrderedDict()
+    for policy in policies:
+        endpoints.setdefault(policy['endpoint'].lower(), []).append(policy['service'])
+    samplers = dict((endpoint, StatsSampler(instances[policy_key(endpoint, names[0])])) for endpoint, names in endpoints.items())
+    record = open(record_file, 'a') if record_file else None
+    print('Autoscaling {} services every {}s{}'.format(len(policies), interval, ', dry run' if dry_run else ''))
+
+    try:
+        while True:
+            start = time.time()
+            # every round gets the retry budget of one deploy
+            for instance in instances.values():
+                instance.retry.renew()
+            for endpoint, names in endpoints.items():
+                try:
+                    samples = samplers[endpoint].sample(names)
+                except Exception as ex:
+                    print('Can not sample services of {}: {}'.format(endpoint, ex))
+                    continue
+                for name in names:
+                    if name not in samples:
+                        print('Service {} on {} not found or not replicated'.format(name, endpoint))
+                        continue
+                    key = policy_key(endpoint, name)
+                    sample = samples[name]
+                    now = time.time()
+                    if record:
+                        record.write(json.dumps(dict(sample, type = 'sample', endpoint = endpoint, service = name, time = now)) + '\n')
+                    scaler.observe(key, now, sample['replicas'], sample['cpu'], sample['memory'])
+                    decision = scaler.decide(key, now, sample['replicas'])
+                    log_decision(decision, record)
+                    if decision['action'] == 'hold' or dry_run:
+                        continue
+                    try:
+                        instance = instances[key]
+                        instance.scale_service(instance.get_service(), decision['desired'])
+                        scaler.scaled(key, now)
+                    except Exception as ex:
+                        print('Can not scale service {} on {}: {}'.format(name, endpoint, ex))
+            runner.metrics.flush()
+            time.sleep(max(interval - (time.time() - start), 0))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if record:
+            record.close()
+        runner.close()
+
+def replay(policies, record_file):
+    '''
+    decisions the policies make on recorded samples, the services are assumed to follow every decision
+    and their load to spread evenly over the replicas. samples recorded without endpoint go to the
+    policy of their service when only one endpoint has it
+    '''
+    scaler = Autoscaler(policies)
+    by_service = {}
+    for policy in policies:
+        by_service.setdefault(policy['service'], []).append(policy['key'])
+    replicas = {}
+    decisions = []
+    for line in open(record_file, 'r'):
+        sample = json.loads(line)
+        if sample.get('type') != 'sample':
+            continue
+        if sample.get('endpoint'):
+            key = policy_key(sample['endpoint'], sample['service'])
+        else:
+            keys = by_service.get(sample['service']) or []
+            key = keys[0] if len(keys) == 1 else None
+        if key not in scaler.policies:
+            continue
+        current = replicas.setdefault(key, sample['replicas'])
+        share = float(sample['replicas']) / current
+        scaler.observe(key, sample['time'], current,
+                       sample['cpu'] * share if sample['cpu'] is not None else None,
+                       sample['memory'] * share if sample['memory'] is not None else None)
+        decision = scaler.decide(key, sample['time'], current)
+        log_decision(decision)
+        decisions.append(decision)
+        if decision['action'] != 'hold':
+            replicas[key] = decision['desired']
+            scaler.scaled(key, sample['time'])
+    return decisions
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" portainer-api batch deploy """
+
+import deploy
+import threading
+import time
+import traceback
+import units
+from cache import Cache
+from concurrent.futures import ThreadPoolExecutor
+from history import History
+from lock import DeployLock
+from metrics import Metrics
+
+DEFAULT_WORKERS = 4
+DEFAULT_ENDPOINT_CONCURRENCY = 2
+
+def load_manifest(manifest_file):
+    '''
+    manifest is a yaml (or json) file:
+
+    defaults:
+      endpoint: prod
+      swarm_mode: true
+    targets:
+      - name: peck
+        image: registry.what.codes/peck/pipeline:dev
+        networks: [app]
+        update: {parallelism: 5, delay: 10s, order: start-first, failure_action: rollback, monitor: 30s}
+        memory: 512m
+        cpus: 1.5
+        constraints: [node.labels.tier==web]
+        spread: [node.labels.zone]
+      - name: fengchao
+        stack_name: fengchao
+        compose_file: docker-compose.deploy.yml
+    '''
+    manifest = deploy.load_yaml(open(manifest_file, 'r').read())
+    if isinstance(manifest, list):
+        manifest = {'targets': manifest}
+
+    defaults = manifest.get('defaults') or {}
+    targets = []
+    for item in manifest.get('targets') or []:
+        target = dict(defaults)
+        target.update(item)
+        validate_target(target)
+        targets.append(target)
+    return targets
+
+def validate_target(target):
+    '''
+    fail on a target that can't be deployed before any deploy starts
+    '''
+    for field in ('endpoint', 'name', 'image', 'stack_name', 'compose_file'):
+        if target.get(field) is not None and not isinstance(target[field], str):
+            raise ValueError('{} of target {} has to be a string'.format(field, target.get('name')))
+    if not target.get('endpoint'):
+        raise ValueError('endpoint of target {} can\'t be null'.format(target.get('name')))
+    if not target.get('name'):
+        raise ValueError('name of target can\'t be null')
+    if target_kind(target) == 'stack':
+        if not target.get('stack_name'):
+            raise ValueError('stack_name of target {} can\'t be null'.format(target['name']))
+    elif not target.get('image'):
+        raise ValueError('image of target {} can\'t be null'.format(target['name']))
+    for field in ('ports', 'volumes', 'envs', 'constraints', 'spread'):
+        values = target.get(field)
+        if values is not None and (not isinstance(values, list) or not all(isinstance(value, str) for value in values)):
+            raise ValueError('{} of target {} has to be a list of strings'.format(field, target['name']))
+    networks = target.get('networks')
+    if networks is not None and not isinstance(networks, list):
+        raise ValueError('networks of target {} has to be a list'.format(target['name']))
+    for network in networks or []:
+        if not isinstance(network, (str, dict)):
+            raise ValueError('network {} of target {} has to be a name or {{name, aliases, ip, ip6}}'.format(network, target['name']))
+        try:
+            spec = deploy.parse_network(network)
+        except Exception as ex:
+            raise ValueError('invalid network of target {}: {}'.format(target['name'], ex))
+        if isinstance(network, dict) and (not isinstance(spec['name'], str) or not isinstance(network.get('aliases') or [], list)
+                                          or not all(isinstance(alias, str) for alias in spec['aliases'])):
+            raise ValueError('network {} of target {} has to be {{name, aliases, ip, ip6}} with strings'.format(network, target['name']))
+
+def target_key(target):
+    '''
+    deploys with the same key change the same container, service or stack
+    '''
+    kind = target_kind(target)
+    name = target.get('stack_name') if kind == 'stack' else target['name']
+    if kind == 'service' and target.get('stack_name'):
+        name = '{}_{}'.format(target['stack_name'], target['name'])
+    return '{}|{}|{}'.format(target['endpoint'].lower(), kind, name)
+
+def target_kind(target):
+    if target.get('compose_file'):
+        return 'stack'
+    if str(target.get('swarm_mode', False)).lower() == str(True).lower():
+        return 'service'
+    return 'container'
+
+class BatchDeploy:
+    def __init__(self, targets, workers = DEFAULT_WORKERS, endpoint_concurrency = DEFAULT_ENDPOINT_CONCURRENCY):
+        self.targets = targets
+        self.workers = workers
+        self.endpoint_concurrency = endpoint_concurrency
+        self.endpoint_locks = {}
+        self.warmup_locks = {}
+        self.endpoint_ids = {}
+        self.session = None
+        self.portainer_token = None
+        self.cache = Cache()
+        self.history = History()
+        self.metrics = Metrics()
+        self.lock = threading.Lock()
+        self.results = []
+
+    def endpoint_lock(self, endpoint):
+        with self.lock:
+            if endpoint not in self.endpoint_locks:
+                self.endpoint_locks[endpoint] = threading.Semaphore(self.endpoint_concurrency)
+            return self.endpoint_locks[endpoint]
+
+    def warmup_lock(self, endpoint):
+        with self.lock:
+            if endpoint not in self.warmup_locks:
+                self.warmup_locks[endpoint] = threading.Lock()
+            return self.warmup_locks[endpoint]
+
+    def create_deploy(self, target):
+        '''
+        the first deploy of an endpoint looks its id up while the other deploys of that endpoint wait,
+        deploys of other endpoints warm up meanwhile. every deploy reuses the session and token of the
+        first one that got them, endpoints warming up at the same time may each authenticate
+        '''
+        endpoint = target['endpoint'].lower()
+        with self.lock:
+            known = endpoint in self.endpoint_ids
+        if known:
+            return self.new_deploy(target)
+        with self.warmup_lock(endpoint):
+            return self.new_deploy(target)
+
+    def new_deploy(self, target):
+        kind = target_kind(target)
+        endpoint = target['endpoint'].lower()
+        with self.lock:
+            session, portainer_token, endpoint_id = self.session, self.portainer_token, self.endpoint_ids.get(endpoint)
+        instance = deploy.Deploy(
+            target['endpoint'],
+            target['name'],
+            target.get('image') if kind != 'stack' else None,
+            list(target.get('networks') or []),
+            list(target.get('ports') or []),
+            list(target.get('volumes') or []),
+            list(target.get('envs') or []),
+            target.get('stack_name'),
+            target.get('compose_file'),
+            units.parse_size(target.get('memory')) or 0,
+            pool_size = max(self.workers, deploy.DEFAULT_POOL_SIZE),
+            session = session,
+            portainer_token = portainer_token,
+            endpoint_id = endpoint_id,
+            cache = self.cache,
+            metrics = self.metrics,
+            update_config = deploy.update_config(**(target.get('update') or {})),
+            cpu_limit = units.parse_cpus(target.get('cpus')),
+            memory_reservation = units.parse_size(target.get('memory_reservation')),
+            cpu_reservation = units.parse_cpus(target.get('cpu_reservation')),
+            constraints = target.get('constraints'),
+            spread = target.get('spread'),
+            history = self.history)
+        with self.lock:
+            if not self.portainer_token:
+                self.session = instance.session
+                self.portainer_token = instance.portainer_token
+            self.endpoint_ids[endpoint] = instance.endpoint_id
+        return instance
+
+    def run_target(self, target):
+        kind = target_kind(target)
+        result = {
+            'name': target['name'],
+            'endpoint': target['endpoint'],
+            'kind': kind,
+            'status': 'failed',
+            'duration': 0,
+            'error': None
+        }
+        start = time.time()
+        lock = DeployLock(target_key(target)) if target.get('lock', True) else None
+        try:
+            if lock and not lock.acquire():
+                result['status'] = deploy.SUPERSEDED
+                return result
+        except Exception as ex:
+            result['error'] = str(ex)
+            return result
+
+        try:
+            self.run_locked(target, kind, result)
+        finally:
+            if lock:
+                lock.release()
+            result['duration'] = time.time() - start
+        return result
+
+    def run_locked(self, target, kind, result):
+        with self.endpoint_lock(target['endpoint'].lower()):
+            try:
+                instance = self.create_deploy(target)
+                skip_unchanged = target.get('skip_unchanged', False)
+                if kind == 'stack':
+                    status = instance.deploy_stack(target.get('pull_concurrency'), target.get('prepull', True),
+                                                   target.get('wait', False), target.get('wait_timeout'), target.get('stack_diff', True))
+                elif kind == 'service':
+                    status = instance.deploy_service(target.get('mode', 'Replicated'), int(target.get('replicas', 1)), target.get('prepull', True),
+                                                     skip_unchanged, target.get('wait', False), target.get('wait_timeout'))
+                else:
+                    status = instance.deploy_container(skip_unchanged, target.get('blue_green', False), target.get('health_timeout'))
+                result['status'] = status or 'success'
+                # keep a token that was refreshed during the deploy for the next ones
+                with self.lock:
+                    self.portainer_token = instance.portainer_token
+            except Exception as ex:
+                traceback.print_exc()
+                result['error'] = str(ex)
+
+    def run(self):
+        with ThreadPoolExecutor(max_workers = self.workers) as executor:
+            self.results = list(executor.map(self.run_target, self.targets))
+        return self.results
+
+    def succeeded(self):
+        return all(result['status'] != 'failed' for result in self.results)
+
+    def summary(self):
+        lines = ['{:<30} {:<15} {:<10} {:<8} {:>10}'.format('TARGET', 'ENDPOINT', 'KIND', 'STATUS', 'DURATION')]
+        for result in self.results:
+            lines.append('{:<30} {:<15} {:<10} {:<8} {:>9.2f}s'.format(
+                result['name'], result['endpoint'], result['kind'], result['status'], result['duration']))
+            if result['error']:
+                lines.append('    {}'.format(result['error']))
+        return '\n'.join(lines)
+
+    def connection_stats(self):
+        return deploy.session_stats(self.session) if self.session else {}
+
+    def close(self):
+        if self.session:
+            self.session.close()
+        self.metrics.close()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" portainer-api local cache """
+
+import base64
+import json
+import os
+import threading
+import time
+
+DEFAULT_STATE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'portainer-api')
+DEFAULT_CACHE_TTL = 3600
+# refresh tokens a little before portainer rejects them
+JWT_EXPIRY_MARGIN = 60
+
+def state_path(name):
+    '''
+    file of the local state (cache, locks, deploy history) in PORTAINER_STATE_DIR,
+    a container that runs one deploy has to keep the directory on a volume
+    '''
+    return os.path.join(os.environ.get('PORTAINER_STATE_DIR', DEFAULT_STATE_DIR), name)
+
+def jwt_expiry(token):
+    '''
+    exp claim of a jwt, None if the token can't be decoded
+    '''
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload.encode()))['exp'])
+    except Exception:
+        return None
+
+class Cache:
+    '''
+    json file of {key: {'value': ..., 'expires': epoch}}, shared by every run on the machine.
+    PORTAINER_CACHE sets the file (off disables the cache), PORTAINER_CACHE_TTL the default ttl.
+    '''
+    def __init__(self, path = None, ttl = None):
+        path = path or os.environ.get('PORTAINER_CACHE') or state_path('cache.json')
+        self.enabled = path.lower() != 'off'
+        self.path = path
+        self.ttl = ttl or float(os.environ.get('PORTAINER_CACHE_TTL', DEFAULT_CACHE_TTL))
+        self.lock = threading.Lock()
+        self.entries = self.load()
+
+    def load(self):
+        if not self.enabled or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as cache_file:
+                return json.load(cache_file)
+        except Exception as ex:
+            print('Ignore broken cache {}: {}'.format(self.path, ex))
+            return {}
+
+    def save(self):
+        now = time.time()
+        self.entries = { key: entry for key, entry in self.entries.items() if entry['expires'] > now }
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok = True)
+            temp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+            # the cache holds portainer tokens
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as cache_file:
+                json.dump(self.entries, cache_file)
+            os.replace(temp_path, self.path)
+        except Exception as ex:
+            print('Can not write cache {}: {}'.format(self.path, ex))
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry['expires'] > time.time():
+                return entry['value']
+            return None
+
+    def set(self, key, value, expires = None):
+        if not self.enabled:
+            return
+        with self.lock:
+            # merge what other processes wrote since we loaded
+            self.entries.update(self.load())
+            self.entries[key] = {'value': value, 'expires': expires or time.time() + self.ttl}
+            self.save()
+
+    def delete(self, key):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.entries.update(self.load())
+            self.entries.pop(key, None)
+            self.save()
+
+    def set_token(self, key, token):
+        expires = jwt_expiry(token)
+        self.set(key, token, expires - JWT_EXPIRY_MARGIN if expires else None)
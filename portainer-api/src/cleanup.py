@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" portainer-api image and container cleanup """
+
+import json
+import time
+import units
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_KEEP = 3
+# stopped containers younger than this may belong to a deploy between create and start
+DEFAULT_MIN_AGE = '1h'
+
+def repositories(image):
+    '''
+    repositories of an image, from its tags and from its digests (swarm pulls by digest, without tag)
+    '''
+    names = set()
+    for reference in (image.get('RepoTags') or []) + (image.get('RepoDigests') or []):
+        if reference == '<none>:<none>' or reference == '<none>@<none>':
+            continue
+        name = reference.partition('@')[0]
+        if ':' in name.rsplit('/', 1)[-1]:
+            name = name.rsplit(':', 1)[0]
+        names.add(name)
+    return names
+
+def unique_size(image):
+    '''
+    bytes freed by removing the image alone, shared layers stay
+    '''
+    shared = image.get('SharedSize', -1)
+    return image.get('Size', 0) - (shared if shared and shared > 0 else 0)
+
+class Cleanup:
+    '''
+    removes stopped containers, old images and dangling layers on every node of an endpoint in parallel,
+    each node reached through the agent target header (the endpoint's own node without agents).
+    per repository the keep most recent images stay, and any image used by a container or named in a
+    service spec, so images pre-pulled for a service are not removed from nodes without its tasks
+    '''
+    def __init__(self, instance, keep = None, min_age = None, dry_run = False):
+        self.instance = instance
+        self.keep = keep if keep is not None else DEFAULT_KEEP
+        self.min_age = min_age or DEFAULT_MIN_AGE
+        self.dry_run = dry_run
+
+    def call(self, method, path, node, params = None):
+        headers = {
+            'authorization': self.instance.portainer_token
+        }
+        if node:
+            headers['x-portaineragent-target'] = node
+        response = self.instance.request(method, self.instance.docker_api_prefix + path, headers = headers, params = params)
+        response.raise_for_status()
+        return response.json() if response.content else None
+
+    def service_images(self):
+        '''
+        images of every service spec, nothing on endpoints without swarm
+        '''
+        try:
+            services = self.call('GET', '/services', None)
+        except Exception:
+            return set()
+        images = set()
+        for service in services:
+            image = service['Spec']['TaskTemplate']['ContainerSpec']['Image']
+            reference, _, digest = image.partition('@')
+            images.add(image)
+            images.add(reference)
+            if digest:
+                # RepoDigests are repository@digest, without the tag of the pinned spec
+                repository = reference.rsplit(':', 1)[0] if ':' in reference.rsplit('/', 1)[-1] else reference
+                images.add('{}@{}'.format(repository, digest))
+        return images
+
+    def removable_images(self, images, containers, service_images):
+        '''
+        images to remove: not used, not in a service spec and not among the keep newest of any of its repositories
+        '''
+        used = set(container['ImageID'] for container in containers)
+        kept = set()
+        by_repository = {}
+        for image in images:
+            references = set((image.get('RepoTags') or []) + (image.get('RepoDigests') or []))
+            if image['Id'] in used or references & service_images:
+                kept.add(image['Id'])
+            for name in repositories(image):
+                by_repository.setdefault(name, []).append(image)
+        for repository_images in by_repository.values():
+            for image in sorted(repository_images, key = lambda image: image['Created'], reverse = True)[:self.keep]:
+                kept.add(image['Id'])
+        # dangling images are left to the prune
+        return [image for image in images if image['Id'] not in kept and repositories(image)]
+
+    def clean_node(self, node, service_images):
+        result = {'node': node or self.instance.endpoint_name, 'containers': 0, 'images': 0, 'reclaimed': 0, 'error': None}
+        try:
+            if self.dry_run:
+                stopped = self.call('GET', '/containers/json', node, {'all': 1, 'size': 1, 'filters': json.dumps({'status': ['exited', 'dead']})})
+                # the list has no until filter, the prune's until compares the creation time
+                created_before = time.time() - units.parse_duration(self.min_age) / 1e9
+                stopped = [container for container in stopped if container.get('Created', 0) < created_before]
+                result['containers'] = len(stopped)
+                result['reclaimed'] += sum(container.get('SizeRw') or 0 for container in stopped)
+            else:
+                pruned = self.call('POST', '/containers/prune', node, {'filters': json.dumps({'until': [self.min_age]})})
+                result['containers'] = len(pruned.get('ContainersDeleted') or [])
+                result['reclaimed'] += pruned.get('SpaceReclaimed') or 0
+
+            containers = self.call('GET', '/containers/json', node, {'all': 1})
+            images = self.call('GET', '/images/json', node, {'shared-size': 1})
+            for image in self.removable_images(images, containers, service_images):
+                name = sorted((image.get('RepoTags') or []) + (image.get('RepoDigests') or []))[0]
+                if self.dry_run:
+                    print('{}: would remove {} ({})'.format(result['node'], name, units.format_size(unique_size(image))))
+                else:
+                    try:
+                        # by id: an image can be tagged in several repositories
+                        self.call('DELETE', '/images/{}'.format(image['Id']), node, {'force': 'true'})
+                    except Exception as ex:
+                        print('{}: can not remove {}: {}'.format(result['node'], name, ex))
+                        continue
+                    print('{}: removed {}'.format(result['node'], name))
+                result['images'] += 1
+                result['reclaimed'] += unique_size(image)
+
+            if not self.dry_run:
+                pruned = self.call('POST', '/images/prune', node, {'filters': json.dumps({'dangling': ['true']})})
+                result['images'] += len([item for item in pruned.get('ImagesDeleted') or [] if item.get('Deleted')])
+                result['reclaimed'] += pruned.get('SpaceReclaimed') or 0
+        except Exception as ex:
+            result['error'] = str(ex)
+        return result
+
+    def run(self):
+        agents = self.instance.agent_nodes()
+        nodes = [agent['NodeName'] for agent in agents] if agents else [None]
+        service_images = self.service_images()
+        with ThreadPoolExecutor(max_workers = max(min(len(nodes), self.instance.pool_size), 1)) as executor:
+            return list(executor.map(lambda node: self.clean_node(node, service_images), nodes))
+
+    def summary(self, results):
+        lines = ['{:<30} {:>10} {:>8} {:>12}'.format('NODE', 'CONTAINERS', 'IMAGES', 'RECLAIMED')]
+        for result in results:
+            lines.append('{:<30} {:>10} {:>8} {:>12}'.format(
+                result['node'], result['containers'], result['images'], units.format_size(result['reclaimed'])))
+            if result['error']:
+                lines.append('    {}'.format(result['error']))
+        lines.append('{:<30} {:>10} {:>8} {:>12}'.format(
+            'TOTAL' if not self.dry_run else 'TOTAL (dry run)',
+            sum(result['containers'] for result in results), sum(result['images'] for result in results),
+            units.format_size(sum(result['reclaimed'] for result in results))))
+        return '\n'.join(lines)
@@ -4,34 +4,166 @@
 """ portainer-api """
 
 import base64
+import copy
 import hashlib
-import requests
 import json
 import os
-import yaml
 import time
+from cache import Cache
+from concurrent.futures import ThreadPoolExecutor
+from history import History, ROLLBACK, ROLLED_BACK
+from metrics import Metrics, timed
+from pull_progress import PullProgress
+from retry import RetryPolicy, CircuitOpenError, RETRY_STATUS, BREAKER_STATUS, error_status
+from units import parse_duration
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 120
+DEFAULT_PULL_CONCURRENCY = 4
+DEFAULT_PULL_IDLE_TIMEOUT = 60
+NO_OP = 'no-op'
+SUPERSEDED = 'superseded'
+# service updates racing with another update of the same service
+VERSION_CONFLICT_RETRIES = 3
+DEFAULT_CONVERGE_TIMEOUT = 300
+CONVERGE_POLL_MIN = 1
+CONVERGE_POLL_MAX = 10
+# update states after which the new tasks will never come up
+UPDATE_FAILED_STATES = ('paused', 'rollback_started', 'rollback_paused', 'rollback_completed')
+DEFAULT_HEALTH_TIMEOUT = 120
+# how long a container without healthcheck has to keep running
+NO_HEALTHCHECK_GRACE = 5
+# networks without dns aliases
+BUILTIN_NETWORKS = ('default', 'bridge', 'host', 'none')
+UPDATE_ORDERS = ('stop-first', 'start-first')
+UPDATE_FAILURE_ACTIONS = ('pause', 'continue', 'rollback')
+
+def session_stats(session):
+    '''
+    connections opened vs reused by the session pools
+    '''
+    opened = 0
+    requested = 0
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            opened += pool.num_connections
+            requested += pool.num_requests
+    return {
+        'requests': requested,
+        'opened': opened,
+        'reused': max(requested - opened, 0)
+    }
+
+def parse_network(network):
+    '''
+    a network name or docker style name=app,alias=web,ip=10.0.0.5 (alias can repeat, ip6 for ipv6),
+    manifests may give {name, aliases, ip, ip6} as well
+    '''
+    if isinstance(network, dict):
+        spec = {'name': network.get('name'), 'aliases': list(network.get('aliases') or []),
+                'ip': network.get('ip'), 'ip6': network.get('ip6')}
+    elif '=' not in network:
+        spec = {'name': network, 'aliases': [], 'ip': None, 'ip6': None}
+    else:
+        spec = {'name': None, 'aliases': [], 'ip': None, 'ip6': None}
+        for option in network.split(','):
+            key, _, value = option.strip().partition('=')
+            if key == 'alias':
+                spec['aliases'].append(value)
+            elif key in ('name', 'ip', 'ip6'):
+                spec[key] = value
+            else:
+                raise Exception('invalid network option {} in {}'.format(key, network))
+    if not spec['name']:
+        raise Exception('network name missing in {}'.format(network))
+    return spec
+
+def load_yaml(content):
+    '''
+    compose files and manifests, parsed by libyaml when pyyaml was built with it.
+    only stacks and batch manifests need yaml, so it is imported on first use
+    '''
+    import yaml
+    return yaml.load(content, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+def update_config(parallelism = None, delay = None, order = None, failure_action = None, monitor = None):
+    '''
+    swarm UpdateConfig of the given rolling update settings, delay and monitor are durations like 10s
+    '''
+    config = {}
+    if parallelism is not None:
+        config['Parallelism'] = int(parallelism)
+    if delay is not None:
+        config['Delay'] = parse_duration(delay)
+    if order:
+        if order not in UPDATE_ORDERS:
+            raise Exception('update order must be one of {}'.format(', '.join(UPDATE_ORDERS)))
+        config['Order'] = order
+    if failure_action:
+        if failure_action not in UPDATE_FAILURE_ACTIONS:
+            raise Exception('update failure action must be one of {}'.format(', '.join(UPDATE_FAILURE_ACTIONS)))
+        config['FailureAction'] = failure_action
+    if monitor is not None:
+        config['Monitor'] = parse_duration(monitor)
+    return config
 
 class Deploy:
-    def __init__(self, endpoint_name, container_name, image, networks, ports, volumes, envs, stack_name, compose_file, memory_limit):
+    def __init__(self, endpoint_name, container_name, image, networks, ports, volumes, envs, stack_name, compose_file, memory_limit,
+                 pool_size = None, timeout = None, retries = None, backoff = None,
+                 session = None, portainer_token = None, endpoint_id = None, cache = None, metrics = None,
+                 update_config = None, cpu_limit = None, memory_reservation = None, cpu_reservation = None,
+                 constraints = None, spread = None, history = None):
+        self.configure(endpoint_name, container_name, image, networks, ports, volumes, envs, stack_name, compose_file, memory_limit,
+                       pool_size, timeout, retries, backoff, cache, metrics, update_config, cpu_limit, memory_reservation,
+                       cpu_reservation, constraints, spread, history)
+        # session, token and endpoint id can be shared between several deploys
+        self.session = session if session else self.create_session()
+        self.portainer_token = portainer_token if portainer_token else self.auth_portainer()
+        self.use_endpoint(endpoint_id if endpoint_id else self.parse_endpoint_id(endpoint_name))
+
+    def configure(self, endpoint_name, container_name, image, networks, ports, volumes, envs, stack_name, compose_file, memory_limit,
+                  pool_size, timeout, retries, backoff, cache, metrics, update_config, cpu_limit, memory_reservation,
+                  cpu_reservation, constraints, spread, history):
+        '''
+        everything but the portainer session, shared with AsyncDeploy
+        '''
         self.read_env()
+        self.metrics = metrics if metrics else Metrics()
+        self.metric_labels = {'endpoint': endpoint_name, 'target': stack_name or container_name}
+        self.pool_size = pool_size or self.pool_size
+        # a single number is the connect and the read timeout, like requests takes it
+        if isinstance(timeout, (int, float)):
+            timeout = (timeout, timeout)
+        self.timeout = tuple(timeout) if timeout else self.timeout
+        self.retry = RetryPolicy(retries, backoff)
+        self.cache = cache if cache else Cache()
+        self.history = history if history else History()
+        self.endpoint_name = endpoint_name
         self.container_name = container_name
         self.image = image
-        self.networks = networks
+        self.networks = [parse_network(network) for network in networks or []]
         self.ports = ports
         self.volumes = volumes
         self.envs = envs
-        self.portainer_token = self.auth_portainer()
         self.registry_token = self.auth_registry()
-        self.endpoint_id = self.parse_endpoint_id(endpoint_name)
-        self.docker_api_prefix = '{}/api/endpoints/{}/docker'.format(
-            self.portainer_url, self.endpoint_id)
-        self.auth_portainer()
         self.stack_name = stack_name
         if compose_file:
             self.compose_file = open(compose_file, 'r').read()
         self.stack_api_prefix = '{}/api/stacks'.format(
             self.portainer_url)
         self.memory_limit = memory_limit
+        self.update_config = update_config or {}
+        # nano cpus and bytes, see units.parse_cpus and units.parse_size
+        self.cpu_limit = cpu_limit
+        self.memory_reservation = memory_reservation
+        self.cpu_reservation = cpu_reservation
+        self.constraints = list(constraints or [])
+        self.spread = list(spread or [])
+        self.stack_index = None
+        self.network_index = {}
 
     def read_env(self):
         self.portainer_url = os.environ.get('PORTAINER_URL')
@@ -41,21 +173,138 @@ def read_env(self):
         self.registry_group = os.environ.get('REGISTRY_GROUP')
         self.registry_username = os.environ.get('REGISTRY_USERNAME')
         self.registry_password = os.environ.get('REGISTRY_PASSWORD')
-        
-        
-    def auth_portainer(self):
+        self.pool_size = int(os.environ.get('PORTAINER_POOL_SIZE', DEFAULT_POOL_SIZE))
+        self.timeout = (
+            float(os.environ.get('PORTAINER_CONNECT_TIMEOUT', DEFAULT_CONNECT_TIMEOUT)),
+            float(os.environ.get('PORTAINER_TIMEOUT', DEFAULT_READ_TIMEOUT))
+        )
+        self.pull_idle_timeout = float(os.environ.get('PORTAINER_PULL_IDLE_TIMEOUT', DEFAULT_PULL_IDLE_TIMEOUT))
+
+    def create_session(self):
+        '''
+        one keep-alive session shared by every portainer call of this deploy, retries are done by request
+        '''
+        # requests is the bulk of the import time, imported once the first session is created
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        adapter = HTTPAdapter(pool_connections = 1, pool_maxsize = self.pool_size, max_retries = 0)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def request(self, method, url, idempotent = None, retry = True, attempt = 0, **kwargs):
+        '''
+        portainer call retried along self.retry (idempotent overrides the method based guess),
+        retry False leaves retrying to the caller which numbers its own attempts
+        '''
+        kwargs.setdefault('timeout', self.timeout)
+        response = self.retried_request(method, url, idempotent, retry, attempt, **kwargs)
+        headers = kwargs.get('headers') or {}
+        # a cached token may have been revoked, login again once
+        if response.status_code == 401 and self.portainer_token and headers.get('authorization') == self.portainer_token:
+            response.close()
+            self.portainer_token = self.auth_portainer(refresh = True)
+            headers['authorization'] = self.portainer_token
+            response = self.retried_request(method, url, idempotent, retry, attempt, **kwargs)
+        return response
+
+    def retried_request(self, method, url, idempotent, retry, attempt, **kwargs):
+        '''
+        response.retried tells an idempotent caller that an earlier attempt may have gone through
+        '''
+        breaker = self.retry.breaker(url)
+        breaker.check()
+        first_attempt = attempt
+        while True:
+            failure = None
+            try:
+                response = self.timed_request(method, url, attempt, **kwargs)
+                status = response.status_code
+            except Exception as ex:
+                response, status, failure = None, None, ex
+            if failure is None and status not in RETRY_STATUS:
+                breaker.record(False)
+                response.retried = attempt > first_attempt
+                return response
+            delay = None
+            if retry and self.retry.retryable(method, status, failure is None or self.request_sent(failure), idempotent):
+                delay = self.retry.delay(attempt, response.headers.get('Retry-After') if response is not None else None)
+            if delay is None:
+                breaker.record(failure is not None or status in BREAKER_STATUS)
+                if failure is not None:
+                    raise failure
+                response.retried = attempt > first_attempt
+                return response
+            if response is not None:
+                response.close()
+            print('Retry {} {} in {:.2f}s after {}'.format(method, self.metric_path(url), delay, status or failure))
+            time.sleep(delay)
+            attempt += 1
+
+    def request_sent(self, ex):
+        '''
+        False when the connection could not be opened, the request never reached portainer
+        '''
+        import requests
+        from urllib3.exceptions import NewConnectionError
+        if isinstance(ex, requests.exceptions.ConnectTimeout):
+            return False
+        reason = getattr(ex.args[0], 'reason', None) if ex.args else None
+        return not isinstance(reason, NewConnectionError)
+
+    def timed_request(self, method, url, attempt = 0, **kwargs):
+        '''
+        session request recorded in self.metrics, streamed bodies are counted by content-length only
+        '''
+        start = time.time()
+        retries = 1 if attempt else 0
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except Exception:
+            self.metrics.record_http(method, self.metric_path(url), 'error', None, time.time() - start, retries, self.metric_labels)
+            raise
+        if kwargs.get('stream'):
+            size = int(response.headers['Content-Length']) if 'Content-Length' in response.headers else None
+        else:
+            size = len(response.content)
+        self.metrics.record_http(method, self.metric_path(url), response.status_code, size, time.time() - start, retries, self.metric_labels)
+        return response
+
+    def metric_path(self, url):
+        return url[len(self.portainer_url):] if self.portainer_url and url.startswith(self.portainer_url) else url
+
+    def connection_stats(self):
+        return session_stats(self.session)
+
+    def close(self):
+        self.session.close()
+
+    @timed('auth')
+    def auth_portainer(self, refresh = False):
+        cache_key = 'token|{}|{}'.format(self.portainer_url, self.portainer_username)
+        if not refresh:
+            token = self.cache.get(cache_key)
+            if token:
+                return token
+
         url = self.portainer_url + '/api/auth'
         payload = json.dumps({'Username': self.portainer_username, 'Password': self.portainer_password})
         headers = {'cache-control': 'no-cache'}
 
-        response = requests.request(
+        # a login has no side effect, retried like a GET
+        response = self.request(
             'POST',
             url,
             data = payload,
-            headers = headers
+            headers = headers,
+            idempotent = True
         )
         response.raise_for_status()
-        return json.loads(response.text)['jwt']
+        token = json.loads(response.text)['jwt']
+        self.cache.set_token(cache_key, token)
+        return token
 
     def auth_registry(self):
         login_info = {
@@ -64,40 +313,82 @@ def auth_registry(self):
             'serveraddress': self.registry_host
         }
         login_info = json.dumps(login_info)
-        return base64.b64encode(login_info.encode())
+        return base64.b64encode(login_info.encode()).decode()
+
+    @timed('endpoint')
+    def parse_endpoint_id(self, endpoint_name, refresh = False):
+        cache_key = 'endpoint|{}|{}'.format(self.portainer_url, endpoint_name.lower())
+        endpoint_id = self.cache.get(cache_key) if not refresh else None
+        if endpoint_id:
+            return endpoint_id
 
-    def parse_endpoint_id(self, endpoint_name):
         url = self.portainer_url + '/api/endpoints'
         headers = {
             'authorization': self.portainer_token,
             'cache-control': 'no-cache',
         }
-        response = requests.request('GET', url, headers = headers)
+        response = self.request('GET', url, headers = headers)
         response.raise_for_status()
-        endpoints = response.json()
+        return self.select_endpoint(response.json(), endpoint_name)
+
+    def select_endpoint(self, endpoints, endpoint_name):
         for endpoint in endpoints:
             if endpoint['Name'].lower() == endpoint_name.lower():
+                self.cache.set('endpoint|{}|{}'.format(self.portainer_url, endpoint_name.lower()), endpoint['Id'])
                 return endpoint['Id']
-        
+
         raise Exception('can not find {} endpoint'.format(endpoint_name))
 
+    def use_endpoint(self, endpoint_id):
+        self.endpoint_id = endpoint_id
+        self.docker_api_prefix = '{}/api/endpoints/{}/docker'.format(
+            self.portainer_url, self.endpoint_id)
+
+    def forget_endpoint(self):
+        '''
+        drop the cached ids of the endpoint, it may have been recreated in portainer under a new id
+        '''
+        self.cache.delete('endpoint|{}|{}'.format(self.portainer_url, self.endpoint_name.lower()))
+        self.cache.delete('swarm|{}|{}'.format(self.portainer_url, self.endpoint_id))
+
+    def endpoint_moved(self, endpoint_id):
+        '''
+        whether a fresh lookup found the endpoint under another id, then it is used from now on
+        '''
+        if not endpoint_id or endpoint_id == self.endpoint_id:
+            return False
+        print('Endpoint {} has a new id {} (was {}), retry with it'.format(self.endpoint_name, endpoint_id, self.endpoint_id))
+        self.use_endpoint(endpoint_id)
+        return True
+
+    @timed('warmup')
     def warmup(self):
-        retry = 0
-        while retry < 3:
+        '''
+        fail before changing anything when the endpoint does not answer within its retries.
+        a failure with a cached or shared endpoint id looks the id up again and warms up once more
+        '''
+        try:
+            self.check_endpoint()
+        except Exception as ex:
+            self.forget_endpoint()
             try:
-                url = '{0}/containers/json'.format(self.docker_api_prefix)
-                headers = {
-                    'authorization': self.portainer_token,
-                    'content-type': 'application/json',
-                    'cache-control': 'no-cache',
-                }
-                response = requests.request(
-                    'GET', url, headers=headers, timeout=5)
-                response.raise_for_status()
-                break
+                endpoint_id = self.parse_endpoint_id(self.endpoint_name, refresh = True)
             except Exception:
-                pass
-            retry += 1
+                raise ex
+            if not self.endpoint_moved(endpoint_id):
+                raise ex
+            self.check_endpoint()
+
+    def check_endpoint(self):
+        url = '{0}/containers/json'.format(self.docker_api_prefix)
+        headers = {
+            'authorization': self.portainer_token,
+            'content-type': 'application/json',
+            'cache-control': 'no-cache',
+        }
+        response = self.request(
+            'GET', url, headers=headers, timeout=(self.timeout[0], 5))
+        response.raise_for_status()
 
     def agents(self):
         agentURL = '{}/v2/agents'.format(self.docker_api_prefix)
@@ -106,29 +397,118 @@ def agents(self):
             'cache-control': 'no-cache',
         }
 
-        response = requests.request('GET', agentURL, headers=headers)
+        response = self.request('GET', agentURL, headers=headers)
         response.raise_for_status()
         return response.json()
 
-    def pull_image(self, image_name = None, agent_node = None):
+    def agent_nodes(self):
         '''
-        pull image from docker registry
+        agents of the endpoint, None when the endpoint is not an agent endpoint
         '''
-        url = '{}/images/create'.format(self.docker_api_prefix)
+        try:
+            return self.agents()
+        except Exception as ex:
+            print('Can not list agents ({}), pull on the endpoint only.'.format(ex))
+            return None
+
+    def node_matches(self, agent, constraints):
+        '''
+        evaluate node.role and node.hostname placement constraints against an agent,
+        constraints on labels or ids can't be resolved from the agent list and always match
+        '''
+        roles = {1: 'manager', 2: 'worker'}
+        node = {
+            'node.role': roles.get(agent.get('NodeRole'), ''),
+            'node.hostname': agent.get('NodeName', '')
+        }
+        for constraint in constraints or []:
+            operator = '!=' if '!=' in constraint else '=='
+            key, value = [item.strip() for item in constraint.split(operator, 1)]
+            if key not in node:
+                continue
+            if (node[key] == value) != (operator == '=='):
+                return False
+        return True
+
+    def pull_plan(self, images, agents):
+        '''
+        (image, node) pairs to pull, images maps an image to the placement constraints of its services
+        '''
+        if agents is None:
+            return [(image, None) for image in images]
+
+        plan = []
+        for image, constraint_sets in images.items():
+            nodes = set()
+            for constraints in constraint_sets:
+                nodes |= set(agent['NodeName'] for agent in agents if self.node_matches(agent, constraints))
+            if nodes:
+                plan += [(image, node) for node in sorted(nodes)]
+            else:
+                plan.append((image, None))
+        return plan
+
+    @timed('pull')
+    def pull_images(self, plan, concurrency = None):
+        concurrency = concurrency or DEFAULT_PULL_CONCURRENCY
+        timings = {}
+
+        def pull(item):
+            image, node = item
+            start = time.time()
+            self.pull_image(image, node)
+            timings['{} ({})'.format(image, node) if node else image] = time.time() - start
 
+        with ThreadPoolExecutor(max_workers = concurrency) as executor:
+            list(executor.map(pull, plan))
+
+        self.print_pull_timings(timings)
+
+    def pull_image_on_nodes(self, image_name = None, constraints = None, concurrency = None):
+        '''
+        pull image on every swarm node the service can be scheduled on,
+        so new tasks don't pull during the rolling update
+        '''
+        image_name, _ = self.image_query(image_name)
+        plan = self.pull_plan({image_name: [constraints]}, self.agent_nodes())
+        self.pull_images(plan, concurrency or min(len(plan), self.pool_size))
+
+    def image_query(self, image_name = None):
+        '''
+        image name with tag and the /images/create query string
+        '''
         if not image_name:
             image_name = self.image
 
-        if ':' not in image_name: # If image does not contains a tag
+        # repo:tag@sha256:... pulls the digest, a registry port is no tag
+        image_name, _, digest = image_name.partition('@')
+        tagged = ':' in image_name.rsplit('/', 1)[-1]
+        if digest:
+            name = image_name.rsplit(':', 1)[0] if tagged else image_name
+            return image_name + '@' + digest, { 'fromImage': name, 'tag': digest }
+
+        if not tagged: # If image does not contains a tag
             image_name += ':latest'
-        
-        name, tag = image_name.split(':')
-        queryString = { 'fromImage': '{}'.format(name), 'tag': tag }
-        
+
+        name, tag = image_name.rsplit(':', 1)
+        return image_name, { 'fromImage': '{}'.format(name), 'tag': tag }
+
+    def registry_auth(self, image_name = None):
+        image_name = image_name or self.image
+        return self.registry_token if image_name.startswith(self.registry_host) else None
+
+    @timed('pull_image')
+    def pull_image(self, image_name = None, agent_node = None):
+        '''
+        pull image from docker registry
+        '''
+        url = '{}/images/create'.format(self.docker_api_prefix)
+
+        image_name, queryString = self.image_query(image_name)
         print(queryString)
         headers = {
             'authorization': self.portainer_token,
-            'X-Registry-Auth': self.registry_token if image_name.startswith(self.registry_host) else None,
+            'X-Registry-Auth': self.registry_auth(image_name),
             'cache-control': 'no-cache',
         }
 
@@ -136,27 +516,156 @@ def pull_image(self, image_name = None, agent_node = None):
             headers["x-portaineragent-target"] = agent_node
             print("Pull image on {} node.".format(agent_node))
 
-        result = False
-        retry = 0
-        while retry < 3:
+        label = '{} ({})'.format(image_name, agent_node) if agent_node else image_name
+        attempt = 0
+        while True:
             try:
-                response = requests.request(
-                    'POST', url, headers=headers, params=queryString, timeout=30 * (1 + retry))
-                print(response.text)
-                if response.status_code < 300:
-                    result = True
-                    break
-            except Exception:
-                pass
-            retry += 1
-        if result == False:
-            raise Exception("Pull image failed")
-        else:
-            # inspect image
-            url = '{}/images/{}/json'.format(self.docker_api_prefix, image_name)
-            response = requests.request('GET', url, headers=headers)
+                self.stream_pull(url, headers, queryString, label, attempt)
+                break
+            except CircuitOpenError:
+                raise
+            except Exception as ex:
+                delay = self.pull_retry_delay(ex, attempt)
+                if delay is None:
+                    raise Exception('Pull image {} failed: {}'.format(label, ex))
+                print('Pull {} attempt {} failed: {}, retry in {:.2f}s'.format(label, attempt + 1, ex, delay))
+                time.sleep(delay)
+                attempt += 1
+
+        # inspect image
+        url = '{}/images/{}/json'.format(self.docker_api_prefix, image_name)
+        response = self.request('GET', url, headers=headers)
+        response.raise_for_status()
+        print("Pull image Id: {} successfully.\n".format(response.json()["Id"]) )
+
+    def pull_retry_delay(self, ex, attempt):
+        '''
+        a pull is idempotent, it is retried as a whole on stalls, broken streams and 5xx
+        (registry errors come back as 500), not on 4xx like an unknown image or a denied login
+        '''
+        status = error_status(ex)
+        if status is not None and status < 500 and status not in RETRY_STATUS:
+            return None
+        return self.retry.delay(attempt)
+
+    def stream_pull(self, url, headers, queryString, label, attempt = 0):
+        '''
+        parse the pull progress while it streams in, the pull only times out
+        when no byte arrives or no layer advances for pull_idle_timeout seconds
+        '''
+        progress = PullProgress(label)
+        response = self.request('POST', url, headers=headers, params=queryString, stream=True,
+                                timeout=(self.timeout[0], self.pull_idle_timeout), retry = False, attempt = attempt)
+        try:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if line:
+                    progress.feed(json.loads(line))
+                if progress.stalled(self.pull_idle_timeout):
+                    raise Exception('no progress for {}s'.format(self.pull_idle_timeout))
+                progress.report()
+        finally:
+            response.close()
+        progress.report(force = True)
+        return progress
+
+    @timed('digest')
+    def registry_digest(self, image_name = None):
+        '''
+        digest the tag currently resolves to in the registry, None when it can't be resolved
+        '''
+        image_name, _ = self.image_query(image_name)
+        url = '{}/distribution/{}/json'.format(self.docker_api_prefix, image_name)
+        headers = {
+            'authorization': self.portainer_token,
+            'X-Registry-Auth': self.registry_auth(image_name),
+        }
+        try:
+            response = self.request('GET', url, headers=headers)
             response.raise_for_status()
-            print("Pull image Id: {} successfully.\n".format(response.json()["Id"]) )
+            return response.json()['Descriptor']['digest']
+        except Exception as ex:
+            print('Can not resolve registry digest of {}: {}'.format(image_name, ex))
+            return None
+
+    def image_has_digest(self, image, digest):
+        return any(repo_digest.endswith('@' + digest) for repo_digest in image.get('RepoDigests') or [])
+
+    def container_current(self, container):
+        '''
+        the container runs the deployed tag, whether the tag moved is checked on its image
+        '''
+        if not container['State'].get('Running'):
+            return False
+        return self.image_query(container['Config']['Image'])[0] == self.image_query()[0]
+
+    def container_config_current(self, container):
+        '''
+        the container has the memory and cpu limits, env, ports and networks of this deploy.
+        env set by the image is in the container too, only the deployed variables have to be there.
+        volumes and the restart policy are not compared
+        '''
+        host_config = container.get('HostConfig') or {}
+        payload = self.container_payload(self.networks)['HostConfig']
+        for key in ('Memory', 'NanoCpus', 'MemoryReservation'):
+            if (host_config.get(key) or 0) != (payload.get(key) or 0):
+                return False
+        env = container['Config'].get('Env') or []
+        if any(item not in env for item in self.envs or []):
+            return False
+        host_ports = lambda bindings: dict((port, sorted(binding.get('HostPort') or '' for binding in values or []))
+                                           for port, values in (bindings or {}).items())
+        if host_ports(host_config.get('PortBindings')) != host_ports(payload['PortBindings']):
+            return False
+        networks = (container.get('NetworkSettings') or {}).get('Networks') or {}
+        return all(network['name'] in networks for network in self.networks)
+
+    def container_unchanged(self, digest):
+        '''
+        the container is running the same tag and config and the tag still resolves to the same digest
+        '''
+        url = '{}/containers/{}/json'.format(self.docker_api_prefix, self.container_name)
+        headers = { 'authorization': self.portainer_token }
+        response = self.request('GET', url, headers=headers)
+        if response.status_code == 404:
+            return False
+        response.raise_for_status()
+        container = response.json()
+        if not self.container_current(container) or not self.container_config_current(container):
+            return False
+
+        url = '{}/images/{}/json'.format(self.docker_api_prefix, container['Image'])
+        response = self.request('GET', url, headers=headers)
+        response.raise_for_status()
+        return self.image_has_digest(response.json(), digest)
+
+    def service_image(self, digest):
+        '''
+        spec image pinned to the digest the tag resolves to like docker service create does on the
+        cli side, the daemon does not pin it (api 1.30+). without a digest the tag is used as it is
+        '''
+        if not digest or '@' in self.image:
+            return self.image
+        return '{}@{}'.format(self.image_query()[0], digest)
+
+    def service_unchanged(self, current_service, digest):
+        '''
+        the spec image is pinned by service_image: repo:tag@sha256:...
+        '''
+        task_template = current_service["Spec"]["TaskTemplate"]
+        image, _, current_digest = task_template["ContainerSpec"]["Image"].partition('@')
+        if self.image_query(image)[0] != self.image_query()[0] or current_digest != digest:
+            return False
+        resources = task_template.get("Resources") or {}
+        for kind, values in self.service_resources().items():
+            for key, value in values.items():
+                if value and (resources.get(kind) or {}).get(key) != value:
+                    return False
+        placement = task_template.get("Placement") or {}
+        for key, value in self.service_placement().items():
+            if placement.get(key) != value:
+                return False
+        return True
 
     def update_restart_policy(self):
         url = '{}/containers/{}/update'.format(
@@ -172,7 +681,7 @@ def update_restart_policy(self):
             }
         }
         payload = json.dumps(payload)
-        response = requests.request('POST', url, headers=headers, params='')
+        response = self.request('POST', url, headers=headers, params='')
         print('cancel restart=always:' + response.text)
 
     def stop_container(self):
@@ -182,27 +691,34 @@ def stop_container(self):
             'authorization': self.portainer_token,
             'cache-control': 'no-cache',
         }
-        requests.request('POST', url, headers=headers, params=None)
+        self.request('POST', url, headers=headers, params=None, idempotent=True)
 
-    def delete_container(self, force = True):
-        url = '{}/containers/{}'.format(self.docker_api_prefix, self.container_name)
+    @timed('delete_container')
+    def delete_container(self, force = True, name = None):
+        url = '{}/containers/{}'.format(self.docker_api_prefix, name or self.container_name)
         queryString = {'force': force}
         headers = {
             'authorization': self.portainer_token,
             'cache-control': 'no-cache',
         }
-        try:
-            response = requests.request('DELETE', url, headers=headers, params=queryString)
-            print(response.text)
-        except Exception as ex:
-            if response.status_code != 404:
-                print('Container not exists')
-            else:
-                raise ex
+        response = self.request('DELETE', url, headers=headers, params=queryString)
+        # create_container takes a 409 of a retried create as its own, so a failed delete has to stop the deploy
+        if response.status_code == 404:
+            print('Container not exists')
+        else:
+            response.raise_for_status()
 
-    def create_container(self):
-        url = '{0}/containers/create'.format(self.docker_api_prefix)
-        queryString = {'name': self.container_name}
+    def endpoint_config(self, network, aliases = None):
+        config = {}
+        aliases = network['aliases'] + [alias for alias in aliases or [] if alias not in network['aliases']]
+        if aliases and network['name'] not in BUILTIN_NETWORKS:
+            config['Aliases'] = aliases
+        if network['ip'] or network['ip6']:
+            config['IPAMConfig'] = dict((key, value) for key, value in
+                                        (('IPv4Address', network['ip']), ('IPv6Address', network['ip6'])) if value)
+        return config
+
+    def container_payload(self, networks, aliases = None):
         portBindings = {}
         exposedPorts = {}
         if self.ports and len(self.ports):
@@ -218,15 +734,13 @@ def create_container(self):
             for volume in self.volumes:
                 binds.append(volume)
 
-        defaultNetwork = self.networks.pop(0) if self.networks and len(self.networks) else 'default'
-
         payload = {
             'Env': self.envs,
             'Image': self.image,
             'ExposedPorts': exposedPorts,
             'HostConfig': {
                 'Binds': binds,
-                'NetworkMode': defaultNetwork,
+                'NetworkMode': networks[0]['name'] if networks else 'default',
                 'PortBindings': portBindings,
                 'RestartPolicy': {
                     'Name': 'always',
@@ -235,87 +749,285 @@ def create_container(self):
                 'Memory': self.memory_limit if self.memory_limit else 0
             }
         }
+        if self.cpu_limit:
+            payload['HostConfig']['NanoCpus'] = self.cpu_limit
+        if self.memory_reservation:
+            payload['HostConfig']['MemoryReservation'] = self.memory_reservation
+        if networks:
+            payload['NetworkingConfig'] = {
+                'EndpointsConfig': dict((network['name'], self.endpoint_config(network, aliases)) for network in networks)
+            }
+        return payload
 
-        payload = json.dumps(payload)
-        print(payload)
+    def single_network_key(self):
+        return 'single-network|{}|{}'.format(self.portainer_url, self.endpoint_id)
+
+    def networks_rejected(self, response):
+        '''
+        engines before docker 25 (api 1.44) connect a new container to one network only
+        '''
+        return response.status_code == 400 and 'cannot be connected to network endpoints' in response.text
+
+    @timed('create_container')
+    def create_container(self, name = None, aliases = None):
+        '''
+        every network is attached by the create request, engines that take one network at create
+        join the others afterwards (remembered per endpoint in the cache)
+        '''
+        url = '{0}/containers/create'.format(self.docker_api_prefix)
+        queryString = {'name': name or self.container_name}
         headers = {
             'authorization': self.portainer_token,
             'content-type': 'application/json',
             'cache-control': 'no-cache',
         }
-        response = requests.request(
-            'POST', url, data=payload, headers=headers, params=queryString)
+        single = len(self.networks) > 1 and self.cache.get(self.single_network_key())
+        payload = json.dumps(self.container_payload(self.networks[:1] if single else self.networks, aliases))
+        print(payload)
+        response = self.request(
+            'POST', url, data=payload, headers=headers, params=queryString, idempotent=True)
+        if not single and len(self.networks) > 1 and self.networks_rejected(response):
+            print('Docker engine takes one network at create, join the others afterwards')
+            self.cache.set(self.single_network_key(), True)
+            single = True
+            payload = json.dumps(self.container_payload(self.networks[:1], aliases))
+            response = self.request(
+                'POST', url, data=payload, headers=headers, params=queryString, idempotent=True)
         print(response.text)
-        
-        # connect to networks
-        while self.networks and len(self.networks):
-            self.join_network(self.networks.pop(0), response.json()['Id'])
+        if response.status_code == 409 and response.retried:
+            # the container is deleted before, an attempt that failed on the way back did create it
+            container_id = self.inspect_container(queryString['name'])['Id']
+        else:
+            response.raise_for_status()
+            container_id = response.json()['Id']
+
+        if single:
+            for network in self.networks[1:]:
+                self.join_network(network, container_id, aliases)
 
-    def join_network(self, network_name, container_id):
-        url = '{}/networks/{}/connect'.format(self.docker_api_prefix, network_name)
+    def join_network(self, network, container_id, aliases = None):
+        url = '{}/networks/{}/connect'.format(self.docker_api_prefix, network['name'])
         headers = {
             'authorization': self.portainer_token,
             'content-type': 'application/json',
             'cache-control': 'no-cache',
         }
         payload = {
-            'Container': container_id
+            'Container': container_id,
+            'EndpointConfig': self.endpoint_config(network, aliases)
         }
         payload = json.dumps(payload)
-        response = requests.request('POST', url, headers=headers, data=payload)
-        response.raise_for_status() 
-        print('join network ' + network_name + ' success.')
+        response = self.request('POST', url, headers=headers, data=payload, idempotent=True)
+        # joined by an attempt that failed on the way back
+        if not (response.status_code == 403 and response.retried):
+            response.raise_for_status()
+        print('join network ' + network['name'] + ' success.')
 
-    def start_container(self):
-        url = '{}/containers/{}/start'.format(self.docker_api_prefix, self.container_name)
+    @timed('start_container')
+    def start_container(self, name = None):
+        url = '{}/containers/{}/start'.format(self.docker_api_prefix, name or self.container_name)
         headers = {
             'authorization': self.portainer_token,
             'cache-control': 'no-cache'
         }
-        response = requests.request('POST', url, headers=headers)
+        # starting a started container answers 304
+        response = self.request('POST', url, headers=headers, idempotent=True)
         response.raise_for_status()
 
-    def swarm_id(self):
-        url = '{}/swarm'.format(self.docker_api_prefix)
+    def inspect_container(self, name = None):
+        url = '{}/containers/{}/json'.format(self.docker_api_prefix, name or self.container_name)
         headers = {
             'authorization': self.portainer_token
         }
-        response = requests.request('GET', url, headers=headers)
+        response = self.request('GET', url, headers=headers)
+        if response.status_code == 404:
+            return None
         response.raise_for_status()
-        swarm_dict = response.json()
-        return swarm_dict["ID"]
+        return response.json()
 
-    def stack_exists(self):
-        url = self.stack_api_prefix
+    def inspect_image(self, image_id):
+        url = '{}/images/{}/json'.format(self.docker_api_prefix, image_id)
         headers = {
             'authorization': self.portainer_token
         }
-        response = requests.request('GET', url, headers=headers)
+        response = self.request('GET', url, headers=headers)
+        if response.status_code == 404:
+            return None
         response.raise_for_status()
-        stacks = response.json()
-        for stack in stacks:
-            if stack["Name"] == self.stack_name:
-                return True
-        
-        return False
+        return response.json()
 
-    def stack_id(self):
-        url = self.stack_api_prefix
+    def snapshot_payload(self, container, image):
+        '''
+        create payload that brings the inspected container back, its image pinned to the digest it runs
+        '''
+        payload = dict(container['Config'])
+        short_id = container['Id'][:12]
+        if payload.get('Hostname') == short_id:
+            del payload['Hostname']
+        payload['HostConfig'] = container.get('HostConfig') or {}
+        endpoints = {}
+        for network_name, network in ((container.get('NetworkSettings') or {}).get('Networks') or {}).items():
+            endpoint = {}
+            aliases = [alias for alias in network.get('Aliases') or [] if alias != short_id]
+            if aliases:
+                endpoint['Aliases'] = aliases
+            if network.get('IPAMConfig'):
+                endpoint['IPAMConfig'] = network['IPAMConfig']
+            endpoints[network_name] = endpoint
+        if endpoints:
+            payload['NetworkingConfig'] = {'EndpointsConfig': endpoints}
+
+        reference = payload['Image'].partition('@')[0]
+        name = self.image_query(reference)[1]['fromImage']
+        digests = [digest.partition('@')[2] for digest in (image or {}).get('RepoDigests') or [] if digest.partition('@')[0] == name]
+        # an image without registry digest only exists on that node, keep its id
+        payload['Image'] = '{}@{}'.format(reference, digests[0]) if digests else container['Image']
+        return payload
+
+    def container_snapshot(self, name = None):
+        '''
+        what a rollback recreates, None without container or without history
+        '''
+        if not self.history.enabled:
+            return None
+        container = self.inspect_container(name)
+        if not container:
+            return None
+        return self.snapshot_payload(container, self.inspect_image(container['Image']))
+
+    def record_deploy(self, kind, name, previous, previous_image):
+        self.history.record(self.endpoint_name, kind, name, self.image, previous, previous_image)
+
+    def rename_container(self, name, new_name):
+        url = '{}/containers/{}/rename'.format(self.docker_api_prefix, name)
+        headers = {
+            'authorization': self.portainer_token
+        }
+        response = self.request('POST', url, headers=headers, params={'name': new_name})
+        response.raise_for_status()
+
+    def container_health(self, container):
+        '''
+        healthy, unhealthy, stopped, running (no healthcheck) or starting
+        '''
+        state = container['State'] if container else {}
+        health = state.get('Health', {}).get('Status')
+        if health in ('healthy', 'unhealthy'):
+            return health
+        if not state or (not state.get('Running') and not state.get('Restarting')):
+            return 'stopped'
+        if not health and state.get('Running') and not state.get('Restarting'):
+            return 'running'
+        return 'starting'
+
+    @timed('wait_healthy')
+    def wait_healthy(self, name, timeout = None):
+        '''
+        wait for the docker healthcheck of the container to pass,
+        containers without healthcheck only have to keep running for a few seconds
+        '''
+        timeout = timeout or DEFAULT_HEALTH_TIMEOUT
+        start = time.time()
+        running_since = None
+        while time.time() - start < timeout:
+            health = self.container_health(self.inspect_container(name))
+            if health == 'healthy':
+                print('Container {} healthy after {:.1f}s'.format(name, time.time() - start))
+                return
+            if health in ('unhealthy', 'stopped'):
+                raise Exception('Container {} is {}'.format(name, health))
+            if health == 'running':
+                running_since = running_since or time.time()
+                if time.time() - running_since >= NO_HEALTHCHECK_GRACE:
+                    print('Container {} has no healthcheck, running for {:.1f}s'.format(name, time.time() - running_since))
+                    return
+            else:
+                running_since = None
+            time.sleep(CONVERGE_POLL_MIN)
+        raise Exception('Container {} not healthy in {}s'.format(name, timeout))
+
+    def deploy_container_blue_green(self, health_timeout = None):
+        '''
+        start the new container next to the old one under a temporary name and the same
+        network aliases, swap names once it is healthy, then remove the old container
+        '''
+        next_name = self.container_name + '-next'
+        old_name = self.container_name + '-old'
+        aliases = [self.container_name]
+
+        self.delete_container(name = next_name)
+        self.create_container(next_name, aliases)
+        self.start_container(next_name)
+        try:
+            self.wait_healthy(next_name, health_timeout)
+        except Exception:
+            print('New container is not healthy, keep the old one')
+            self.delete_container(name = next_name)
+            raise
+        print('new container healthy')
+
+        has_old = self.inspect_container() is not None
+        if has_old:
+            self.delete_container(name = old_name)
+            self.rename_container(self.container_name, old_name)
+        self.rename_container(next_name, self.container_name)
+        if has_old:
+            self.delete_container(name = old_name)
+        print('swap container successfully')
+
+    def swarm_id(self):
+        cache_key = 'swarm|{}|{}'.format(self.portainer_url, self.endpoint_id)
+        swarm_id = self.cache.get(cache_key)
+        if swarm_id:
+            return swarm_id
+
+        url = '{}/swarm'.format(self.docker_api_prefix)
         headers = {
             'authorization': self.portainer_token
         }
-        response = requests.request('GET', url, headers=headers)
+        response = self.request('GET', url, headers=headers)
         response.raise_for_status()
-        stacks = response.json()
+        swarm_dict = response.json()
+        if swarm_dict["ID"]:
+            self.cache.set(cache_key, swarm_dict["ID"])
+        return swarm_dict["ID"]
+
+    def index_stacks(self, stacks):
+        '''
+        stacks by name, a stack of this endpoint wins over a namesake on another endpoint
+        '''
+        index = {}
         for stack in stacks:
-            if stack["Name"] == self.stack_name:
-                return stack["Id"]
+            if stack["Name"] not in index or stack.get("EndpointId") == self.endpoint_id:
+                index[stack["Name"]] = stack
+        return index
 
-    def create_stack(self):
-        url = self.stack_api_prefix
-        queryString = {'method': 'string', 'type': 1, 'endpointId': self.endpoint_id}
+    def stacks(self):
+        '''
+        portainer can't filter stacks by name, the list is fetched once per deploy
+        '''
+        if self.stack_index is None:
+            url = self.stack_api_prefix
+            headers = {
+                'authorization': self.portainer_token
+            }
+            response = self.request('GET', url, headers=headers)
+            response.raise_for_status()
+            self.stack_index = self.index_stacks(response.json())
+        return self.stack_index
+
+    def stack_exists(self):
+        return self.stack_name in self.stacks()
+
+    def stack_id(self):
+        stack = self.stacks().get(self.stack_name)
+        if stack:
+            return stack["Id"]
 
-        swarm_id = self.swarm_id()
+    def stack_payload(self, swarm_id):
+        '''
+        body and query of a stack create
+        '''
         if not swarm_id:
             swarm_id = hashlib.sha224(str(self.stack_name).encode()).hexdigest()
 
@@ -325,14 +1037,20 @@ def create_stack(self):
             # convert to raw string that contains space and '/n '
             'StackFileContent': self.compose_file  # repr(self.compose_file)
         }
-        payload = json.dumps(payload)
+        return json.dumps(payload), {'method': 'string', 'type': 1, 'endpointId': self.endpoint_id}
 
+    @timed('create_stack')
+    def create_stack(self):
+        url = self.stack_api_prefix
+        payload, queryString = self.stack_payload(self.swarm_id())
         headers = { 'authorization': self.portainer_token }
-        response = requests.request(
+        response = self.request(
             'POST', url, data=payload, headers=headers, params=queryString)
         response.raise_for_status()
         print(response.text)
+        self.stack_index = None
 
+    @timed('update_stack')
     def update_stack(self):
         stack_id = self.stack_id()
         url = '{}/{}'.format(self.stack_api_prefix, stack_id)
@@ -342,28 +1060,177 @@ def update_stack(self):
             'StackFileContent': self.compose_file  # repr(self.compose_file)
         }
         payload = json.dumps(payload)
-        response = requests.request(
+        response = self.request(
             'PUT', url, data=payload, headers=headers, params=queryString)
         response.raise_for_status()
         print(response.text)
 
-    def pull_stack_images(self):
-        compose_dict = yaml.load(self.compose_file, Loader=yaml.FullLoader)
-        for service in compose_dict['services']:
-            image = compose_dict['services'][service]['image']
-            self.pull_image(image)
+    def stack_file(self, stack_id):
+        url = '{}/{}/file'.format(self.stack_api_prefix, stack_id)
+        headers = { 'authorization': self.portainer_token }
+        response = self.request('GET', url, headers=headers)
+        response.raise_for_status()
+        return response.json()['StackFileContent']
 
-    def get_network(self, name):
-        list_network_api = self.docker_api_prefix + '/networks'
+    def stack_structure_changed(self, deployed, desired):
+        '''
+        why the stack needs a full update, None when at most service images differ
+        '''
+        if not isinstance(deployed, dict) or not isinstance(desired, dict):
+            return 'deployed stack file can not be parsed'
+        if dict((key, value) for key, value in deployed.items() if key != 'services') != \
+                dict((key, value) for key, value in desired.items() if key != 'services'):
+            return 'networks, volumes, configs or secrets changed'
+        deployed_services = deployed.get('services') or {}
+        desired_services = desired.get('services') or {}
+        if set(deployed_services) != set(desired_services):
+            return 'services added or removed'
+        for name, service in desired_services.items():
+            if not service.get('image'):
+                return 'service {} has no image'.format(name)
+            if dict((key, value) for key, value in service.items() if key != 'image') != \
+                    dict((key, value) for key, value in deployed_services[name].items() if key != 'image'):
+                return 'service {} changed'.format(name)
+        return None
+
+    def service_image_changed(self, service, image, digest):
+        '''
+        the live spec runs another tag, or the tag moved to another digest in the registry.
+        a digest that could not be resolved counts as changed, stack_service_payload forces the update
+        '''
+        live_image, _, live_digest = service['Spec']['TaskTemplate']['ContainerSpec']['Image'].partition('@')
+        if self.image_query(live_image)[0] != image:
+            return True
+        return not digest or digest != live_digest
+
+    @timed('stack_diff')
+    def stack_changes(self, stack_id):
+        '''
+        services whose image changed as [(live service, image, digest)], None when the
+        compose file differs from the deployed one in anything but images
+        '''
+        plan = self.stack_plan(self.stack_file(stack_id), self.stack_services())
+        if not plan:
+            return None
+
+        images, live = plan
+        unique_images = sorted(set(images.values()))
+        with ThreadPoolExecutor(max_workers = max(min(len(unique_images), self.pool_size), 1)) as executor:
+            digests = dict(zip(unique_images, executor.map(self.registry_digest, unique_images)))
+        return self.stack_image_changes(images, live, digests)
+
+    def stack_plan(self, deployed_file, services):
+        '''
+        (image per compose service, live service per name), None when the stack needs a full update
+        '''
+        desired = load_yaml(self.compose_file)
+        reason = self.stack_structure_changed(load_yaml(deployed_file), desired)
+        if reason:
+            print('Full stack update: {}'.format(reason))
+            return None
+
+        live = dict((service['Spec']['Name'], service) for service in services)
+        images = dict((name, self.image_query(service['image'])[0]) for name, service in desired['services'].items())
+        missing = [name for name in images if '{}_{}'.format(self.stack_name, name) not in live]
+        if missing:
+            print('Full stack update: services {} are not running'.format(', '.join(missing)))
+            return None
+        return images, live
+
+    def stack_image_changes(self, images, live, digests):
+        changes = []
+        for name, image in sorted(images.items()):
+            service = live['{}_{}'.format(self.stack_name, name)]
+            if self.service_image_changed(service, image, digests[image]):
+                changes.append((service, image, digests[image]))
+            else:
+                print('Service {} unchanged'.format(service['Spec']['Name']))
+        return changes
+
+    def stack_service_payload(self, service, image, digest):
+        '''
+        pin the new digest like docker stack deploy does, force the update when it is unknown
+        '''
+        payload = service['Spec']
+        if digest:
+            payload['TaskTemplate']['ContainerSpec']['Image'] = '{}@{}'.format(image, digest)
+        else:
+            payload['TaskTemplate']['ContainerSpec']['Image'] = image
+            payload['TaskTemplate']['ForceUpdate'] = payload['TaskTemplate'].get('ForceUpdate', 0) + 1
+        return payload
+
+    @timed('update_service')
+    def update_stack_service(self, service, image, digest):
         headers = {
-            'authorization': self.portainer_token
+            'authorization': self.portainer_token,
+            'X-Registry-Auth': self.registry_auth(image)
         }
-        response = requests.request('GET', list_network_api, headers=headers)
+        response = self.post_service_update(service, lambda current: self.stack_service_payload(current, image, digest), headers)
         response.raise_for_status()
-        networks = response.json()
-        for network in networks:
-            if network["Name"] == name:
-                return network
+        print('Update service {} to {} successfully'.format(service['Spec']['Name'], service['Spec']['TaskTemplate']['ContainerSpec']['Image']))
+
+    def changed_images(self, changes):
+        images = {}
+        for service, image, _ in changes:
+            placement = service['Spec']['TaskTemplate'].get('Placement', {})
+            images.setdefault(image, []).append(placement.get('Constraints') or [])
+        return images
+
+    def stack_images(self):
+        '''
+        images of the compose file de-duplicated by image reference,
+        mapped to the placement constraints of the services using them
+        '''
+        compose_dict = load_yaml(self.compose_file)
+        images = {}
+        for service in compose_dict['services'].values():
+            image = service.get('image')
+            if not image:
+                continue
+            image, _ = self.image_query(image)
+            placement = (service.get('deploy') or {}).get('placement') or {}
+            images.setdefault(image, []).append(placement.get('constraints') or [])
+        return images
+
+    def pull_stack_images(self, concurrency = None, prepull = True):
+        agents = self.agent_nodes() if prepull else None
+        self.pull_images(self.pull_plan(self.stack_images(), agents), concurrency)
+
+    def print_pull_timings(self, timings):
+        for image, duration in sorted(timings.items(), key = lambda item: -item[1]):
+            print('{:>8.2f}s  {}'.format(duration, image))
+
+    def name_filter(self, *names):
+        '''
+        docker name filters match substrings, callers still compare names exactly
+        '''
+        return {'filters': json.dumps({'name': list(names)})}
+
+    def get_networks(self, names):
+        '''
+        fetch every missing network with one filtered request and keep them for this deploy
+        '''
+        missing = [name for name in names if name not in self.network_index]
+        if missing:
+            list_network_api = self.docker_api_prefix + '/networks'
+            headers = {
+                'authorization': self.portainer_token
+            }
+            response = self.request('GET', list_network_api, headers=headers, params=self.name_filter(*missing))
+            response.raise_for_status()
+            self.index_networks(missing, response.json())
+        return [self.network_index[name] for name in names]
+
+    def index_networks(self, names, networks):
+        '''
+        remember the listed networks, None for the names that were not found
+        '''
+        found = dict((network["Name"], network) for network in networks)
+        for name in names:
+            self.network_index[name] = found.get(name)
+
+    def get_network(self, name):
+        return self.get_networks([name])[0]
 
     def service_name(self):
         if self.stack_name:
@@ -376,33 +1243,61 @@ def get_service(self):
         headers = {
             'authorization': self.portainer_token
         }
-        response = requests.request('GET', service_api, headers=headers)
+        response = self.request('GET', service_api, headers=headers, params=self.name_filter(self.service_name()))
         response.raise_for_status()
-        services = response.json()
+        return self.select_service(response.json())
+
+    def select_service(self, services):
+        '''
+        the name filter matches prefixes, keep the exact name
+        '''
         for service in services:
             if service["Spec"]["Name"] == self.service_name():
                 return service
 
-    def create_service(self, mode = "Replicated", replicas = 1):
-        create_service_api = self.docker_api_prefix + '/services/create'
-        headers = {
-            'authorization': self.portainer_token,
-            'X-Registry-Auth': self.registry_token if self.image.startswith(self.registry_host) else None
+    def service_resources(self):
+        '''
+        Limits and Reservations of the task template, only the values that were given
+        '''
+        resources = {
+            'Limits': {
+                'MemoryBytes': self.memory_limit,
+                'NanoCPUs': self.cpu_limit
+            },
+            'Reservations': {
+                'MemoryBytes': self.memory_reservation,
+                'NanoCPUs': self.cpu_reservation
+            }
         }
+        return dict((kind, dict((key, value) for key, value in values.items() if value))
+                    for kind, values in resources.items() if any(values.values()))
+
+    def service_placement(self):
+        '''
+        constraints like node.labels.tier==web, spread over node.labels.zone like descriptors
+        '''
+        placement = {}
+        if self.constraints:
+            placement['Constraints'] = self.constraints
+        if self.spread:
+            placement['Preferences'] = [{'Spread': {'SpreadDescriptor': descriptor}} for descriptor in self.spread]
+        return placement
+
+    def service_payload(self, mode, replicas, networks, digest = None):
+        resources = self.service_resources()
+        resources.setdefault('Limits', {}).setdefault('MemoryBytes', self.memory_limit)
         payload = {
             'Name': self.service_name(),
             'TaskTemplate': {
                 'ContainerSpec': {
-                    'Image': self.image,
+                    'Image': self.service_image(digest),
                     'Env': self.envs,
                 },
-                'Resources': {
-                    'Limits': {
-                        'MemoryBytes': self.memory_limit
-                    }
-                }
+                'Resources': resources
             }
         }
+        if self.service_placement():
+            payload['TaskTemplate']['Placement'] = self.service_placement()
 
         # mode
         if mode:
@@ -418,14 +1313,19 @@ def create_service(self, mode = "Replicated", replicas = 1):
                 }
 
         # attach network
-        if self.networks and len(self.networks):
+        if networks and len(networks):
             payload["TaskTemplate"]["Networks"] = []
-            for network in self.networks:
-                network = self.get_network(network)
+            for spec, network in zip(self.networks, networks):
                 if network:
-                    payload["TaskTemplate"]["Networks"].append({
-                        "Target": network["Id"]
-                    })
+                    attachment = {"Target": network["Id"]}
+                    if spec['aliases']:
+                        attachment["Aliases"] = spec['aliases']
+                    payload["TaskTemplate"]["Networks"].append(attachment)
+
+        # rolling update
+        if self.update_config:
+            payload["UpdateConfig"] = dict(self.update_config)
+            payload["RollbackConfig"] = self.rollback_config()
 
         # port binding
         if self.ports and len(self.ports):
@@ -443,61 +1343,266 @@ def create_service(self, mode = "Replicated", replicas = 1):
                         'TargetPort': int(internalPort)
                     }
                 )
+        return payload
 
-        payload = json.dumps(payload)
-        response = requests.request('POST', create_service_api, data = payload, headers=headers)
+    @timed('create_service')
+    def create_service(self, mode = "Replicated", replicas = 1, digest = None):
+        create_service_api = self.docker_api_prefix + '/services/create'
+        headers = {
+            'authorization': self.portainer_token,
+            'X-Registry-Auth': self.registry_auth()
+        }
+        networks = self.get_networks([network['name'] for network in self.networks])
+        payload = json.dumps(self.service_payload(mode, replicas, networks, digest))
+        response = self.request('POST', create_service_api, data = payload, headers=headers)
         response.raise_for_status()
         print(response.text)
         print('Create service successfully')
+        return response.json()['ID']
+
+    def stack_services(self):
+        service_api = self.docker_api_prefix + '/services'
+        headers = {
+            'authorization': self.portainer_token
+        }
+        queryString = {'filters': json.dumps({'label': ['com.docker.stack.namespace={}'.format(self.stack_name)]})}
+        response = self.request('GET', service_api, headers=headers, params=queryString)
+        response.raise_for_status()
+        return response.json()
+
+    def stack_service_ids(self):
+        return [service['ID'] for service in self.stack_services()]
+
+    def convergence(self, services, tasks):
+        '''
+        service id -> (converged, running, desired) for services and their desired-running tasks,
+        a task counts once it runs the current image and force-update generation of its service
+        '''
+        result = {}
+        for service in services:
+            name = service['Spec']['Name']
+            update_status = service.get('UpdateStatus') or {}
+            if update_status.get('State') in UPDATE_FAILED_STATES:
+                raise Exception('Update of service {} {}: {}'.format(
+                    name, update_status['State'], update_status.get('Message')))
+
+            template = service['Spec']['TaskTemplate']
+            service_tasks = [task for task in tasks if task['ServiceID'] == service['ID']]
+            current = [task for task in service_tasks
+                       if task['Spec']['ContainerSpec']['Image'] == template['ContainerSpec']['Image']
+                       and task['Spec'].get('ForceUpdate', 0) == template.get('ForceUpdate', 0)]
+            running = len([task for task in current if task['Status']['State'] == 'running'])
+            if 'Replicated' in service['Spec'].get('Mode', {}):
+                desired = service['Spec']['Mode']['Replicated'].get('Replicas', 0)
+            else:
+                # global tasks show up once the scheduler picked the nodes
+                desired = max(len(service_tasks), 1)
+            converged = running >= desired and len(current) == len(service_tasks) \
+                and update_status.get('State') in (None, 'completed')
+            result[service['ID']] = (converged, running, desired)
+        return result
+
+    @timed('wait_converged')
+    def wait_converged(self, service_ids, timeout = None):
+        '''
+        poll services and tasks (one request each per round) until every service converged,
+        polling backs off while nothing changes and speeds up again on progress
+        '''
+        timeout = timeout or DEFAULT_CONVERGE_TIMEOUT
+        headers = {
+            'authorization': self.portainer_token
+        }
+        start = time.time()
+        delay = CONVERGE_POLL_MIN
+        pending = list(service_ids)
+        durations = {}
+        last = None
+        while pending:
+            response = self.request('GET', self.docker_api_prefix + '/services', headers=headers,
+                                    params={'filters': json.dumps({'id': pending})})
+            response.raise_for_status()
+            services = response.json()
+            response = self.request('GET', self.docker_api_prefix + '/tasks', headers=headers,
+                                    params={'filters': json.dumps({'service': pending, 'desired-state': ['running']})})
+            response.raise_for_status()
+            state = self.converge_round(services, response.json(), pending, start, durations)
+            if not pending:
+                break
+            delay = self.converge_delay(delay, state, last, start, timeout)
+            last = state
+            time.sleep(delay)
+        return durations
+
+    def converge_round(self, services, tasks, pending, start, durations):
+        '''
+        drop converged and removed services from pending, their time goes to durations
+        '''
+        state = self.convergence(services, tasks)
+        for service_id in set(pending) - set(state):
+            print('Service {} was removed'.format(service_id))
+            pending.remove(service_id)
+
+        for service in services:
+            converged, running, desired = state[service['ID']]
+            if converged:
+                durations[service['Spec']['Name']] = time.time() - start
+                pending.remove(service['ID'])
+                print('Service {} converged in {:.1f}s'.format(service['Spec']['Name'], durations[service['Spec']['Name']]))
+            else:
+                print('Service {}: {}/{} tasks running'.format(service['Spec']['Name'], running, desired))
+        return state
+
+    def converge_delay(self, delay, state, last, start, timeout):
+        delay = CONVERGE_POLL_MIN if state != last else min(delay * 2, CONVERGE_POLL_MAX)
+        if time.time() - start + delay > timeout:
+            raise Exception('Services did not converge in {}s'.format(timeout))
+        return delay
 
     '''
     Deploy service (image & memory limit)
     '''
-    def deploy_service(self, mode = "Replicated", replicas = 1):
+    @timed('deploy')
+    def deploy_service(self, mode = "Replicated", replicas = 1, prepull = True, skip_unchanged = False,
+                       wait = False, wait_timeout = None):
         self.warmup()
-        self.pull_image()
         current_service = self.get_service()
+        # resolved for every deploy, the spec is pinned to it
+        digest = self.registry_digest()
+        if current_service and skip_unchanged:
+            if digest and self.service_unchanged(current_service, digest):
+                print('Service {} already runs {}@{}, no-op'.format(self.service_name(), self.image, digest))
+                return NO_OP
+
+        if prepull:
+            placement = current_service["Spec"]["TaskTemplate"].get("Placement", {}) if current_service else {}
+            self.pull_image_on_nodes(constraints = self.constraints or placement.get("Constraints"))
+        else:
+            self.pull_image()
         if not current_service:
             print("Service not exists!")
             print("Trying to create service: {}".format(self.service_name()))
-            self.create_service(mode, replicas)
+            service_id = self.create_service(mode, replicas, digest)
+            self.record_deploy('service', self.service_name(), None, None)
+            if wait:
+                self.wait_converged([service_id], wait_timeout)
             return
 
-        update_service_api = self.docker_api_prefix + '/services/' + current_service["ID"] + '/update'
+        previous = self.update_service(current_service, digest)
+        # recorded before waiting, a rollout that fails to converge is what gets rolled back
+        self.record_deploy('service', self.service_name(), previous, previous["TaskTemplate"]["ContainerSpec"]["Image"])
+        if wait:
+            self.wait_converged([current_service["ID"]], wait_timeout)
+
+    @timed('update_service')
+    def update_service(self, current_service, digest = None):
         headers = {
             'authorization': self.portainer_token,
-            'X-Registry-Auth': self.registry_token if self.image.startswith(self.registry_host) else None
+            'X-Registry-Auth': self.registry_auth()
         }
+        response = self.post_service_update(current_service, lambda service: self.service_update_payload(service, digest), headers)
+        response.raise_for_status()
+        print(response.text)
+        print('Update service {} successfully'.format(self.service_name()))
+        return response.replaced
 
-        queryString = {'version': current_service["Version"]["Index"]}
+    def scale_service(self, current_service, replicas):
+        '''
+        change the replicas of a replicated service, the rest of the deployed spec stays as it is
+        '''
+        def scale_payload(service):
+            payload = service["Spec"]
+            payload["Mode"]["Replicated"]["Replicas"] = replicas
+            return payload
+
+        image = current_service["Spec"]["TaskTemplate"]["ContainerSpec"]["Image"]
+        headers = {
+            'authorization': self.portainer_token,
+            'X-Registry-Auth': self.registry_auth(image) if self.registry_host else None
+        }
+        response = self.post_service_update(current_service, scale_payload, headers)
+        response.raise_for_status()
+        print('Scale service {} to {} replicas successfully'.format(current_service["Spec"]["Name"], replicas))
+
+    def version_conflict(self, response):
+        return response.status_code >= 400 and 'out of sequence' in response.text
+
+    def inspect_service(self, service_id):
+        url = '{}/services/{}'.format(self.docker_api_prefix, service_id)
+        headers = {
+            'authorization': self.portainer_token
+        }
+        response = self.request('GET', url, headers=headers)
+        response.raise_for_status()
+        return response.json()
 
+    def post_service_update(self, service, build_payload, headers):
+        '''
+        swarm rejects updates based on an outdated Version.Index, another deploy updated the
+        service in between: build the payload again from a fresh spec and retry.
+        response.replaced is the spec the sent update replaced, the payload builders change it in place
+        '''
+        url = '{}/services/{}/update'.format(self.docker_api_prefix, service['ID'])
+        for attempt in range(VERSION_CONFLICT_RETRIES + 1):
+            queryString = {'version': service['Version']['Index']}
+            replaced = copy.deepcopy(service['Spec'])
+            payload = json.dumps(build_payload(service))
+            response = self.request('POST', url, data = payload, headers=headers, params=queryString)
+            response.replaced = replaced
+            if not self.version_conflict(response) or attempt == VERSION_CONFLICT_RETRIES:
+                return response
+            print('Service {} was updated meanwhile, retry with a fresh spec'.format(service['Spec']['Name']))
+            fresh = self.inspect_service(service['ID'])
+            service.clear()
+            service.update(fresh)
+
+    def rollback_config(self):
+        '''
+        roll back at the pace of the rollout, failure actions of rollbacks are limited to pause and continue
+        '''
+        return dict((key, value) for key, value in self.update_config.items() if key != 'FailureAction')
+
+    def service_update_payload(self, current_service, digest = None):
         payload = current_service["Spec"]
-        payload["TaskTemplate"]["ContainerSpec"]["Image"] = self.image
+        payload["TaskTemplate"]["ContainerSpec"]["Image"] = self.service_image(digest)
         payload["TaskTemplate"]["ForceUpdate"] += 1
-        if self.memory_limit > 0:
-            if "Limits" in payload["TaskTemplate"]["Resources"]:
-                payload["TaskTemplate"]["Resources"]["Limits"]["MemoryBytes"] = self.memory_limit
-            else:
-                payload["TaskTemplate"]["Resources"] = {
-                    "Limits": {
-                        "MemoryBytes": self.memory_limit
-                    }
-                }
-        payload = json.dumps(payload)
-        response = requests.request('POST', update_service_api, data = payload, headers=headers, params=queryString)
-        response.raise_for_status()
-        print(response.text)
-        print('Update service {} successfully'.format(self.service_name()))
+        if self.update_config:
+            payload.setdefault("UpdateConfig", {}).update(self.update_config)
+            payload.setdefault("RollbackConfig", {}).update(self.rollback_config())
+        resources = payload["TaskTemplate"].get("Resources") or {}
+        for kind, values in self.service_resources().items():
+            resources[kind] = dict(resources.get(kind) or {}, **values)
+        payload["TaskTemplate"]["Resources"] = resources
+        if self.service_placement():
+            payload["TaskTemplate"]["Placement"] = dict(payload["TaskTemplate"].get("Placement") or {}, **self.service_placement())
+        return payload
 
     '''
     Deploy container
     '''
-    def deploy_container(self):
+    @timed('deploy')
+    def deploy_container(self, skip_unchanged = False, blue_green = False, health_timeout = None):
+        if self.constraints or self.spread or self.cpu_reservation:
+            print('Placement and cpu reservations only apply to swarm services, ignored for containers')
         self.warmup()
         print('warmup successfully')
 
+        if skip_unchanged:
+            digest = self.registry_digest()
+            if digest and self.container_unchanged(digest):
+                print('Container {} already runs {}@{}, no-op'.format(self.container_name, self.image, digest))
+                return NO_OP
+
         self.pull_image()
         print('pull image successfully')
+        previous = self.container_snapshot()
+
+        if blue_green and self.ports:
+            print('Published ports can not be bound by two containers, blue/green deploy disabled')
+        elif blue_green:
+            self.deploy_container_blue_green(health_timeout)
+            self.record_deploy('container', self.container_name, previous, previous['Image'] if previous else None)
+            print('deploy finished')
+            return
 
         self.delete_container()
         print('delete container successfully')
@@ -507,13 +1612,127 @@ def deploy_container(self):
 
         self.start_container()
         print('start container successfully')
+        self.record_deploy('container', self.container_name, previous, previous['Image'] if previous else None)
         print('deploy finished')
 
-    def deploy_stack(self):
+    def rollback_target(self, kind, name):
+        entry = self.history.rollback_target(self.endpoint_name, kind, name)
+        if not entry:
+            if not self.history.enabled or not os.path.exists(self.history.path):
+                raise Exception('No deploy history at {}: rollback needs the history of earlier deploys, keep '
+                                'PORTAINER_STATE_DIR (or PORTAINER_HISTORY) on a volume'.format(self.history.path))
+            raise Exception('No deploy of {} {} on {} to roll back, see --history'.format(kind, name, self.endpoint_name))
+        return entry
+
+    @timed('rollback')
+    def rollback_service(self, prepull = True, wait = False, wait_timeout = None):
+        '''
+        restore the spec the latest deploy replaced, keeping the current replicas
+        '''
+        entry = self.rollback_target('service', self.service_name())
+        current_service = self.get_service()
+        if not current_service:
+            raise Exception('Service {} not exists'.format(self.service_name()))
+        spec = entry['previous']
+        image = spec["TaskTemplate"]["ContainerSpec"]["Image"]
+        print('Roll back service {} to {}'.format(self.service_name(), image))
+        if prepull:
+            self.pull_image_on_nodes(image, (spec["TaskTemplate"].get("Placement") or {}).get("Constraints"))
+
+        def rollback_payload(service):
+            payload = copy.deepcopy(spec)
+            live = service["Spec"]
+            if "Replicated" in payload.get("Mode", {}) and "Replicated" in live.get("Mode", {}):
+                payload["Mode"] = live["Mode"]
+            payload["TaskTemplate"]["ForceUpdate"] = live["TaskTemplate"].get("ForceUpdate", 0)
+            return payload
+
+        headers = {
+            'authorization': self.portainer_token,
+            'X-Registry-Auth': self.registry_auth(image)
+        }
+        response = self.post_service_update(current_service, rollback_payload, headers)
+        response.raise_for_status()
+        previous = response.replaced
+        self.history.mark(entry['id'], ROLLED_BACK)
+        self.history.record(self.endpoint_name, 'service', self.service_name(), image, previous,
+                            previous["TaskTemplate"]["ContainerSpec"]["Image"], ROLLBACK)
+        print('Roll back service {} successfully'.format(self.service_name()))
+        if wait:
+            self.wait_converged([current_service["ID"]], wait_timeout)
+
+    def restore_container(self, payload):
+        '''
+        create a container from a snapshot payload, engines that take one network at create join the others afterwards
+        '''
+        url = '{0}/containers/create'.format(self.docker_api_prefix)
+        queryString = {'name': self.container_name}
+        headers = {
+            'authorization': self.portainer_token,
+            'content-type': 'application/json',
+        }
+        endpoints = list(((payload.get('NetworkingConfig') or {}).get('EndpointsConfig') or {}).items())
+        single = False
+        response = self.request('POST', url, data=json.dumps(payload), headers=headers, params=queryString, idempotent=True)
+        if len(endpoints) > 1 and self.networks_rejected(response):
+            single = True
+            response = self.request('POST', url, data=json.dumps(dict(payload, NetworkingConfig={'EndpointsConfig': dict(endpoints[:1])})),
+                                    headers=headers, params=queryString, idempotent=True)
+        if response.status_code == 409 and response.retried:
+            # deleted before, like in create_container an attempt that failed on the way back did create it
+            container_id = self.inspect_container()['Id']
+        else:
+            response.raise_for_status()
+            container_id = response.json()['Id']
+
+        if single:
+            for network_name, endpoint in endpoints[1:]:
+                ipam = endpoint.get('IPAMConfig') or {}
+                network = {'name': network_name, 'aliases': endpoint.get('Aliases') or [],
+                           'ip': ipam.get('IPv4Address'), 'ip6': ipam.get('IPv6Address')}
+                self.join_network(network, container_id)
+
+    @timed('rollback')
+    def rollback_container(self):
+        '''
+        recreate the container the latest deploy replaced
+        '''
+        entry = self.rollback_target('container', self.container_name)
+        payload = entry['previous']
+        print('Roll back container {} to {}'.format(self.container_name, payload['Image']))
+        # an image id is already on the node
+        if not payload['Image'].startswith('sha256:'):
+            self.pull_image(payload['Image'])
+        previous = self.container_snapshot()
+        self.delete_container()
+        self.restore_container(payload)
+        self.start_container()
+        self.history.mark(entry['id'], ROLLED_BACK)
+        self.history.record(self.endpoint_name, 'container', self.container_name, payload['Image'], previous,
+                            previous['Image'] if previous else None, ROLLBACK)
+        print('Roll back container {} successfully'.format(self.container_name))
+
+    @timed('deploy')
+    def deploy_stack(self, pull_concurrency = None, prepull = True, wait = False, wait_timeout = None, diff = True):
         self.warmup()
         print('warmup successfully')
 
-        self.pull_stack_images()
+        stack_id = self.stack_id()
+        changes = self.stack_changes(stack_id) if stack_id and diff else None
+        if changes is not None:
+            if not changes:
+                print('Stack {} unchanged, no-op'.format(self.stack_name))
+                return NO_OP
+            agents = self.agent_nodes() if prepull else None
+            self.pull_images(self.pull_plan(self.changed_images(changes), agents), pull_concurrency)
+            print('pull changed images successfully')
+            for service, image, digest in changes:
+                self.update_stack_service(service, image, digest)
+            if wait:
+                self.wait_converged([service['ID'] for service, _, _ in changes], wait_timeout)
+            return
+
+        self.pull_stack_images(pull_concurrency, prepull)
         print('pull stack images successfully')
 
         if not self.stack_exists():
@@ -523,6 +1742,9 @@ def deploy_stack(self):
             self.update_stack()
             print('update stack successfully')
 
+        if wait:
+            self.wait_converged(self.stack_service_ids(), wait_timeout)
+
 
 if __name__ =='__main__':
     import sys
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" portainer-api deploy history """
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from cache import state_path
+
+# entries kept per service or container
+DEFAULT_HISTORY_LIMIT = 50
+DEPLOYED = 'deployed'
+ROLLBACK = 'rollback'
+ROLLED_BACK = 'rolled-back'
+
+SCHEMA = '''
+create table if not exists deploys (
+    id integer primary key autoincrement,
+    time real not null,
+    endpoint text not null,
+    kind text not null,
+    name text not null,
+    image text,
+    previous_image text,
+    previous text,
+    status text not null
+);
+create index if not exists deploys_target on deploys (endpoint, kind, name, id);
+'''
+
+class History:
+    '''
+    sqlite file of the deploys on this machine, each with what it replaced: the service spec or the
+    container create payload, image pinned to its digest. a rollback restores what the latest deploy
+    that was not rolled back replaced, so repeated rollbacks walk further back.
+    PORTAINER_HISTORY sets the file (off disables the history), PORTAINER_HISTORY_LIMIT the entries kept.
+    '''
+    def __init__(self, path = None, limit = None):
+        path = path or os.environ.get('PORTAINER_HISTORY') or state_path('history.db')
+        self.enabled = path.lower() != 'off'
+        self.path = path
+        self.limit = limit or int(os.environ.get('PORTAINER_HISTORY_LIMIT', DEFAULT_HISTORY_LIMIT))
+        self.lock = threading.Lock()
+        self.ready = False
+
+    def connect(self):
+        if not self.ready:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok = True)
+        db = sqlite3.connect(self.path, timeout = 30)
+        db.row_factory = sqlite3.Row
+        if not self.ready:
+            db.executescript(SCHEMA)
+            self.ready = True
+        return db
+
+    def execute(self, *statements):
+        '''
+        (sql, parameters) statements in one transaction, rows of each statement
+        '''
+        with self.lock:
+            db = self.connect()
+            try:
+                with db:
+                    return [db.execute(sql, parameters).fetchall() for sql, parameters in statements]
+            finally:
+                db.close()
+
+    def record(self, endpoint, kind, name, image, previous = None, previous_image = None, status = DEPLOYED):
+        '''
+        a finished deploy, history problems never fail the deploy
+        '''
+        if not self.enabled:
+            return
+        try:
+            self.execute(
+                ('insert into deploys (time, endpoint, kind, name, image, previous_image, previous, status) '
+                 'values (?, ?, ?, ?, ?, ?, ?, ?)',
+                 (time.time(), endpoint.lower(), kind, name, image, previous_image,
+                  json.dumps(previous) if previous is not None else None, status)),
+                ('delete from deploys where endpoint = ? and kind = ? and name = ? and id not in '
+                 '(select id from deploys where endpoint = ? and kind = ? and name = ? order by id desc limit ?)',
+                 (endpoint.lower(), kind, name, endpoint.lower(), kind, name, self.limit)))
+        except Exception as ex:
+            print('Can not write deploy history {}: {}'.format(self.path, ex))
+
+    def entries(self, endpoint, kind, name):
+        '''
+        deploys of a service or container, latest first
+        '''
+        if not self.enabled or not os.path.exists(self.path):
+            return []
+        rows = self.execute(('select * from deploys where endpoint = ? and kind = ? and name = ? order by id desc',
+                             (endpoint.lower(), kind, name)))[0]
+        entries = []
+        for row in rows:
+            entry = dict(row)
+            entry['previous'] = json.loads(entry['previous']) if entry['previous'] else None
+            entries.append(entry)
+        return entries
+
+    def rollback_target(self, endpoint, kind, name):
+        '''
+        the latest deploy that was not rolled back yet, None when there is nothing to roll back
+        '''
+        for entry in self.entries(endpoint, kind, name):
+            if entry['status'] == DEPLOYED:
+                return entry if entry['previous'] is not None else None
+        return None
+
+    def mark(self, entry_id, status):
+        self.execute(('update deploys set status = ? where id = ?', (status, entry_id)))
+
+    def summary(self, endpoint, kind, name):
+        if not self.enabled or not os.path.exists(self.path):
+            return 'No deploy history at {}, keep PORTAINER_STATE_DIR on a volume to keep it between runs'.format(self.path)
+        lines = ['{:<6} {:<20} {:<12} {}'.format('ID', 'TIME', 'STATUS', 'IMAGE (PREVIOUS)')]
+        for entry in self.entries(endpoint, kind, name):
+            lines.append('{:<6} {:<20} {:<12} {} ({})'.format(
+                entry['id'], time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['time'])),
+                entry['status'], entry['image'], entry['previous_image'] or '-'))
+        return '\n'.join(lines)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" portainer-api deploy locks """
+
+import hashlib
+import os
+import time
+import uuid
+from cache import state_path
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+DEFAULT_LOCK_TIMEOUT = 1800
+LOCK_POLL = 0.5
+
+class DeployLock:
+    '''
+    serializes deploys of the same target on this machine, latest wins:
+    every deploy registers itself as the latest request before it waits for the lock,
+    a deploy that gets the lock after a newer request registered steps aside.
+    PORTAINER_LOCK_DIR sets the directory (off disables locking), PORTAINER_LOCK_TIMEOUT the wait.
+
+        with DeployLock(key) as lock:
+            if lock.superseded:
+                return
+    '''
+    def __init__(self, key, directory = None, timeout = None):
+        directory = directory or os.environ.get('PORTAINER_LOCK_DIR') or state_path('locks')
+        self.enabled = directory.lower() != 'off' and fcntl is not None
+        self.key = key
+        self.timeout = timeout or float(os.environ.get('PORTAINER_LOCK_TIMEOUT', DEFAULT_LOCK_TIMEOUT))
+        name = hashlib.sha1(key.encode()).hexdigest()
+        self.lock_path = os.path.join(directory, name + '.lock')
+        self.latest_path = os.path.join(directory, name + '.latest')
+        self.ticket = uuid.uuid4().hex
+        self.lock_file = None
+        self.superseded = False
+
+    def register(self):
+        temp_path = '{}.{}.tmp'.format(self.latest_path, self.ticket)
+        with open(temp_path, 'w') as latest_file:
+            latest_file.write(self.ticket)
+        os.replace(temp_path, self.latest_path)
+
+    def latest(self):
+        try:
+            with open(self.latest_path, 'r') as latest_file:
+                return latest_file.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def acquire(self):
+        '''
+        False when a newer deploy of the target is waiting, the lock is not held then
+        '''
+        if not self.enabled:
+            return True
+        os.makedirs(os.path.dirname(self.lock_path), exist_ok = True)
+        self.register()
+        self.lock_file = open(self.lock_path, 'a')
+        start = time.time()
+        reported = False
+        while True:
+            try:
+                fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if not reported:
+                    print('Another deploy of {} is running, waiting for it'.format(self.key))
+                    reported = True
+                if time.time() - start > self.timeout:
+                    self.lock_file.close()
+                    self.lock_file = None
+                    raise Exception('Deploy lock of {} not acquired in {}s'.format(self.key, self.timeout))
+                time.sleep(LOCK_POLL)
+
+        latest = self.latest()
+        if latest and latest != self.ticket:
+            print('A newer deploy of {} is waiting, skip this one'.format(self.key))
+            self.superseded = True
+            self.release()
+            return False
+        return True
+
+    def release(self):
+        if not self.lock_file:
+            return
+        # the latest ticket stays after the deploy: an older deploy still waiting for the lock
+        # must find it, or it would deploy after the newest one
+        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        self.lock_file.close()
+        self.lock_file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
@@ -1,9 +1,14 @@
+import time
+# --profile-startup measures from here on, interpreter startup itself is not included
+startup_time = time.time()
+
 import deploy
 import getopt
 import os
-import requests
 import sys
-import time
+import units
+
+imported_time = time.time()
 
 docker_container_name = None
 docker_envs = []
@@ -15,6 +20,42 @@
 docker_memory_limit = 0
 docker_service_mode = "Replicated"
 docker_replicas = 1
+batch_manifest = None
+batch_workers = 4
+batch_endpoint_concurrency = 2
+deploy_engine = 'sync'
+pull_concurrency = None
+prepull = True
+skip_unchanged = False
+wait_converged = False
+wait_timeout = None
+blue_green = False
+health_timeout = None
+stack_diff = True
+update_parallelism = None
+update_delay = None
+update_order = None
+update_failure_action = None
+update_monitor = None
+cpu_limit = None
+memory_reservation = None
+cpu_reservation = None
+placement_constraints = []
+placement_spread = []
+serve = False
+server_listen = None
+deploy_lock = True
+profile_startup = False
+autoscale_policies = None
+autoscale_interval = None
+autoscale_record = None
+autoscale_replay = None
+dry_run = False
+rollback = False
+show_history = False
+cleanup_mode = False
+cleanup_keep = None
+cleanup_min_age = None
 
 def check(param, name):
     if not param:
@@ -22,16 +63,63 @@ def check(param, name):
 
 def parse_optional_args(argv):
     global docker_envs, docker_volumes, docker_ports, docker_networks, docker_compose_file, docker_container_name, docker_stack_name, docker_memory_limit, docker_service_mode, docker_replicas
+    global batch_manifest, batch_workers, batch_endpoint_concurrency, deploy_engine, pull_concurrency, prepull, skip_unchanged, wait_converged, wait_timeout, blue_green, health_timeout, stack_diff
+    global update_parallelism, update_delay, update_order, update_failure_action, update_monitor
+    global cpu_limit, memory_reservation, cpu_reservation, placement_constraints, placement_spread, serve, server_listen, deploy_lock, profile_startup
+    global autoscale_policies, autoscale_interval, autoscale_record, autoscale_replay, dry_run, rollback, show_history
+    global cleanup_mode, cleanup_keep, cleanup_min_age
     usage = 'Usage: main.py  \
             --docker_env=ASPNETCORE_ENVIRONMENT=Development \
             --net=bridge \
             --v=source:target \
             --port=8585:80 \
-            --compose-file=docker-compose.yml'
+            --compose-file=docker-compose.yml \
+            --manifest=targets.yml \
+            --workers=4 \
+            --endpoint-concurrency=2 \
+            --async \
+            --pull-concurrency=4 \
+            --no-prepull \
+            --skip-unchanged \
+            --wait \
+            --wait-timeout=300 \
+            --blue-green \
+            --health-timeout=120 \
+            --no-stack-diff \
+            --update-parallelism=5 \
+            --update-delay=10s \
+            --update-order=start-first \
+            --update-failure-action=rollback \
+            --update-monitor=30s \
+            --memory=512m \
+            --cpus=1.5 \
+            --memory-reservation=256m \
+            --cpu-reservation=0.5 \
+            --constraint=node.labels.tier==web \
+            --placement-pref=spread=node.labels.zone \
+            --serve \
+            --listen=127.0.0.1:8700 \
+            --no-lock \
+            --profile-startup \
+            --autoscale=autoscale.yml \
+            --interval=15 \
+            --record=samples.jsonl \
+            --replay=samples.jsonl \
+            --dry-run \
+            --rollback \
+            --history \
+            --cleanup \
+            --keep=3 \
+            --min-age=1h'
     try:
         opts, args = getopt.getopt(argv,
                                    'p:e:v',
-                                   ['env=', 'net=', 'port=', 'volume=', 'compose-file=', 'name=', 'container-name=', 'stack-name=', 'memory=', 'limit-memory=', 'mode=', 'replicas='])
+                                   ['env=', 'net=', 'port=', 'volume=', 'compose-file=', 'name=', 'container-name=', 'stack-name=', 'memory=', 'limit-memory=', 'mode=', 'replicas=', 'manifest=', 'workers=', 'endpoint-concurrency=', 'async', 'pull-concurrency=', 'no-prepull', 'skip-unchanged', 'wait', 'wait-timeout=', 'blue-green', 'health-timeout=', 'no-stack-diff',
+                                    'update-parallelism=', 'update-delay=', 'update-order=', 'update-failure-action=', 'update-monitor=',
+                                    'cpus=', 'limit-cpu=', 'memory-reservation=', 'reserve-memory=', 'cpu-reservation=', 'reserve-cpu=',
+                                    'constraint=', 'placement-pref=', 'serve', 'listen=', 'no-lock', 'profile-startup',
+                                    'autoscale=', 'interval=', 'record=', 'replay=', 'dry-run', 'rollback', 'history',
+                                    'cleanup', 'keep=', 'min-age='])
     except getopt.GetoptError as er:
         print(er)
         print(usage)
@@ -54,43 +142,283 @@ def parse_optional_args(argv):
         elif opt in('--stack-name'):
             docker_stack_name = str.strip(arg)
         elif opt in('--memory', '--limit-memory'):
-            docker_memory_limit = int(str.strip(arg))
+            docker_memory_limit = units.parse_size(str.strip(arg))
         elif opt in('--mode'):
             docker_service_mode = str.strip(arg)
         elif opt in('--replicas'):
             docker_replicas = int(str.strip(arg))
+        elif opt in('--manifest'):
+            batch_manifest = str.strip(arg)
+        elif opt in('--workers'):
+            batch_workers = int(str.strip(arg))
+        elif opt in('--endpoint-concurrency'):
+            batch_endpoint_concurrency = int(str.strip(arg))
+        elif opt in('--async'):
+            deploy_engine = 'async'
+        elif opt in('--pull-concurrency'):
+            pull_concurrency = int(str.strip(arg))
+        elif opt in('--no-prepull'):
+            prepull = False
+        elif opt in('--skip-unchanged'):
+            skip_unchanged = True
+        elif opt in('--wait'):
+            wait_converged = True
+        elif opt in('--wait-timeout'):
+            wait_timeout = int(str.strip(arg))
+        elif opt in('--blue-green'):
+            blue_green = True
+        elif opt in('--health-timeout'):
+            health_timeout = int(str.strip(arg))
+        elif opt in('--no-stack-diff'):
+            stack_diff = False
+        elif opt in('--update-parallelism'):
+            update_parallelism = int(str.strip(arg))
+        elif opt in('--update-delay'):
+            update_delay = str.strip(arg)
+        elif opt in('--update-order'):
+            update_order = str.strip(arg)
+        elif opt in('--update-failure-action'):
+            update_failure_action = str.strip(arg)
+        elif opt in('--update-monitor'):
+            update_monitor = str.strip(arg)
+        elif opt in('--cpus', '--limit-cpu'):
+            cpu_limit = units.parse_cpus(str.strip(arg))
+        elif opt in('--memory-reservation', '--reserve-memory'):
+            memory_reservation = units.parse_size(str.strip(arg))
+        elif opt in('--cpu-reservation', '--reserve-cpu'):
+            cpu_reservation = units.parse_cpus(str.strip(arg))
+        elif opt in('--constraint'):
+            placement_constraints.append(str.strip(arg))
+        elif opt in('--placement-pref'):
+            strategy, _, descriptor = str.strip(arg).partition('=')
+            if strategy != 'spread' or not descriptor:
+                raise Exception('placement preference must be spread=<node label>, got {}'.format(arg))
+            placement_spread.append(descriptor)
+        elif opt in('--serve'):
+            serve = True
+        elif opt in('--listen'):
+            server_listen = str.strip(arg)
+        elif opt in('--no-lock'):
+            deploy_lock = False
+        elif opt in('--profile-startup'):
+            profile_startup = True
+        elif opt in('--autoscale'):
+            autoscale_policies = str.strip(arg)
+        elif opt in('--interval'):
+            autoscale_interval = float(str.strip(arg))
+        elif opt in('--record'):
+            autoscale_record = str.strip(arg)
+        elif opt in('--replay'):
+            autoscale_replay = str.strip(arg)
+        elif opt in('--dry-run'):
+            dry_run = True
+        elif opt in('--rollback'):
+            rollback = True
+        elif opt in('--history'):
+            show_history = True
+        elif opt in('--cleanup'):
+            cleanup_mode = True
+        elif opt in('--keep'):
+            cleanup_keep = int(str.strip(arg))
+        elif opt in('--min-age'):
+            cleanup_min_age = str.strip(arg)
+
+def report_startup(import_seconds, init_start):
+    '''
+    init covers the http client import, portainer login, endpoint lookup and registry auth
+    '''
+    if not profile_startup:
+        return
+    now = time.time()
+    print("Startup: imports {:.0f}ms, init {:.0f}ms, total {:.0f}ms until the first deploy step".format(
+        (imported_time - startup_time + import_seconds) * 1000, (now - init_start) * 1000, (now - startup_time) * 1000))
+
+def deploy_sync(deploy_args, deploy_kwargs, operation, *operation_args):
+    init_start = time.time()
+    instance = deploy.Deploy(*deploy_args, **deploy_kwargs)
+    report_startup(0, init_start)
+    try:
+        getattr(instance, operation)(*operation_args)
+    finally:
+        print(instance.metrics.summary())
+        print("Portainer connections: {}".format(instance.connection_stats()))
+        instance.close()
+        instance.metrics.close()
+
+def deploy_async(deploy_args, deploy_kwargs, operation, *operation_args):
+    import_start = time.time()
+    import asyncio
+    import async_deploy
+    init_start = time.time()
+
+    async def run():
+        async with async_deploy.AsyncDeploy(*deploy_args, **deploy_kwargs) as instance:
+            report_startup(init_start - import_start, init_start)
+            try:
+                await getattr(instance, operation)(*operation_args)
+            finally:
+                print(instance.metrics.summary())
+                print("Portainer connections: {}".format(instance.connection_stats()))
+                instance.metrics.close()
+
+    asyncio.run(run())
+
+def deploy_batch():
+    import batch
+    print("------------Deploy batch------------")
+    batch_deploy = batch.BatchDeploy(batch.load_manifest(batch_manifest), batch_workers, batch_endpoint_concurrency)
+    batch_deploy.run()
+    print(batch_deploy.summary())
+    print(batch_deploy.metrics.summary())
+    print("Portainer connections: {}".format(batch_deploy.connection_stats()))
+    batch_deploy.close()
+    if not batch_deploy.succeeded():
+        sys.exit(1)
+    print("------------Deploy completed------------")
+
+def deploy_server():
+    import server
+    # env of the server process are defaults of every job
+    defaults = {}
+    if os.environ.get('PORTAINER_ENDPOINT'):
+        defaults['endpoint'] = os.environ.get('PORTAINER_ENDPOINT')
+    if os.environ.get('SWARM_MODE'):
+        defaults['swarm_mode'] = os.environ.get('SWARM_MODE')
+    print("------------Deploy server------------")
+    server.serve(server_listen, batch_workers, batch_endpoint_concurrency, defaults)
+
+def deploy_autoscale():
+    import autoscale
+    policies = autoscale.load_policies(autoscale_policies)
+    if autoscale_replay:
+        print("------------Replay autoscale------------")
+        decisions = autoscale.replay(policies, autoscale_replay)
+        print("{} decisions, {} scalings".format(len(decisions), len([item for item in decisions if item['action'] != 'hold'])))
+        return
+    print("------------Autoscale------------")
+    autoscale.run(policies, autoscale_interval, autoscale_record, dry_run)
+
+def deploy_history(endpoint_name, kind, name):
+    from history import History
+    print("------------Deploy history------------")
+    print(History().summary(endpoint_name, kind, name))
+
+def deploy_cleanup(endpoint_name):
+    import cleanup
+    print("------------Cleanup {}------------".format(endpoint_name))
+    instance = deploy.Deploy(endpoint_name, None, None, [], [], [], [], None, None, 0)
+    try:
+        images_cleanup = cleanup.Cleanup(instance, cleanup_keep, cleanup_min_age, dry_run)
+        results = images_cleanup.run()
+        print(images_cleanup.summary(results))
+        print(instance.metrics.summary())
+    finally:
+        instance.close()
+        instance.metrics.close()
+    if any(result['error'] for result in results):
+        sys.exit(1)
 
 if __name__ == '__main__':
     print("------------Portainer-Api------------")
 
+    # Parse commandline arguments
+    if len(sys.argv) > 1:
+        parse_optional_args(sys.argv[1:])
+
+    # Server mode
+    if serve:
+        deploy_server()
+        sys.exit(0)
+
+    # Autoscale mode
+    if autoscale_policies:
+        deploy_autoscale()
+        sys.exit(0)
+
+    # Batch mode
+    if batch_manifest:
+        deploy_batch()
+        sys.exit(0)
+
     # Get required env
     endpoint_name = os.environ.get('PORTAINER_ENDPOINT')
     check(endpoint_name, 'PORTAINER_ENDPOINT')
-    docker_container_name = os.environ.get('PROJECT_NAME')
+
+    # Cleanup mode, every node of the endpoint
+    if cleanup_mode:
+        deploy_cleanup(endpoint_name)
+        sys.exit(0)
+
+    # --name overrides PROJECT_NAME
+    docker_container_name = docker_container_name or os.environ.get('PROJECT_NAME')
     check(docker_container_name, 'PROJECT_NAME')
     swarm_mode = os.environ.get('SWARM_MODE')
     image = os.environ.get('DOCKER_IMAGE')
+    service_mode = bool(swarm_mode and swarm_mode.lower() == str(True).lower())
 
-    # Parse commandline arguments
-    if len(sys.argv) > 1:
-        parse_optional_args(sys.argv[1:])
-    
-    # Swarm mode
-    if swarm_mode and swarm_mode.lower() == str(True).lower():
+    # History and rollback of a service or container, stacks are not recorded
+    if show_history or rollback:
+        if service_mode and docker_compose_file:
+            raise Exception('History and rollback support services and containers, not stacks')
+        if show_history:
+            name = '{}_{}'.format(docker_stack_name, docker_container_name) if service_mode and docker_stack_name else docker_container_name
+            deploy_history(endpoint_name, 'service' if service_mode else 'container', name)
+            sys.exit(0)
+
+    # Rollback, swarm mode or container
+    if rollback:
+        print("------------Rollback {}------------".format('service' if service_mode else 'container'))
+        deploy_args = (endpoint_name, docker_container_name, image, [], [], [], [], docker_stack_name if service_mode else None, None, 0)
+        operation = ('rollback_service', prepull, wait_converged, wait_timeout) if service_mode else ('rollback_container',)
+    elif service_mode:
         if docker_compose_file:
             check(docker_stack_name, 'STACK_NAME')
             print("------------Deploy stack------------")
-            deploy = deploy.Deploy(endpoint_name, docker_container_name, None, None, None, None, None, docker_stack_name, docker_compose_file, None)
-            deploy.deploy_stack()
+            deploy_args = (endpoint_name, docker_container_name, None, None, None, None, None, docker_stack_name, docker_compose_file, None)
+            operation = ('deploy_stack', pull_concurrency, prepull, wait_converged, wait_timeout, stack_diff)
         else:
             check(image, 'DOCKER_IMAGE')
             print("------------Deploy service------------")
-            deploy = deploy.Deploy(endpoint_name, docker_container_name, image, docker_networks, docker_ports, docker_volumes, docker_envs, docker_stack_name, docker_compose_file, docker_memory_limit)
-            deploy.deploy_service(docker_service_mode, docker_replicas)
+            deploy_args = (endpoint_name, docker_container_name, image, docker_networks, docker_ports, docker_volumes, docker_envs, docker_stack_name, docker_compose_file, docker_memory_limit)
+            operation = ('deploy_service', docker_service_mode, docker_replicas, prepull, skip_unchanged, wait_converged, wait_timeout)
     else:
         check(image, 'DOCKER_IMAGE')
         print("------------Deploy container------------")
-        deploy = deploy.Deploy(endpoint_name, docker_container_name, image, docker_networks, docker_ports, docker_volumes, docker_envs, None, None, docker_memory_limit)
-        deploy.deploy_container()
-    
-    print("------------Deploy completed------------")
\ No newline at end of file
+        deploy_args = (endpoint_name, docker_container_name, image, docker_networks, docker_ports, docker_volumes, docker_envs, None, None, docker_memory_limit)
+        operation = ('deploy_container', skip_unchanged, blue_green, health_timeout)
+
+    deploy_kwargs = {
+        'update_config': deploy.update_config(update_parallelism, update_delay, update_order, update_failure_action, update_monitor),
+        'cpu_limit': cpu_limit,
+        'memory_reservation': memory_reservation,
+        'cpu_reservation': cpu_reservation,
+        'constraints': placement_constraints,
+        'spread': placement_spread
+    }
+
+    # concurrent deploys of the same target on this machine: one at a time, latest wins
+    lock = None
+    if deploy_lock:
+        import batch
+        from lock import DeployLock
+        lock = DeployLock(batch.target_key({
+            'endpoint': endpoint_name,
+            'name': docker_container_name,
+            'stack_name': docker_stack_name,
+            'compose_file': docker_compose_file if service_mode else None,
+            'swarm_mode': service_mode
+        }))
+        if not lock.acquire():
+            print("------------Deploy superseded------------")
+            sys.exit(0)
+
+    try:
+        # rollback runs on the sync engine
+        if deploy_engine == 'async' and not rollback:
+            deploy_async(deploy_args, deploy_kwargs, *operation)
+        else:
+            deploy_sync(deploy_args, deploy_kwargs, *operation)
+    finally:
+        if lock:
+            lock.release()
+    print("------------Deploy completed------------")
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" portainer-api deploy metrics """
+
+import functools
+import inspect
+import json
+import os
+import re
+import socket
+import threading
+import time
+import uuid
+
+METRIC_PREFIX = 'portainer_api'
+# upper bounds of the phase duration histogram in seconds, from a single call up to a slow rollout
+PHASE_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+def timed(phase):
+    '''
+    record the decorated Deploy method as a phase of self.metrics
+    '''
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(self, *args, **kwargs):
+                with self.metrics.phase(phase, self.metric_labels):
+                    return await func(self, *args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.phase(phase, self.metric_labels):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+class Phase:
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.record_phase(self.name, time.time() - self.start, 'failed' if exc_type else 'success', self.labels)
+        return False
+
+class Metrics:
+    '''
+    times deploy phases and portainer http calls.
+    PORTAINER_METRICS_FILE appends every record as a json line ('-' for stdout),
+    PORTAINER_METRICS_PROM writes prometheus text format on close (node exporter textfile collector),
+    PORTAINER_METRICS_STATSD (host:port) sends statsd timers over udp.
+    '''
+    def __init__(self, jsonl_file = None, prometheus_file = None, statsd = None):
+        self.jsonl_file = jsonl_file or os.environ.get('PORTAINER_METRICS_FILE')
+        self.prometheus_file = prometheus_file or os.environ.get('PORTAINER_METRICS_PROM')
+        statsd = statsd or os.environ.get('PORTAINER_METRICS_STATSD')
+        self.statsd = None
+        if statsd:
+            host, _, port = statsd.partition(':')
+            self.statsd = (host or 'localhost', int(port or 8125))
+            self.statsd_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.run_id = uuid.uuid4().hex[:12]
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.requests = {}
+
+    def phase(self, name, labels = None):
+        return Phase(self, name, labels or {})
+
+    def key(self, labels, **extra):
+        items = dict(labels)
+        items.update(extra)
+        return tuple(sorted(items.items()))
+
+    def record_phase(self, name, duration, status, labels):
+        with self.lock:
+            total = self.phases.setdefault(self.key(labels, phase = name, status = status), [0, 0.0, [0] * len(PHASE_BUCKETS)])
+            total[0] += 1
+            total[1] += duration
+            for index, bound in enumerate(PHASE_BUCKETS):
+                if duration <= bound:
+                    total[2][index] += 1
+        self.emit(dict(labels, type = 'phase', phase = name, status = status, duration = round(duration, 4)))
+        self.send_statsd('phase.{}'.format(name), duration)
+
+    def record_http(self, method, path, status, size, latency, retries, labels):
+        with self.lock:
+            total = self.requests.setdefault(self.key(labels, method = method, status = str(status)), [0, 0.0, 0, 0])
+            total[0] += 1
+            total[1] += latency
+            total[2] += size or 0
+            total[3] += retries
+        self.emit(dict(labels, type = 'http', method = method, path = path, status = status,
+                       bytes = size, latency = round(latency, 4), retries = retries))
+        self.send_statsd('http.{}'.format(method.lower()), latency)
+        if retries:
+            self.send_statsd_count('http.retries', retries)
+
+    def emit(self, record):
+        if not self.jsonl_file:
+            return
+        record = dict(record, run = self.run_id, time = round(time.time(), 3))
+        line = json.dumps(record) + '\n'
+        with self.lock:
+            if self.jsonl_file == '-':
+                print(line, end = '')
+            else:
+                with open(self.jsonl_file, 'a') as metrics_file:
+                    metrics_file.write(line)
+
+    def send_statsd(self, name, seconds):
+        self.send_statsd_line('{}.{}:{}|ms'.format(METRIC_PREFIX, name, int(seconds * 1000)))
+
+    def send_statsd_count(self, name, count):
+        self.send_statsd_line('{}.{}:{}|c'.format(METRIC_PREFIX, name, count))
+
+    def send_statsd_line(self, line):
+        if not self.statsd:
+            return
+        try:
+            self.statsd_socket.sendto(line.encode(), self.statsd)
+        except Exception as ex:
+            print('Can not send statsd metric: {}'.format(ex))
+
+    def prometheus_labels(self, key):
+        '''
+        label values escaped like the text format wants: backslash, double quote and newline
+        '''
+        return ','.join('{}="{}"'.format(re.sub(r'[^a-zA-Z0-9_]', '_', name),
+                                         str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                        for name, value in key)
+
+    def prometheus(self):
+        lines = [
+            '# HELP {}_phase_duration_seconds Time spent in deploy phases.'.format(METRIC_PREFIX),
+            '# TYPE {}_phase_duration_seconds histogram'.format(METRIC_PREFIX)]
+        for key, (count, duration, buckets) in sorted(self.phases.items()):
+            for bound, bucket in zip(PHASE_BUCKETS, buckets):
+                lines.append('{}_phase_duration_seconds_bucket{{{}}} {}'.format(
+                    METRIC_PREFIX, self.prometheus_labels(key + (('le', bound),)), bucket))
+            lines.append('{}_phase_duration_seconds_bucket{{{}}} {}'.format(
+                METRIC_PREFIX, self.prometheus_labels(key + (('le', '+Inf'),)), count))
+            lines.append('{}_phase_duration_seconds_sum{{{}}} {:.6f}'.format(METRIC_PREFIX, self.prometheus_labels(key), duration))
+            lines.append('{}_phase_duration_seconds_count{{{}}} {}'.format(METRIC_PREFIX, self.prometheus_labels(key), count))
+        lines += [
+            '# HELP {}_http_requests_total Portainer api calls.'.format(METRIC_PREFIX),
+            '# TYPE {}_http_requests_total counter'.format(METRIC_PREFIX)]
+        for key, (count, latency, size, retries) in sorted(self.requests.items()):
+            lines.append('{}_http_requests_total{{{}}} {}'.format(METRIC_PREFIX, self.prometheus_labels(key), count))
+        for name, index, help_text in (('http_request_duration_seconds_total', 1, 'Time spent in portainer api calls.'),
+                                       ('http_response_bytes_total', 2, 'Bytes received from portainer.'),
+                                       ('http_retries_total', 3, 'Retried portainer api calls.')):
+            lines += [
+                '# HELP {}_{} {}'.format(METRIC_PREFIX, name, help_text),
+                '# TYPE {}_{} counter'.format(METRIC_PREFIX, name)]
+            for key, total in sorted(self.requests.items()):
+                lines.append('{}_{}{{{}}} {}'.format(METRIC_PREFIX, name, self.prometheus_labels(key), total[index]))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        '''
+        time per phase, slowest first
+        '''
+        phases = {}
+        for key, (count, duration, buckets) in self.phases.items():
+            name = dict(key)['phase']
+            phases[name] = phases.get(name, 0) + duration
+        requests = sum(total[0] for total in self.requests.values())
+        latency = sum(total[1] for total in self.requests.values())
+        retries = sum(total[3] for total in self.requests.values())
+        lines = ['{:>8.2f}s  {}'.format(duration, name) for name, duration in sorted(phases.items(), key = lambda item: -item[1])]
+        lines.append('{} portainer calls, {:.2f}s, {} retries'.format(requests, latency, retries))
+        return '\n'.join(lines)
+
+    def flush(self):
+        if self.prometheus_file:
+            with self.lock:
+                text = self.prometheus()
+            temp_path = '{}.{}.tmp'.format(self.prometheus_file, os.getpid())
+            with open(temp_path, 'w') as prometheus_file:
+                prometheus_file.write(text)
+            os.replace(temp_path, self.prometheus_file)
+
+    def close(self):
+        self.flush()
+        if self.statsd:
+            self.statsd_socket.close()
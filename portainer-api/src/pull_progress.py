@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" portainer-api image pull progress """
+
+import time
+from units import format_size
+
+DEFAULT_REPORT_INTERVAL = 2
+# layer statuses after which the layer won't download anything more
+LAYER_DONE = ('Download complete', 'Pull complete', 'Already exists')
+# statuses about the whole image, their id is the tag or digest that is pulled and not a layer
+IMAGE_STATUS = ('Pulling from ', 'Pulling repository', 'Digest:', 'Status:')
+
+class PullProgress:
+    '''
+    aggregate the newline-delimited json events of /images/create into
+    layers and bytes done, and tell whether the pull stopped making progress
+    '''
+    def __init__(self, label, report_interval = DEFAULT_REPORT_INTERVAL):
+        self.label = label
+        self.report_interval = report_interval
+        self.layers = {}
+        self.digest = None
+        self.start = time.time()
+        self.last_report = self.start
+        self.last_advance = self.start
+
+    def feed(self, event):
+        if event.get('error'):
+            raise Exception('Pull {} failed: {}'.format(self.label, event['error']))
+
+        layer = event.get('id')
+        status = event.get('status') or ''
+        detail = event.get('progressDetail') or {}
+        if status.startswith('Digest:'):
+            self.digest = status.split(':', 1)[1].strip()
+        if not layer or status.startswith(IMAGE_STATUS):
+            return
+
+        progress = self.layers.setdefault(layer, {'current': 0, 'total': 0, 'done': False})
+        if status == 'Downloading' and detail.get('total'):
+            if detail.get('current', 0) > progress['current']:
+                self.last_advance = time.time()
+            progress['current'] = detail.get('current', 0)
+            progress['total'] = detail['total']
+        elif status == 'Extracting' and detail.get('current'):
+            self.last_advance = time.time()
+        elif status in LAYER_DONE and not progress['done']:
+            progress['done'] = True
+            progress['current'] = progress['total']
+            self.last_advance = time.time()
+
+    def downloaded(self):
+        return sum(progress['current'] for progress in self.layers.values())
+
+    def stalled(self, idle_timeout):
+        return time.time() - self.last_advance > idle_timeout
+
+    def status(self):
+        elapsed = max(time.time() - self.start, 0.001)
+        done = len([progress for progress in self.layers.values() if progress['done']])
+        total = sum(progress['total'] for progress in self.layers.values())
+        return '{}: {}/{} layers, {}/{}, {}/s'.format(
+            self.label, done, len(self.layers), format_size(self.downloaded()), format_size(total),
+            format_size(self.downloaded() / elapsed))
+
+    def report(self, force = False):
+        if force or time.time() - self.last_report >= self.report_interval:
+            self.last_report = time.time()
+            print(self.status())
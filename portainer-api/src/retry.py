@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" portainer-api retry policy and circuit breaker """
+
+import os
+import random
+import re
+import threading
+import time
+
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+DEFAULT_BACKOFF_MAX = 30
+# seconds a deploy may spend before failed calls are not retried anymore
+DEFAULT_RETRY_BUDGET = 300
+DEFAULT_BREAKER_THRESHOLD = 5
+DEFAULT_BREAKER_COOLDOWN = 30
+# statuses of a proxy or portainer that did not get to the docker engine, or asks to slow down
+RETRY_STATUS = (429, 502, 503, 504)
+BREAKER_STATUS = (502, 503, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+class CircuitOpenError(Exception):
+    pass
+
+class StatusError(Exception):
+    '''
+    a failed response, for callers that raise instead of returning the response
+    '''
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+def error_status(ex):
+    '''
+    http status of a StatusError or a requests HTTPError, None for connection and stream errors
+    '''
+    status = getattr(ex, 'status_code', None)
+    if status is None:
+        status = getattr(getattr(ex, 'response', None), 'status_code', None)
+    return status
+
+class CircuitBreaker:
+    '''
+    opens after threshold calls in a row failed with a connection error or 502/503/504 (each after its
+    retries), every call then fails at once for cooldown seconds. after the cooldown one call is let
+    through, its success closes the breaker, its failure opens it again.
+    '''
+    def __init__(self, key, threshold, cooldown):
+        self.key = key
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def check(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if time.time() - self.opened_at >= self.cooldown and not self.trial:
+                self.trial = True
+                return
+        raise CircuitOpenError('{} is unavailable after {} failed calls, not calling it for {}s'.format(
+            self.key, self.failures, self.cooldown))
+
+    def record(self, failed):
+        with self.lock:
+            if not failed:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.trial or self.failures >= self.threshold:
+                    if self.opened_at is None or self.trial:
+                        print('Circuit breaker of {} opened after {} failed calls'.format(self.key, self.failures))
+                    self.opened_at = time.time()
+            self.trial = False
+
+breakers = {}
+breakers_lock = threading.Lock()
+
+class RetryPolicy:
+    '''
+    retries of the portainer calls of one deploy: exponential backoff with full jitter up to
+    backoff_max, at most retries times per call and only while the deploy is within its budget.
+    only idempotent calls are retried on 429/502/503/504 and on errors after the request was sent,
+    any call is retried when the connection could not be opened.
+    the circuit breakers are shared by every deploy of the process, one per portainer endpoint.
+    PORTAINER_RETRIES, PORTAINER_BACKOFF, PORTAINER_BACKOFF_MAX, PORTAINER_RETRY_BUDGET,
+    PORTAINER_BREAKER_THRESHOLD and PORTAINER_BREAKER_COOLDOWN override the defaults.
+    '''
+    def __init__(self, retries = None, backoff = None, backoff_max = None, budget = None,
+                 breaker_threshold = None, breaker_cooldown = None):
+        self.retries = retries if retries is not None else int(os.environ.get('PORTAINER_RETRIES', DEFAULT_RETRIES))
+        self.backoff = backoff if backoff is not None else float(os.environ.get('PORTAINER_BACKOFF', DEFAULT_BACKOFF))
+        self.backoff_max = backoff_max if backoff_max is not None else float(os.environ.get('PORTAINER_BACKOFF_MAX', DEFAULT_BACKOFF_MAX))
+        self.budget = budget if budget is not None else float(os.environ.get('PORTAINER_RETRY_BUDGET', DEFAULT_RETRY_BUDGET))
+        self.breaker_threshold = breaker_threshold or int(os.environ.get('PORTAINER_BREAKER_THRESHOLD', DEFAULT_BREAKER_THRESHOLD))
+        self.breaker_cooldown = breaker_cooldown if breaker_cooldown is not None else float(
+            os.environ.get('PORTAINER_BREAKER_COOLDOWN', DEFAULT_BREAKER_COOLDOWN))
+        self.random = random.Random()
+        self.renew()
+
+    def renew(self):
+        '''
+        start a new budget, for instances that run one deploy after another
+        '''
+        self.deadline = time.time() + self.budget if self.budget else None
+
+    def breaker(self, url):
+        '''
+        breaker of the portainer endpoint of url, calls outside an endpoint share the portainer one
+        '''
+        match = re.match(r'^(.*?/api/endpoints/\d+)(/|$)', url)
+        key = match.group(1) if match else url.split('/api/')[0]
+        with breakers_lock:
+            if key not in breakers:
+                breakers[key] = CircuitBreaker(key, self.breaker_threshold, self.breaker_cooldown)
+            return breakers[key]
+
+    def retryable(self, method, status = None, sent = True, idempotent = None):
+        '''
+        status None is a connection or stream error, sent False an error before the request went out
+        '''
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        if status is not None:
+            return idempotent and status in RETRY_STATUS
+        return idempotent or not sent
+
+    def delay(self, attempt, retry_after = None):
+        '''
+        seconds to wait before retry number attempt + 1, None when the retries or the budget are spent
+        '''
+        if attempt >= self.retries:
+            return None
+        delay = self.random.uniform(0, min(self.backoff_max, self.backoff * (2 ** attempt)))
+        if retry_after:
+            try:
+                delay = max(delay, min(float(retry_after), self.backoff_max))
+            except ValueError:
+                pass
+        if self.deadline and time.time() + delay > self.deadline:
+            print('Retry budget of {:.0f}s spent, not retrying'.format(self.budget))
+            return None
+        return delay
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" portainer-api deploy server """
+
+import batch
+import itertools
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+DEFAULT_LISTEN = '127.0.0.1:8700'
+# finished jobs kept for status queries
+DEFAULT_JOB_HISTORY = 1000
+MAX_WAIT = 3600
+FINISHED = ('success', 'failed', 'no-op', 'superseded')
+
+class DeployQueue:
+    '''
+    runs deploy jobs on a warm BatchDeploy: one job at a time per container, service or stack,
+    at most workers jobs overall. A job submitted while another one for the same target waits
+    replaces the waiting one, so a burst of deploys ends in a single deploy of the latest request.
+    '''
+    def __init__(self, workers = batch.DEFAULT_WORKERS, endpoint_concurrency = batch.DEFAULT_ENDPOINT_CONCURRENCY,
+                 defaults = None, history = DEFAULT_JOB_HISTORY):
+        self.runner = batch.BatchDeploy([], workers, endpoint_concurrency)
+        self.executor = ThreadPoolExecutor(max_workers = workers)
+        self.defaults = defaults or {}
+        self.history = history
+        self.lock = threading.Condition()
+        self.ids = itertools.count(1)
+        self.jobs = {}
+        self.running = {}
+        self.waiting = {}
+
+    def submit(self, target):
+        target = dict(self.defaults, **target)
+        batch.validate_target(target)
+        key = batch.target_key(target)
+
+        with self.lock:
+            waiting = self.waiting.get(key)
+            if waiting:
+                waiting['target'] = target
+                waiting['coalesced'] += 1
+                print('Deploy {} coalesced into job {}'.format(key, waiting['id']))
+                return dict(waiting)
+
+            job = {
+                'id': str(next(self.ids)),
+                'key': key,
+                'kind': batch.target_kind(target),
+                'target': target,
+                'status': 'queued',
+                'coalesced': 0,
+                'created': time.time(),
+                'started': None,
+                'finished': None,
+                'duration': None,
+                'error': None
+            }
+            self.jobs[job['id']] = job
+            if key in self.running:
+                self.waiting[key] = job
+            else:
+                self.start(job)
+            self.trim()
+            return dict(job)
+
+    def start(self, job):
+        self.running[job['key']] = job
+        job['status'] = 'running'
+        job['started'] = time.time()
+        self.executor.submit(self.run, job)
+
+    def run(self, job):
+        try:
+            result = self.runner.run_target(job['target'])
+        except Exception as ex:
+            result = {'status': 'failed', 'error': str(ex), 'duration': time.time() - job['started']}
+        try:
+            self.runner.metrics.flush()
+        except Exception as ex:
+            print('Can not write metrics: {}'.format(ex))
+
+        with self.lock:
+            job['status'] = result['status']
+            job['error'] = result['error']
+            job['duration'] = result['duration']
+            job['finished'] = time.time()
+            print('Job {} {} {} in {:.2f}s'.format(job['id'], job['key'], job['status'], job['duration']))
+            del self.running[job['key']]
+            waiting = self.waiting.pop(job['key'], None)
+            if waiting:
+                self.start(waiting)
+            self.lock.notify_all()
+
+    def trim(self):
+        finished = [job for job in self.jobs.values() if job['status'] in FINISHED]
+        for job in sorted(finished, key = lambda job: job['finished'])[:max(len(self.jobs) - self.history, 0)]:
+            del self.jobs[job['id']]
+
+    def job(self, job_id, wait = 0):
+        '''
+        job status, waits up to wait seconds for the job to finish
+        '''
+        deadline = time.time() + min(wait, MAX_WAIT)
+        with self.lock:
+            while job_id in self.jobs and self.jobs[job_id]['status'] not in FINISHED and time.time() < deadline:
+                self.lock.wait(deadline - time.time())
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def list(self):
+        with self.lock:
+            return [dict(job) for job in sorted(self.jobs.values(), key = lambda job: int(job['id']))]
+
+    def status(self):
+        with self.lock:
+            return {
+                'running': len(self.running),
+                'waiting': len(self.waiting),
+                'jobs': len(self.jobs),
+                'connections': self.runner.connection_stats()
+            }
+
+    def close(self):
+        self.executor.shutdown(wait = True)
+        self.runner.close()
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        print('{} {}'.format(self.address_string(), format % args))
+
+    @property
+    def queue(self):
+        return self.server.queue
+
+    def send(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def authorized(self):
+        token = self.server.token
+        if not token or self.headers.get('Authorization') == 'Bearer ' + token:
+            return True
+        self.send(401, {'message': 'invalid token'})
+        return False
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        url = urlparse(self.path)
+        if url.path == '/health':
+            return self.send(200, dict(self.queue.status(), status = 'ok'))
+        if url.path == '/deploys':
+            return self.send(200, self.queue.list())
+        match = re.match(r'^/deploys/(\d+)$', url.path)
+        if match:
+            try:
+                wait = float(parse_qs(url.query).get('wait', ['0'])[0])
+            except ValueError:
+                return self.send(400, {'message': 'wait has to be a number of seconds'})
+            job = self.queue.job(match.group(1), wait)
+            return self.send(200, job) if job else self.send(404, {'message': 'no such job'})
+        self.send(404, {'message': 'not found'})
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        if urlparse(self.path).path != '/deploys':
+            return self.send(404, {'message': 'not found'})
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            target = json.loads(self.rfile.read(length) or b'{}')
+            if not isinstance(target, dict):
+                raise ValueError('a deploy is a json object')
+            self.send(202, self.queue.submit(target))
+        except (ValueError, TypeError, AttributeError) as ex:
+            self.send(400, {'message': str(ex)})
+
+def serve(listen = None, workers = batch.DEFAULT_WORKERS, endpoint_concurrency = batch.DEFAULT_ENDPOINT_CONCURRENCY, defaults = None):
+    '''
+    DEPLOY_SERVER_TOKEN, when set, has to be sent as Authorization: Bearer <token>
+    '''
+    host, _, port = (listen or os.environ.get('DEPLOY_SERVER_LISTEN', DEFAULT_LISTEN)).rpartition(':')
+    server = ThreadingHTTPServer((host or '127.0.0.1', int(port)), Handler)
+    server.daemon_threads = True
+    server.queue = DeployQueue(workers, endpoint_concurrency, defaults)
+    server.token = os.environ.get('DEPLOY_SERVER_TOKEN')
+    print('Deploy server listening on {}:{}'.format(*server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.queue.close()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" portainer-api human readable units """
+
+import re
+
+DURATION_UNITS = {
+    'ns': 1,
+    'us': 10 ** 3,
+    'ms': 10 ** 6,
+    's': 10 ** 9,
+    'm': 60 * 10 ** 9,
+    'h': 3600 * 10 ** 9
+}
+
+def parse_duration(value):
+    '''
+    docker style duration (10s, 1m30s, 500ms, plain numbers are seconds) in nanoseconds
+    '''
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        return int(value * DURATION_UNITS['s'])
+    value = str(value).strip()
+    if re.match(r'^\d+(\.\d+)?$', value):
+        return int(float(value) * DURATION_UNITS['s'])
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ns|us|ms|s|m|h)', value)
+    if not parts or ''.join(number + unit for number, unit in parts) != value:
+        raise Exception('invalid duration {}'.format(value))
+    return int(sum(float(number) * DURATION_UNITS[unit] for number, unit in parts))
+
+SIZE_UNITS = {
+    'b': 1,
+    'k': 1024,
+    'm': 1024 ** 2,
+    'g': 1024 ** 3,
+    't': 1024 ** 4
+}
+
+def parse_size(value):
+    '''
+    docker style size (512m, 1.5g, 64k; kb/mb/gb work too, plain numbers are bytes) in bytes
+    '''
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = re.match(r'^(\d+(?:\.\d+)?)\s*([bkmgt]?)b?$', str(value).strip().lower())
+    if not match:
+        raise Exception('invalid size {}'.format(value))
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2) or 'b'])
+
+def parse_cpus(value):
+    '''
+    number of cpus (1.5, 0.25) in nano cpus
+    '''
+    if value is None or value == '':
+        return None
+    try:
+        cpus = float(value)
+    except ValueError:
+        raise Exception('invalid cpus {}'.format(value))
+    if cpus <= 0:
+        raise Exception('cpus must be greater than 0')
+    return int(round(cpus * 10 ** 9))
+
+def format_size(value):
+    '''
+    bytes as docker prints them: 1.5GB, 320MB (binary units)
+    '''
+    value = float(value or 0)
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(value) < 1024:
+            return '{:.0f}{}'.format(value, unit) if unit == 'B' else '{:.1f}{}'.format(value, unit)
+        value /= 1024
+    return '{:.1f}TB'.format(value)